@@ -0,0 +1,195 @@
+import collections
+import time
+
+# A user posting FLOOD_MESSAGES times in one channel within FLOOD_WINDOW seconds is flooding it; BURST_MESSAGES
+# across all channels within BURST_WINDOW seconds is a burst
+FLOOD_WINDOW = 10
+FLOOD_MESSAGES = 8
+BURST_WINDOW = 60
+BURST_MESSAGES = 30
+# Flood and burst alerts for the same user are at least this far apart
+ALERT_INTERVAL = 5 * 60
+# Each 5 minute slot with at least one message counts as active time
+ACTIVE_SLOT = 5 * 60
+# Reaching out to this many people for the first time within a day is a pattern of scams and grooming
+MANY_NEW_CONTACTS = 20
+# Extra severity for reports against users who flooded in the last day or made many new contacts
+FLOOD_SEVERITY_WEIGHT = 0.5
+NEW_CONTACTS_SEVERITY_WEIGHT = 0.5
+MAX_CONTACTS = 1000
+MAX_CHANNELS = 10
+MAX_USERS = 50000
+
+
+class RingCounter:
+    '''
+    Event counts over a sliding window of `buckets` buckets of `width` seconds each. A bucket is reused once its
+    time has passed, so the counter never grows and stale counts never need cleaning up.
+    '''
+
+    __slots__ = ("width", "counts", "stamps")
+
+    def __init__(self, width, buckets):
+        self.width = width
+        self.counts = [0] * buckets
+        self.stamps = [-1] * buckets
+
+    def add(self, now, amount=1):
+        bucket = int(now // self.width)
+        index = bucket % len(self.counts)
+        if self.stamps[index] != bucket:
+            self.stamps[index] = bucket
+            self.counts[index] = 0
+        self.counts[index] += amount
+
+    def total(self, now):
+        oldest = int(now // self.width) - len(self.counts)
+        return sum(count for count, stamp in zip(self.counts, self.stamps) if stamp > oldest)
+
+
+def write_activity(db, rows):
+    '''
+    Write job: stores a batch of (user_id, new_chats_last_day, hours_logged_delta, num_friends, now) rows.
+    '''
+    db.executemany('''
+    INSERT INTO users (user_id, new_chats_last_day, hours_logged, num_friends, created_at, updated_at)
+    VALUES (?1, ?2, ?3, ?4, ?5, ?5)
+    ON CONFLICT (user_id) DO UPDATE SET new_chats_last_day = excluded.new_chats_last_day,
+                                        hours_logged = COALESCE(hours_logged, 0) + excluded.hours_logged,
+                                        num_friends = MAX(COALESCE(num_friends, 0), excluded.num_friends),
+                                        updated_at = excluded.updated_at
+    ''', rows)
+
+
+class UserActivity:
+    __slots__ = ("channels", "messages", "contacts", "new_contacts", "last_slot", "unflushed_hours",
+                 "flooded_at", "alerted_at")
+
+    def __init__(self):
+        self.channels = collections.OrderedDict()  # channel id -> RingCounter over FLOOD_WINDOW
+        self.messages = RingCounter(BURST_WINDOW / 6, 6)
+        self.contacts = collections.OrderedDict()  # user id -> when they were first contacted
+        self.new_contacts = RingCounter(60 * 60, 24)
+        self.last_slot = None
+        self.unflushed_hours = 0.0
+        self.flooded_at = None
+        self.alerted_at = None
+
+
+class ActivityTracker:
+    '''
+    Per-user message velocity, new contacts and active time, kept in memory with RingCounters.
+
+    `record` is called for every channel message and returns an alert when the user floods a channel or posts
+    a burst across channels. Counters of users who have been active since the last flush are written to the
+    users table (new_chats_last_day, hours_logged, num_friends) in one batch by `flush`.
+    '''
+
+    def __init__(self, writer, max_users=MAX_USERS):
+        self.writer = writer
+        self.max_users = max_users
+        self.users = collections.OrderedDict()
+        self.dirty = set()
+        # Rows of users evicted before their counters were flushed
+        self.pending = []
+
+    def get(self, user_id):
+        activity = self.users.get(user_id)
+        if activity is None:
+            activity = self.users[user_id] = UserActivity()
+            while len(self.users) > self.max_users:
+                evicted_id, evicted = self.users.popitem(last=False)
+                if evicted_id in self.dirty:
+                    self.dirty.discard(evicted_id)
+                    self.pending.append(self.row(evicted_id, evicted, time.time()))
+        else:
+            self.users.move_to_end(user_id)
+        return activity
+
+    def record(self, user_id, channel_id, contact_ids=(), now=None):
+        '''
+        Counts a message from the user, addressed to `contact_ids` (mentions and replies). Returns a description
+        of the flood or burst if the user just crossed a threshold and hasn't been alerted about recently.
+        '''
+        now = now if now is not None else time.time()
+        activity = self.get(user_id)
+        self.dirty.add(user_id)
+
+        channel = activity.channels.get(channel_id)
+        if channel is None:
+            channel = activity.channels[channel_id] = RingCounter(FLOOD_WINDOW / 5, 5)
+            if len(activity.channels) > MAX_CHANNELS:
+                activity.channels.popitem(last=False)
+        else:
+            activity.channels.move_to_end(channel_id)
+        channel.add(now)
+        activity.messages.add(now)
+
+        for contact_id in contact_ids:
+            if contact_id == user_id:
+                continue
+            if contact_id in activity.contacts:
+                activity.contacts.move_to_end(contact_id)
+                continue
+            activity.contacts[contact_id] = now
+            activity.new_contacts.add(now)
+            if len(activity.contacts) > MAX_CONTACTS:
+                activity.contacts.popitem(last=False)
+
+        slot = int(now // ACTIVE_SLOT)
+        if slot != activity.last_slot:
+            activity.last_slot = slot
+            activity.unflushed_hours += ACTIVE_SLOT / 3600
+
+        in_channel = channel.total(now)
+        overall = activity.messages.total(now)
+        if in_channel >= FLOOD_MESSAGES:
+            alert = f"{in_channel} messages in one channel within {FLOOD_WINDOW} seconds"
+        elif overall >= BURST_MESSAGES:
+            alert = f"{overall} messages across channels within {BURST_WINDOW} seconds"
+        else:
+            return None
+        activity.flooded_at = now
+        if activity.alerted_at is not None and now - activity.alerted_at < ALERT_INTERVAL:
+            return None
+        activity.alerted_at = now
+        return alert
+
+    def new_contacts(self, user_id, now=None):
+        activity = self.users.get(user_id)
+        return activity.new_contacts.total(now if now is not None else time.time()) if activity is not None else 0
+
+    def severity_weight(self, user_id, now=None):
+        '''
+        Multiplier for a new report against the user, based on their recent activity.
+        '''
+        now = now if now is not None else time.time()
+        activity = self.users.get(user_id)
+        if activity is None:
+            return 1
+        weight = 1
+        if activity.flooded_at is not None and now - activity.flooded_at < 24 * 60 * 60:
+            weight += FLOOD_SEVERITY_WEIGHT
+        if activity.new_contacts.total(now) >= MANY_NEW_CONTACTS:
+            weight += NEW_CONTACTS_SEVERITY_WEIGHT
+        return weight
+
+    def row(self, user_id, activity, now):
+        row = (user_id, activity.new_contacts.total(now), activity.unflushed_hours, len(activity.contacts), now)
+        activity.unflushed_hours = 0.0
+        return row
+
+    def flush(self):
+        '''
+        Queues one write job with the counters of every user active since the last flush.
+        '''
+        now = time.time()
+        rows = self.pending + [self.row(user_id, self.users[user_id], now) for user_id in self.dirty]
+        self.pending = []
+        self.dirty.clear()
+        if rows:
+            self.writer.submit(write_activity, rows)
+        return len(rows)
+
+    def __len__(self):
+        return len(self.users)
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+
+logger = logging.getLogger('discord')
+
+
+class MessageBatcher:
+    '''
+    Collects items per key and hands them to `flush(key, items)` once `max_messages` have arrived or
+    `max_delay` seconds have passed since the first one, whichever comes first.
+    '''
+
+    def __init__(self, flush, max_messages, max_delay):
+        self.flush_callback = flush
+        self.max_messages = max_messages
+        self.max_delay = max_delay
+        self.pending = {}
+        self.timers = {}
+        self.tasks = set()
+
+    def add(self, key, item):
+        items = self.pending.setdefault(key, [])
+        items.append(item)
+        if len(items) >= self.max_messages:
+            self.flush(key)
+        elif len(items) == 1:
+            self.timers[key] = self.spawn(self.flush_later(key))
+
+    async def flush_later(self, key):
+        await asyncio.sleep(self.max_delay)
+        self.timers.pop(key, None)
+        self.flush(key)
+
+    def flush(self, key):
+        timer = self.timers.pop(key, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        items = self.pending.pop(key, None)
+        if items:
+            self.spawn(self.flush_callback(key, items))
+
+    def flush_all(self):
+        for key in list(self.pending):
+            self.flush(key)
+
+    def spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.on_task_done)
+        return task
+
+    def on_task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Batch flush failed", exc_info=task.exception())
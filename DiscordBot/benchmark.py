@@ -0,0 +1,363 @@
+'''
+Replays a corpus of chat messages through ModBot.on_message without a Discord connection and reports
+throughput, end-to-end latency, event-loop lag and API calls per message.
+
+Discord objects are replaced by small fakes and the LLM calls by local stand-ins with configurable latency, so
+runs are free and repeatable. Perspective requests go through the bot's real PerspectiveClient (token bucket,
+retries, max_pending) to a stub server on localhost. The bot runs inside a temporary directory with its own
+modbot.db.
+
+    python benchmark.py --messages 2000 --rate 200 --llm-latency 1.5
+    python benchmark.py --corpus p4dataset2024.txt --mode cascade
+'''
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from aiohttp import web
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GROUP_NUM = "26"
+
+BENIGN = [
+    "anyone up for a game tonight?", "lol that was hilarious", "did you finish the homework",
+    "what time is the meeting", "i just got a new puppy!", "good morning everyone",
+    "has anyone seen the new episode", "brb getting food", "that build is so good", "thanks for the help",
+]
+SPAM = [
+    "FREE NITRO claim your nitro at http://disc0rd-gift.example", "wire me money and I'll double it, dm me for a deal",
+    "claim your robux now at http://free-robux.example", "send me bitcoin for a guaranteed 10x return",
+]
+TOXIC = [
+    "you are a worthless idiot and everyone hates you", "shut up you stupid loser",
+    "i know where you live and i will hurt you", "go kill yourself nobody wants you here",
+]
+GROOMING = [
+    "how old are u? you seem really mature", "are you alone right now?", "don't tell your parents we talk, it's our little secret",
+    "send me a pic of you, i won't show anyone", "what school do you go to?",
+]
+
+
+class FakeChannel:
+    def __init__(self, channel_id, name, guild, stats, latency):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.stats = stats
+        self.latency = latency
+
+    async def send(self, content=None, **kwargs):
+        self.stats["discord_sends"] += 1
+        await asyncio.sleep(self.latency)
+
+    def get_partial_message(self, message_id):
+        return FakeMessage(message_id, "", None, self, self.stats, self.latency)
+
+
+class FakeMessage:
+    def __init__(self, message_id, content, author, channel, stats, latency):
+        self.id = message_id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.stats = stats
+        self.latency = latency
+
+    async def delete(self):
+        self.stats["discord_deletes"] += 1
+        await asyncio.sleep(self.latency)
+
+
+def load_corpus(path, count, rng):
+    '''
+    Returns (text, label) pairs. A corpus file has one message per line, optionally as "LABEL<TAB>text";
+    without a usable file a synthetic mix of benign chat, spam raids, toxicity and grooming is generated.
+    '''
+    if path and os.path.isfile(path):
+        with open(path, encoding='utf-8') as f:
+            lines = [line.rstrip('\n') for line in f if line.strip()]
+        if lines:
+            corpus = []
+            for line in lines:
+                label, _, text = line.rpartition('\t')
+                corpus.append((text, label or None))
+            return [corpus[i % len(corpus)] for i in range(count)]
+        print(f"{path} is empty, generating a synthetic corpus instead")
+
+    kinds = [(BENIGN, None, 0.80), (SPAM, "SPAM", 0.08), (TOXIC, "HARASSMENT", 0.07), (GROOMING, "CHILD_GROOMING", 0.05)]
+    corpus = []
+    for _ in range(count):
+        texts, label, _ = rng.choices(kinds, weights=[kind[2] for kind in kinds])[0]
+        corpus.append((rng.choice(texts), label))
+    return corpus
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+async def run(args, bot_module):
+    import local_model
+    import metrics
+    import pipeline
+    from classifier import Verdict
+    from classify_worker import Worker
+    from report import BroadAbuseType, SpecificAbuseType
+
+    rng = random.Random(args.seed)
+    stats = {"llm_calls": 0, "llm_api_calls": 0, "perspective_calls": 0, "discord_sends": 0, "discord_deletes": 0}
+    labels = {}
+
+    def verdict_for(label):
+        if label == "CHILD_GROOMING":
+            return Verdict(True, BroadAbuseType.HARASSMENT, SpecificAbuseType.GROOMING, child_grooming_info=["personal_questions_asked"])
+        if label == "SPAM":
+            return Verdict(True, BroadAbuseType.SPAM, SpecificAbuseType.SCAM)
+        if label:
+            return Verdict(True, BroadAbuseType.HARASSMENT, SpecificAbuseType.BULLYING)
+        return Verdict(False)
+
+    def last_label(conversation):
+        # The stand-ins judge a conversation by its last message, looked up by text
+        for text, label in labels.items():
+            if conversation.rstrip().endswith(text):
+                return label
+        return None
+
+    async def fake_classify(conversation, mode="structured"):
+        verdict = verdict_for(last_label(conversation))
+        # Triage clears a clean conversation in 1 call. The cascade then makes 6 calls for a violation and 10 for
+        # grooming, in 4 and 5 rounds since independent questions are asked concurrently.
+        if not verdict.violation:
+            calls, rounds = 1, 1
+        elif mode == "structured":
+            calls, rounds = 2, 2
+        else:
+            calls, rounds = (10, 5) if verdict.child_grooming_info else (6, 4)
+        stats["llm_calls"] += 1
+        stats["llm_api_calls"] += calls
+        await asyncio.sleep(args.llm_latency * rounds)
+        if rng.random() < args.llm_error_rate:
+            raise RuntimeError("LLM unavailable")
+        verdict.api_calls = calls
+        return verdict
+
+    async def fake_classify_batch(messages, targets):
+        stats["llm_calls"] += 1
+        stats["llm_api_calls"] += 1
+        await asyncio.sleep(args.llm_latency)
+        if rng.random() < args.llm_error_rate:
+            raise RuntimeError("LLM unavailable")
+        return {index: verdict_for(labels.get(messages[index][1])) for index in targets}
+
+    async def stub_perspective(request):
+        stats["perspective_calls"] += 1
+        text = (await request.json())["comment"]["text"]
+        await asyncio.sleep(args.perspective_latency)
+        if rng.random() < args.perspective_error_rate:
+            return web.Response(status=503, text="stub outage")
+        label = labels.get(text)
+        if label == "HARASSMENT":
+            value = rng.uniform(0.6, 0.99)
+        elif label:
+            value = rng.uniform(0.2, 0.6)
+        else:
+            value = rng.uniform(0.0, 0.45)
+        return web.json_response({"attributeScores": {"TOXICITY": {"summaryScore": {"value": value}}}})
+
+    app = web.Application()
+    app.router.add_post("/", stub_perspective)
+    stub = web.AppRunner(app, access_log=None)
+    await stub.setup()
+    site = web.TCPSite(stub, "127.0.0.1", 0)
+    await site.start()
+    perspective_url = f"http://127.0.0.1:{stub.addresses[0][1]}/"
+
+    pipeline.classify = fake_classify
+    pipeline.classify_batch = fake_classify_batch
+    bot_module.CLASSIFICATION_MODE = args.mode
+    bot_module.BATCH_MAX_MESSAGES = args.batch
+    if args.perspective_qps is not None:
+        bot_module.PERSPECTIVE_QPS = args.perspective_qps
+
+    class BenchBot(bot_module.ModBot):
+        user = SimpleNamespace(id=1, name=f"Group {GROUP_NUM} Bot")
+
+    bot = BenchBot("benchmark", classify_in_workers=args.queue > 0)
+    bot.perspective.url = perspective_url
+    if args.local_model:
+        local_model.train(bot.conn, args.local_model, full=True)
+    # What setup_hook does once the real bot has logged in, without its background tasks
+    bot.set_group_num(bot.user.name)
+    bot.load()
+
+    guild = SimpleNamespace(id=1000, name="bench")
+    mod_channel = FakeChannel(2000, f"group-{GROUP_NUM}-mod", guild, stats, args.discord_latency)
+    channels = [FakeChannel(3000 + i, f"group-{GROUP_NUM}", guild, stats, args.discord_latency) for i in range(args.channels)]
+    users = [SimpleNamespace(id=10_000 + i, name=f"user{i}") for i in range(args.users)]
+    guild.text_channels = [mod_channel] + channels
+    bot.guild_registry.scan_guild(guild)
+    bot.mod_channels[guild.id] = mod_channel
+    channels_by_id = {channel.id: channel for channel in channels}
+    bot.get_channel = channels_by_id.get
+
+    # Time each message until the bot is done with it, including any batch it ends up in
+    started, finished = {}, {}
+    classify_message = bot.classify_message
+    apply_result = bot.apply_result
+
+    async def timed_classify(message, messages):
+        await classify_message(message, messages)
+        finished[message.id] = time.perf_counter()
+
+    async def timed_apply_result(payload, actions):
+        await apply_result(payload, actions)
+        finished[payload["id"]] = time.perf_counter()
+
+    bot.classify_message = timed_classify
+    bot.apply_result = timed_apply_result
+
+    # With --queue, workers run in this process as well (so the fake APIs apply) and share the database
+    workers = []
+    for index in range(args.queue):
+        worker = Worker(f"bench-{index}", bot_module.DB_PATH, "benchmark",
+                        perspective_qps=(bot_module.PERSPECTIVE_QPS - bot_module.GATEWAY_PERSPECTIVE_QPS) / args.queue,
+                        mode=args.mode,
+                        batch_max_messages=args.batch)
+        worker.perspective.url = perspective_url
+        workers.append(worker)
+    worker_tasks = [asyncio.create_task(worker.run()) for worker in workers]
+    if workers:
+        bot.result_poller = asyncio.create_task(bot.deliver_results())
+
+    lags = []
+    running = True
+
+    async def monitor_loop_lag():
+        while running:
+            before = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - before - 0.01)
+
+    monitor = asyncio.create_task(monitor_loop_lag())
+    corpus = load_corpus(args.corpus, args.messages, rng)
+    handlers = []
+
+    start = time.perf_counter()
+    for index, (text, label) in enumerate(corpus):
+        labels[text] = label
+        message = FakeMessage(index + 1, text, rng.choice(users), rng.choice(channels), stats, args.discord_latency)
+        started[message.id] = time.perf_counter()
+        # discord.py runs each event handler in its own task
+        handlers.append(asyncio.create_task(bot.on_message(message)))
+        if args.rate:
+            await asyncio.sleep(1 / args.rate)
+        else:
+            await asyncio.sleep(0)
+
+    await asyncio.gather(*handlers)
+
+    def busy():
+        if workers:
+            return bot.db.qsize() or any(status != "FAILED" for status in bot.work_queue.counts()) or \
+                any(worker.tasks for worker in workers)
+        return bot.classification_tasks or bot.pipeline.batcher.pending or bot.pipeline.batcher.tasks
+
+    while busy():
+        bot.pipeline.batcher.flush_all()
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    for task in worker_tasks + ([bot.result_poller] if workers else []):
+        task.cancel()
+    for worker in workers:
+        await worker.close()
+    await bot.perspective.close()
+    # Deletions and notices still waiting on their rate limits are sent before counting them
+    await bot.outbound.drain()
+    drained = time.perf_counter() - start
+    running = False
+    await monitor
+    await stub.cleanup()
+    # Wait for the writer thread to commit everything that was queued
+    bot.user_activity.flush()
+    bot.db.close()
+    reports = bot.conn.execute("SELECT COUNT(*) FROM reports").fetchone()[0]
+
+    # Messages stopped by the regex tier never reach classify_message
+    latencies = [finished.get(message_id, started[message_id]) - started[message_id] for message_id in started]
+    count = len(corpus)
+    print(f"Messages:            {count} ({args.mode} mode, batch size {args.batch}"
+          f"{f', {args.queue} queue workers' if args.queue else ''})")
+    print(f"Throughput:          {count / elapsed:.1f} messages/sec over {elapsed:.2f}s")
+    print(f"End-to-end latency:  p50 {percentile(latencies, 50) * 1000:.1f}ms, "
+          f"p95 {percentile(latencies, 95) * 1000:.1f}ms, p99 {percentile(latencies, 99) * 1000:.1f}ms")
+    print(f"Event-loop lag:      mean {statistics.mean(lags) * 1000 if lags else 0:.2f}ms, "
+          f"p99 {percentile(lags, 99) * 1000:.2f}ms, max {max(lags, default=0) * 1000:.2f}ms")
+    print(f"LLM requests:        {stats['llm_calls']} ({stats['llm_calls'] / count:.3f}/message), "
+          f"{stats['llm_api_calls']} API round trips ({stats['llm_api_calls'] / count:.3f}/message)")
+    shed = metrics.API_CALLS.values.get(("perspective", "shed"), 0)
+    print(f"Perspective calls:   {stats['perspective_calls']} ({stats['perspective_calls'] / count:.3f}/message) at "
+          f"{bot_module.PERSPECTIVE_QPS} QPS, {shed} shed over the quota")
+    print(f"Discord actions:     {stats['discord_deletes']} deletes, {stats['discord_sends']} sends, "
+          f"all sent after {drained:.2f}s")
+    print(f"Reports filed:       {reports}")
+    if bot.classifications_dropped:
+        print(f"Dropped:             {bot.classifications_dropped} message(s) over MAX_PENDING_CLASSIFICATIONS")
+    for tier in bot_module.TIERS:
+        print(f"  {bot.tier_stats[tier].summary()}")
+    for worker in workers:
+        print(f"Worker {worker.name}:")
+        for tier in bot_module.TIERS:
+            if worker.tier_stats[tier].calls:
+                print(f"  {worker.tier_stats[tier].summary()}")
+    print(bot.format_cache_stats())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay synthetic or recorded traffic through ModBot.")
+    parser.add_argument("--corpus", help="file with one message per line, optionally LABEL<TAB>text")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=100, help="messages per second, 0 for as fast as possible")
+    parser.add_argument("--channels", type=int, default=5)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--mode", choices=["structured", "cascade"], default="structured")
+    parser.add_argument("--batch", type=int, default=5, help="BATCH_MAX_MESSAGES, 1 disables batching")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="seconds per LLM round trip")
+    parser.add_argument("--perspective-latency", type=float, default=0.15)
+    parser.add_argument("--perspective-qps", type=float,
+                        help="Perspective quota, split between the gateway and the workers with --queue "
+                             "(default: PERSPECTIVE_QPS)")
+    parser.add_argument("--discord-latency", type=float, default=0.05)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="share of LLM requests that fail")
+    parser.add_argument("--perspective-error-rate", type=float, default=0.0,
+                        help="share of Perspective requests that fail with a 503 (and are retried)")
+    parser.add_argument("--local-model", metavar="DATASET", help="train the local model from this LABEL<TAB>text file first")
+    parser.add_argument("--queue", type=int, default=0, metavar="WORKERS",
+                        help="classify through the work queue with this many workers instead of on the bot's loop")
+    parser.add_argument("--seed", type=int, default=152)
+    args = parser.parse_args()
+    if args.corpus:
+        args.corpus = os.path.abspath(args.corpus)
+    if args.local_model:
+        args.local_model = os.path.abspath(args.local_model)
+
+    # The bot opens modbot.db (and looks for config.json) relative to the working directory
+    workdir = tempfile.mkdtemp(prefix="modbot-bench-")
+    os.chdir(workdir)
+    sys.path.insert(0, HERE)
+    import bot as bot_module
+
+    asyncio.run(run(args, bot_module))
+
+
+if __name__ == "__main__":
+    main()
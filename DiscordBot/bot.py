@@ -1,113 +1,360 @@
-import collections
+import argparse
+import asyncio
 import discord
 from discord.ext import commands
 import os
 import json
 import logging
 import re
-import sqlite3
+import time
 from types import SimpleNamespace
-from collections import deque
-from queue import PriorityQueue
-from report import Report, SpecificAbuseType, BroadAbuseType, State
+from report import Report, State
 from moderate_report import ModerateReport
-from claude import query, PROMPTS
-from perspective import get_perspective_scores
+from moderation_queue import ModerationQueue
+from report_views import ReportListView
+from classifier import Verdict
+from context_store import ContextStore
+from detection import TIERS, TierStats
+from pipeline import ClassificationPipeline, CLASSIFICATION_MODE, BATCH_MAX_MESSAGES, BATCH_MAX_DELAY, \
+    MAX_CONCURRENT_CLASSIFICATIONS, PERSPECTIVE_DEADLINE
+from work_queue import WorkQueue, message_from_payload
+from regex_rules import RuleEngine
+from fingerprint import FingerprintIndex
+from activity import ActivityTracker
+from config import ConfigFile, CONFIG_PATH
+from guild_registry import GuildRegistry
+from perspective import PerspectiveClient, PERSPECTIVE_QPS, GATEWAY_PERSPECTIVE_QPS
+from verdict_cache import VerdictCache
+from db_writer import DBWriter, connect
+from migrations import migrate
+from offenders import OffenderService, record_report
+from outbound import OutboundScheduler
+import metrics
 
 BOT_AUTHOR_ID = 0
-PERSPECTIVE_SCORE_THRESHOLD = 0.5
+# Messages being classified at once, waiting ones included. Past this, new messages skip the tiers after the
+# regex rules and fingerprints and are counted in modbot_classifications_dropped_total.
+MAX_PENDING_CLASSIFICATIONS = 200
+# Messages waiting on the Perspective quota at once, about what it serves within PERSPECTIVE_DEADLINE. Beyond
+# this a message skips the tier as if Perspective were down, instead of queueing up behind the quota.
+PERSPECTIVE_MAX_PENDING = 3
+# This process uses the whole Perspective quota (PERSPECTIVE_QPS) on its own, or GATEWAY_PERSPECTIVE_QPS of it
+# with --queue. Processes started with --shard-ids share the quota and must each be given their part with
+# --perspective-qps.
+# Verdicts cached by content hash so reposted text doesn't cost another API call
+VERDICT_CACHE_SIZE = 10000
+# Keep cached verdicts in modbot.db so the cache is warm after a restart
+PERSIST_VERDICT_CACHE = True
+# Offender profiles kept in memory; the rest are read from modbot.db when needed
+OFFENDER_CACHE_SIZE = 5000
+# Cached profiles are read again after this many seconds, to pick up reports filed by other bot processes
+OFFENDER_CACHE_MAX_AGE = 60
+# Prometheus metrics are served on http://METRICS_HOST:METRICS_PORT/metrics; None turns the endpoint off. A
+# process started with --shard-ids serves them on METRICS_PORT plus its first shard id, unless given --metrics-port.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+# Notices to the same mod channel within this many seconds are sent together as one message
+MOD_POST_COALESCE_DELAY = 1.0
+# Open an OpenTelemetry span per message (needs the opentelemetry package and an exporter set up)
+TRACE_MESSAGES = False
+CACHE_STATS_KEYWORD = "cache stats"
+TIER_STATS_KEYWORD = "tier stats"
+CONFIG_RELOAD_KEYWORD = "reload config"
+# How often config.json (thresholds, prompts, channel overrides) is checked for changes
+CONFIG_RELOAD_SECONDS = 5
+# Near-copies of one message posted by RAID_ACCOUNTS different accounts within RAID_WINDOW seconds raise a raid
+# alert in the mod channel
+RAID_WINDOW = 5 * 60
+RAID_ACCOUNTS = 8
+# How often per-user activity counters are written to the users table
+ACTIVITY_FLUSH_SECONDS = 60
+# Gateway shards: SHARD_COUNT None asks Discord how many to use, SHARD_IDS None runs all of them in this process.
+# Run one process per group of shards with --shard-count and --shard-ids to spread guilds across processes.
+SHARD_COUNT = None
+SHARD_IDS = None
+# Hand classification to a pool of classify_worker.py processes through the classify_jobs table instead of
+# running it on this process's event loop (--queue)
+CLASSIFY_IN_WORKERS = False
+# How often the gateway checks for finished classification jobs, and how many it acts on at a time
+RESULT_POLL_SECONDS = 0.1
+RESULT_BATCH_SIZE = 100
+# How often to check for a newly trained local model version (python local_model.py train)
+LOCAL_MODEL_RELOAD_SECONDS = 5 * 60
+# A moderator's claim on a report lapses back to the queue after this long without activity
+MODERATION_LEASE_SECONDS = 30 * 60
+# How often lapsed claims are put back in the queue, so listing and counting it stay plain reads
+MODERATION_LEASE_EXPIRY_SECONDS = 60
 
-# Set up logging to the console
 logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(
-    filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter(
-    '%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
 
-# There should be a file called 'tokens.json' inside the same folder as this file
-token_path = 'tokens.json'
-if not os.path.isfile(token_path):
-    raise Exception(f"{token_path} not found!")
-with open(token_path) as f:
-    tokens = json.load(f)
-    discord_token = tokens['discord']
-    perspective_token = tokens['perspective']
 CONTEXT_WINDOW_SIZE = 30
+# Conversations (guild, channel, thread) whose context windows are kept in memory at once
+MAX_CONTEXT_CONVERSATIONS = 500
+# Cap on the total characters held across all context windows
+MAX_CONTEXT_CHARS = 2_000_000
+
+# There should be a file called 'tokens.json' inside the same folder as this file
+TOKEN_PATH = 'tokens.json'
+DB_PATH = 'modbot.db'
+
+
+def setup_logging():
+    # Set up logging to the console
+    logger.setLevel(logging.DEBUG)
+    handler = logging.FileHandler(
+        filename='discord.log', encoding='utf-8', mode='w')
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+    logger.addHandler(handler)
+
+
+def load_tokens(token_path=TOKEN_PATH):
+    if not os.path.isfile(token_path):
+        raise Exception(f"{token_path} not found!")
+    with open(token_path) as f:
+        return json.load(f)
+
+
+def open_database(db_path=DB_PATH):
+    '''
+    Opens modbot.db and creates or upgrades the tables. This connection is for reads and setup; once the bot is
+    running every write goes through its DBWriter thread.
+    '''
+    conn = connect(db_path)
+    migrate(conn)
+    return conn
+
+
+class ModBot(discord.AutoShardedClient):
+    '''
+    Constructing the bot only opens the database; the regex rules, the local model and config.json are loaded by
+    load(), which setup_hook calls once the bot has logged in.
+    '''
 
-# Initialize SQLite database
-conn = sqlite3.connect('modbot.db')
-c = conn.cursor()
-
-# Create tables
-c.execute('''
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    age INTEGER,
-    num_friends INTEGER,
-    hours_logged REAL,
-    new_chats_last_day INTEGER,
-    num_reports INTEGER DEFAULT 0,
-    num_violations INTEGER DEFAULT 0,
-    severity INTEGER DEFAULT 0
-)
-''')
-
-c.execute('''
-CREATE TABLE IF NOT EXISTS reports (
-    report_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    reported_user_id INTEGER,
-    violation_type TEXT,
-    severity INTEGER,
-    status TEXT,
-    immediate_danger BOOLEAN DEFAULT FALSE,
-    permission_given BOOLEAN DEFAULT FALSE,
-    FOREIGN KEY (user_id) REFERENCES users (user_id),
-    FOREIGN KEY (reported_user_id) REFERENCES users (user_id)
-)
-''')
-
-c.execute('''
-CREATE TABLE IF NOT EXISTS moderations (
-    moderation_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    report_id INTEGER,
-    moderator_id INTEGER,
-    action_taken TEXT,
-    justification TEXT,
-    severity INTEGER,
-    FOREIGN KEY (report_id) REFERENCES reports (report_id)
-)
-''')
-
-c.execute('''
-CREATE TABLE IF NOT EXISTS regex_rules (
-    rule_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    guild_id INTEGER,
-    pattern TEXT,
-    FOREIGN KEY (guild_id) REFERENCES guilds (id)
-)
-''')
-
-conn.commit()
-
-class ModBot(discord.Client):
-    def __init__(self):
+    def __init__(self, perspective_token, db_path=DB_PATH, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS,
+                 classify_in_workers=CLASSIFY_IN_WORKERS, config_path=CONFIG_PATH, perspective_qps=None):
         intents = discord.Intents.default()
         intents.message_content = True
-        super().__init__(command_prefix='.', intents=intents)
+        super().__init__(command_prefix='.', intents=intents, shard_count=shard_count, shard_ids=shard_ids)
         self.group_num = None
-        self.mod_channels = {}  # Map from guild to the mod channel id for that guild
+        self.mod_channels = {}  # Map from guild id to its mod channel, resolved on first use
         self.reports = {}  # Map from user IDs to the state of their report
 
-        self.pending_moderation = PriorityQueue()
+        self.conn = open_database(db_path)
+        # Writes are batched into group commits on a background thread so the event loop never waits on disk
+        self.db = DBWriter(db_path)
+
+        # Mod and monitored channel ids per guild, kept up to date from guild and channel events
+        self.guild_registry = GuildRegistry(self.conn, self.db)
+        self.config = ConfigFile(config_path)
+        self.config_watcher = None
+
+        # Reports waiting for a moderator live in the reports table, so they survive restarts
+        self.pending_moderation = ModerationQueue(self.conn, self.db, self, MODERATION_LEASE_SECONDS)
         self.moderations = {}
+        self.lease_expirer = None
         self.context_window = CONTEXT_WINDOW_SIZE
-        self.messages = deque()  # List of tuples of user ids and conversations
-
-        # Maps from user ID to the number of offenses they have committed
-        self.num_offenses = collections.defaultdict(int)
+        # Per-conversation windows of (user id, content, message) tuples
+        self.messages = ContextStore(CONTEXT_WINDOW_SIZE, MAX_CONTEXT_CONVERSATIONS, MAX_CONTEXT_CHARS)
+
+        # Each channel message is classified in its own task so the event loop is never held up
+        self.classification_tasks = set()
+        self.classifications_dropped = 0
+        self.tier_stats = {tier: TierStats(tier) for tier in TIERS}
+
+        # Shared Perspective client; pools connections and keeps us within this process's part of the API quota
+        if perspective_qps is None:
+            perspective_qps = GATEWAY_PERSPECTIVE_QPS if classify_in_workers else PERSPECTIVE_QPS
+        self.perspective = PerspectiveClient(perspective_token, qps=perspective_qps,
+                                             max_pending=PERSPECTIVE_MAX_PENDING)
+
+        self.verdict_cache = VerdictCache(VERDICT_CACHE_SIZE, conn=self.conn if PERSIST_VERDICT_CACHE else None,
+                                          writer=self.db)
+
+        # The tiers after the regex rules and fingerprints, with this bot acting on their decisions. Also
+        # scores reported messages with Perspective during the report flow.
+        self.pipeline = ClassificationPipeline(
+            self, self.perspective, self.verdict_cache, self.tier_stats, None, CLASSIFICATION_MODE,
+            BATCH_MAX_MESSAGES, BATCH_MAX_DELAY, MAX_CONCURRENT_CLASSIFICATIONS, PERSPECTIVE_DEADLINE)
+        self.local_model_reloader = None
+
+        # With classify_in_workers, messages that get past the regex rules and fingerprints are queued for
+        # classify_worker.py and their results are picked up by deliver_results
+        self.classify_in_workers = classify_in_workers
+        self.work_queue = WorkQueue(self.conn, self.db)
+        self.result_poller = None
+
+        # Compiled regex rules per guild, kept in sync with the regex_rules table
+        self.rules = RuleEngine()
+
+        # Clusters of near-identical recent messages per guild, for catching spam raids without an API call
+        self.fingerprints = FingerprintIndex(RAID_WINDOW, RAID_ACCOUNTS)
+
+        # Message velocity, new contacts and active time per user, for flood detection and report severity
+        self.user_activity = ActivityTracker(self.db)
+        self.activity_flusher = None
+
+        # Offense history per user, backed by the users and reports tables
+        self.offenders = OffenderService(self.conn, OFFENDER_CACHE_SIZE, OFFENDER_CACHE_MAX_AGE)
+
+        # Deletions, DMs and mod channel notices go out through one rate-limited priority queue
+        self.outbound = OutboundScheduler(self, coalesce_delay=MOD_POST_COALESCE_DELAY)
+
+        self.metrics_server = metrics.MetricsServer(host=METRICS_HOST, port=METRICS_PORT) if METRICS_PORT else None
+        self.loop_lag_monitor = None
+        self.register_metrics()
+        if TRACE_MESSAGES:
+            metrics.enable_tracing()
+
+    def register_metrics(self):
+        # Values the bot already tracks elsewhere, read on every scrape
+        metrics.REGISTRY.gauge("modbot_moderation_queue_depth", "Reports waiting for a moderator",
+                               collect=lambda: {(): self.pending_moderation.qsize()})
+        metrics.REGISTRY.gauge("modbot_active_moderations", "Reports currently being moderated",
+                               collect=lambda: {(): len(self.moderations)})
+        metrics.REGISTRY.gauge("modbot_classifications_in_flight", "Messages being classified",
+                               collect=lambda: {(): len(self.classification_tasks)})
+        metrics.REGISTRY.counter("modbot_classifications_dropped_total",
+                                 "Messages not classified because MAX_PENDING_CLASSIFICATIONS were already pending "
+                                 "or (with --queue) their job could not be queued",
+                                 collect=lambda: {(): self.classifications_dropped})
+        metrics.REGISTRY.gauge("modbot_batched_messages", "Escalated messages waiting for their batch to flush",
+                               collect=lambda: {(): self.pipeline.pending()})
+        metrics.REGISTRY.gauge("modbot_classify_jobs", "Classification jobs in the work queue", ["status"],
+                               collect=lambda: {(status,): count for status, count in self.work_queue.counts().items()})
+        metrics.REGISTRY.gauge("modbot_db_write_queue_depth", "Write jobs waiting for the database writer",
+                               collect=lambda: {(): self.db.qsize()})
+        metrics.REGISTRY.gauge("modbot_outbound_queue_depth", "Discord actions waiting to be sent",
+                               collect=lambda: {(): self.outbound.qsize()})
+        metrics.REGISTRY.gauge("modbot_fingerprint_clusters", "Clusters of near-identical recent messages",
+                               collect=lambda: {(): len(self.fingerprints)})
+        metrics.REGISTRY.gauge("modbot_tracked_users", "Users with activity counters in memory",
+                               collect=lambda: {(): len(self.user_activity)})
+        metrics.REGISTRY.gauge("modbot_context_conversations", "Conversations with a context window in memory",
+                               collect=lambda: {(): len(self.messages)})
+        metrics.REGISTRY.counter("modbot_tier_decisions_total", "Decisions made by each detection tier",
+                                 ["tier", "outcome"],
+                                 collect=lambda: {(tier, outcome): count for tier in TIERS
+                                                  for outcome, count in self.tier_stats[tier].outcomes.items()})
+        metrics.REGISTRY.counter("modbot_cache_lookups_total", "Verdict cache lookups", ["namespace", "result"],
+                                 collect=lambda: {(namespace, result): counts[result]
+                                                  for namespace, counts in self.verdict_cache.stats().items()
+                                                  for result in ("hits", "misses", "coalesced")})
+        metrics.REGISTRY.counter("modbot_offender_cache_lookups_total", "Offender profile lookups", ["result"],
+                                 collect=lambda: {("hits",): self.offenders.hits, ("misses",): self.offenders.misses})
+
+    def load(self):
+        self.rules.load(self.conn.cursor())
+        if self.pipeline.reload_local_model(self.conn):
+            print(f"Loaded local model version {self.pipeline.local_model.version}")
+        self.reload_config()
+
+    def set_group_num(self, bot_name):
+        match = re.search('[gG]roup (\d+) [bB]ot', bot_name)
+        if match:
+            self.group_num = match.group(1)
+        else:
+            raise Exception(
+                "Group number not found in bot's name. Name format should be \"Group # Bot\".")
+        self.guild_registry.set_names(f'group-{self.group_num}-mod', f'group-{self.group_num}')
+
+    async def setup_hook(self):
+        # Runs after login, before the gateway connects, so every guild event below sees the group's channel names
+        self.set_group_num(self.user.name)
+        self.load()
+        self.config_watcher = asyncio.create_task(self.watch_config())
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        self.loop_lag_monitor = asyncio.create_task(metrics.monitor_loop_lag())
+        self.activity_flusher = asyncio.create_task(self.flush_activity())
+        self.lease_expirer = asyncio.create_task(self.expire_moderation_leases())
+        self.local_model_reloader = asyncio.create_task(self.reload_local_model())
+        if self.classify_in_workers:
+            self.result_poller = asyncio.create_task(self.deliver_results())
+
+    async def flush_activity(self):
+        while True:
+            await asyncio.sleep(ACTIVITY_FLUSH_SECONDS)
+            self.user_activity.flush()
+
+    async def expire_moderation_leases(self):
+        while True:
+            await asyncio.sleep(MODERATION_LEASE_EXPIRY_SECONDS)
+            try:
+                await self.pending_moderation.expire_leases()
+            except Exception:
+                logger.exception("Expiring moderation leases failed")
+
+    async def reload_local_model(self):
+        while True:
+            await asyncio.sleep(LOCAL_MODEL_RELOAD_SECONDS)
+            self.pipeline.reload_local_model(self.conn)
+
+    async def watch_config(self):
+        while True:
+            await asyncio.sleep(CONFIG_RELOAD_SECONDS)
+            self.reload_config()
+
+    def reload_config(self):
+        if not self.config.reload_if_changed():
+            return False
+        self.guild_registry.set_overrides(self.config.guilds)
+        return True
+
+    def owned_shards(self):
+        return list(self.shard_ids) if self.shard_ids is not None else list(range(self.shard_count or 1))
+
+    def shard_of(self, guild_id):
+        return (guild_id >> 22) % (self.shard_count or 1)
+
+    async def deliver_results(self):
+        '''
+        Acts on the decisions classify_worker.py made about messages in this process's guilds.
+        '''
+        while True:
+            shards = self.owned_shards()
+            if not self.work_queue.has_results(shards):
+                await asyncio.sleep(RESULT_POLL_SECONDS)
+                continue
+            for payload, actions in await self.work_queue.take_results(shards, RESULT_BATCH_SIZE):
+                try:
+                    await self.apply_result(payload, actions)
+                except Exception:
+                    logger.exception("Acting on the classification of message %s failed", payload["id"])
+
+    async def apply_result(self, payload, actions):
+        channel = self.get_channel(payload["channel_id"]) or self.get_partial_messageable(
+            payload["channel_id"], guild_id=payload["guild_id"])
+        message, _ = message_from_payload(payload, channel)
+        message.delete = channel.get_partial_message(message.id).delete
+        for action in actions:
+            if action["action"] == "block":
+                await self.block_message(message, action["notice"], action["violation"])
+            elif action["action"] == "report":
+                await self.report_message(message, Verdict.from_dict(action["verdict"]))
+            else:
+                await self.forward_message(message, action["notice"])
+
+    async def close(self):
+        if self.config_watcher is not None:
+            self.config_watcher.cancel()
+        if self.loop_lag_monitor is not None:
+            self.loop_lag_monitor.cancel()
+        if self.activity_flusher is not None:
+            self.activity_flusher.cancel()
+        if self.lease_expirer is not None:
+            self.lease_expirer.cancel()
+        if self.local_model_reloader is not None:
+            self.local_model_reloader.cancel()
+        if self.result_poller is not None:
+            self.result_poller.cancel()
+        self.user_activity.flush()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        await self.outbound.close()
+        await self.perspective.close()
+        await super().close()
+        self.db.close()
 
     async def on_ready(self):
         print(f'{self.user.name} has connected to Discord! It is these guilds:')
@@ -115,17 +362,43 @@ class ModBot(discord.Client):
             print(f' - {guild.name}')
         print('Press Ctrl-C to quit.')
 
-        match = re.search('[gG]roup (\d+) [bB]ot', self.user.name)
-        if match:
-            self.group_num = match.group(1)
-        else:
-            raise Exception(
-                "Group number not found in bot's name. Name format should be \"Group # Bot\".")
+    # Each guild's channels are looked up once as it becomes available, then followed through channel events
+    async def on_guild_available(self, guild):
+        self.guild_registry.scan_guild(guild)
 
-        for guild in self.guilds:
-            for channel in guild.text_channels:
-                if channel.name == f'group-{self.group_num}-mod':
-                    self.mod_channels[guild.id] = channel
+    async def on_guild_join(self, guild):
+        self.guild_registry.scan_guild(guild)
+
+    async def on_guild_remove(self, guild):
+        self.guild_registry.remove_guild(guild.id)
+        self.mod_channels.pop(guild.id, None)
+
+    async def on_guild_channel_create(self, channel):
+        if isinstance(channel, discord.TextChannel):
+            self.guild_registry.add_channel(channel)
+
+    async def on_guild_channel_delete(self, channel):
+        self.guild_registry.remove_channel(channel)
+
+    async def on_guild_channel_update(self, before, after):
+        if isinstance(after, discord.TextChannel):
+            self.guild_registry.rename_channel(before, after)
+
+    def mod_channel(self, guild_id):
+        '''
+        The guild's mod channel. A guild on another process's shards is looked up in the guild_channels table.
+        '''
+        channel_id = self.guild_registry.mod_channel_id(guild_id)
+        if channel_id is None:
+            raise KeyError(f"No mod channel known for guild {guild_id}")
+        channel = self.mod_channels.get(guild_id)
+        if channel is None or channel.id != channel_id:
+            guild = self.get_guild(guild_id)
+            channel = guild.get_channel(channel_id) if guild is not None else None
+            if channel is None:
+                channel = self.get_partial_messageable(channel_id, guild_id=guild_id)
+            self.mod_channels[guild_id] = channel
+        return channel
 
     async def on_message(self, message):
         '''
@@ -136,10 +409,11 @@ class ModBot(discord.Client):
         if message.author.id == self.user.id:
             return
 
-        if message.guild:
-            await self.handle_channel_message(message)
-        else:
-            await self.handle_dm(message)
+        with metrics.span("on_message", message_id=message.id), metrics.timed("on_message"):
+            if message.guild:
+                await self.handle_channel_message(message)
+            else:
+                await self.handle_dm(message)
 
     async def handle_dm(self, message):
         if message.content == Report.HELP_KEYWORD:
@@ -175,53 +449,85 @@ class ModBot(discord.Client):
         if report.report_complete():
             # If it wasn't canceled then the report need to be moderated
             if not report.report_canceled():
-                self.pending_moderation.put(
-                    (report.calculate_report_severity() * - 1, report))
+                # Saving the report to the database puts it in the moderation queue
+                report_id = await self.save_report_to_db(message.author.id, report)
+                report.report_id = report_id  # Assign the generated report_id to the report
 
                 response = f"There's a new report from {message.author.name}!\n"
                 response += f"There are {self.pending_moderation.qsize()} report(s) in the queue.\n\n"
                 response += "Type \"show reports\" to see them or \"moderate\" to start moderating. \n\n\n"
 
-                await self.mod_channels[report.get_guild_id()].send(response)
-
-                self.num_offenses[report.reported_message.author.id] += 1
-
-                # Save the report details to the database
-                report_id = self.save_report_to_db(message.author.id, report)
-                report.report_id = report_id  # Assign the generated report_id to the report
+                self.outbound.post(self.mod_channel(report.get_guild_id()), response)
 
             self.reports.pop(author_id)
 
     async def handle_channel_message(self, message):
-        if message.channel.name == f'group-{self.group_num}-mod':
+        channels = self.guild_registry.get(message.guild.id)
+        if channels is None:
+            return
+
+        if message.channel.id == channels.mod_channel_id:
             regex_command = await self.parse_for_regex_commands(message)
             if regex_command:
                 return
             author_id = message.author.id
 
+            if message.content == CACHE_STATS_KEYWORD:
+                await message.channel.send(self.format_cache_stats())
+                return
+
+            if message.content == TIER_STATS_KEYWORD:
+                await message.channel.send("\n".join(self.tier_stats[tier].summary() for tier in TIERS))
+                return
+
+            if message.content == CONFIG_RELOAD_KEYWORD:
+                if self.reload_config():
+                    await message.channel.send(f"Applied the settings in {self.config.path}.")
+                else:
+                    await message.channel.send(f"No new settings applied; {self.config.path} is unchanged or "
+                                               f"invalid (see discord.log).")
+                return
+
             if self.pending_moderation.empty() and author_id not in self.moderations:
                 await message.channel.send("No reports to moderate! Rest easy :)")
                 return
 
             if message.content == ModerateReport.SHOW_REPORTS_KEYWORD:
-                for index, tup in enumerate(list(self.pending_moderation.queue)):
-                    _, report = tup
-                    await message.channel.send(f"{index + 1}. {report.compile_summary()}")
-                response = f"There are {self.pending_moderation.qsize()} report(s) in the queue.\n\n"
-                response += "Type \"show reports\" to see them or \"moderate\" to start moderating. \n\n\n"
-                await message.channel.send(response)
+                # One paginated message, however long the queue is
+                view = ReportListView(self.pending_moderation, self.pending_moderation.list_open())
+                await message.channel.send(embed=view.render(), view=view)
                 return
 
             if author_id not in self.moderations and not message.content.startswith(ModerateReport.START_KEYWORD):
                 return
 
+            if author_id in self.moderations and message.content == ModerateReport.CANCEL_KEYWORD:
+                # Give the report back now rather than leaving it locked until the lease runs out
+                report = self.moderations.pop(author_id).report
+                await self.pending_moderation.release(report.report_id, author_id)
+                await message.channel.send("The report went back to the queue.")
+                return
+
+            if author_id in self.moderations:
+                # Keep the claim alive; if it lapsed, someone else may already be moderating this report
+                report = self.moderations[author_id].report
+                if not await self.pending_moderation.renew(report.report_id, author_id):
+                    self.moderations.pop(author_id)
+                    await message.channel.send("Your claim on that report expired and it went back to the queue. "
+                                               "Type \"moderate\" to pick up the next report.")
+                    return
+
             if author_id not in self.moderations:
-                # Pop a report from the queue in order of severity
-                report = self.pending_moderation.get()[1]
+                # Claim the most severe report in the queue
+                report = await self.pending_moderation.claim(author_id)
+                if report is None:
+                    await message.channel.send("No reports to moderate! Rest easy :)")
+                    return
                 # Assign the moderator
                 self.moderations[author_id] = ModerateReport(self, report, message.author)
 
-            responses = await self.moderations[author_id].handle_message(message, self.num_offenses[self.moderations[author_id].report.reported_message.author.id])
+            offender = self.offenders.get(self.moderations[author_id].report.reported_message.author.id)
+            responses = await self.moderations[author_id].handle_message(message, offender)
             for r in responses:
                 if isinstance(r, str):
                     await message.channel.send(r)
@@ -232,285 +538,251 @@ class ModBot(discord.Client):
 
             if self.moderations[author_id].moderate_complete():
                 await message.channel.send(f"There are {self.pending_moderation.qsize()} report(s) remaining.")
-                self.save_moderation_to_db(self.moderations[author_id])
+                await self.save_moderation_to_db(self.moderations[author_id])
                 self.moderations.pop(author_id)
             return
 
-        if not message.channel.name == f'group-{self.group_num}':
+        # Threads are monitored along with the channel they were started in
+        channel_id = message.channel.parent_id if isinstance(message.channel, discord.Thread) else message.channel.id
+        if channel_id not in channels.monitored_channel_ids:
             return
 
-        if len(self.messages) == CONTEXT_WINDOW_SIZE:
-            self.messages.popleft()
-        self.messages.append((message.author.id, message.content, message))
-
-        guild_id = message.guild.id
-        c.execute('SELECT pattern FROM regex_rules WHERE guild_id = ?', (guild_id,))
-        rules = c.fetchall()
-        for rule in rules:
-            pattern = rule[0]
-            if re.search(pattern, message.content):
-                await message.delete()
-                mod_channel = self.mod_channels[message.guild.id]
-                await mod_channel.send(f'Message from {message.author.name} deleted: "{message.content}" matched rule "{pattern}"')
-                return
+        # Only this conversation's recent messages are sent to the classifier
+        context = self.messages.add(message)
+
+        flood = self.user_activity.record(message.author.id, message.channel.id, self.contacts_of(message))
+        if flood is not None:
+            self.outbound.post(self.mod_channel(message.guild.id),
+                               f'{message.author.name} is flooding the server: {flood}. Latest message: "{message.content}"')
+
+        started = time.perf_counter()
+        pattern = self.rules.match(message.guild.id, message.content)
+        self.tier_stats["regex"].record("block" if pattern is not None else "pass", started)
+        if pattern is not None:
+            self.outbound.delete(message)
+            mod_channel = self.mod_channel(message.guild.id)
+            self.outbound.post(mod_channel, f'Message from {message.author.name} deleted: "{message.content}" matched rule "{pattern}"')
+            return
 
-        mod_channel = self.mod_channels[message.guild.id]
-        scores = self.eval_text(self.messages)
-
-        if scores == "NO VIOLATION":
-            perspective_scores = get_perspective_scores(message.content)
-            perspective_violation = True in [
-                ele > PERSPECTIVE_SCORE_THRESHOLD for ele in list(perspective_scores.values())]
-            if perspective_scores is not None and perspective_violation:
-                await message.delete()
-                mod_channel = self.mod_channels[message.guild.id]
-                formatted_scores = "\n".join(
-                    [f"{attribute}: {score:.2f}" for attribute, score in perspective_scores.items()])
-                await mod_channel.send(
-                    f'Message from:\n'
-                    f'{message.author.name}: "{message.content}"\n\n'
-                    f'Perspective scores:\n'
-                    f'{formatted_scores}\n\n'
-                    f'This message has been deleted and the user should be reviewed.'
-                )
-                return
+        started = time.perf_counter()
+        cluster = self.fingerprints.add(message.guild.id, message.author.id, message.content)
+        if cluster is not None and self.fingerprints.raid_alert_due(cluster):
+            self.outbound.post(
+                self.mod_channel(message.guild.id),
+                f'Possible raid: {len(cluster.members)} near-identical messages from {cluster.accounts()} accounts '
+                f'in the last {RAID_WINDOW // 60} minutes, like this one from {message.author.name}:\n"{message.content}"'
+            )
+        if cluster is not None and cluster.violation is not None:
+            self.tier_stats["fingerprint"].record("block", started)
+            self.outbound.delete(message)
+            self.outbound.post(
+                self.mod_channel(message.guild.id),
+                f'Message from {message.author.name} deleted: "{message.content}" is a near-copy of a message '
+                f'already found to be {cluster.violation}'
+            )
+            return
+        self.tier_stats["fingerprint"].record("pass", started)
+
+        if self.classify_in_workers:
+            try:
+                await self.work_queue.put(self.shard_of(message.guild.id), message, context)
+            except Exception:
+                self.classifications_dropped += 1
+                logger.exception("Queueing message %s for classification failed", message.id)
             return
 
-        await mod_channel.send(f'Forwarded message:\n{message.author.name}: "{message.content}"')
+        if len(self.classification_tasks) >= MAX_PENDING_CLASSIFICATIONS:
+            self.classifications_dropped += 1
+            return
+
+        task = asyncio.create_task(self.classify_message(message, context))
+        self.classification_tasks.add(task)
+        task.add_done_callback(self.on_classification_done)
+
+    def on_classification_done(self, task):
+        self.classification_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Classification failed", exc_info=task.exception())
+
+    async def classify_message(self, message, messages):
+        await self.pipeline.classify(message, messages)
+
+    async def block_message(self, message, notice, violation):
+        self.fingerprints.mark_violation(message.guild.id, message.content, violation)
+        self.outbound.delete(message)
+        self.outbound.post(self.mod_channel(message.guild.id), notice)
+
+    async def report_message(self, message, verdict):
+        await self.report_violation(message, verdict)
+        self.outbound.post(self.mod_channel(message.guild.id),
+                           f'Forwarded message:\n{message.author.name}: "{message.content}"')
+
+    async def forward_message(self, message, notice):
+        self.outbound.post(self.mod_channel(message.guild.id), notice)
+
+    async def score_perspective(self, text):
+        return await self.pipeline.score_perspective(text)
+
+    def format_cache_stats(self):
+        lines = [f"Verdict cache: {len(self.verdict_cache)} entries"]
+        for namespace, counts in self.verdict_cache.stats().items():
+            lookups = counts["hits"] + counts["misses"]
+            hit_rate = counts["hits"] / lookups if lookups else 0
+            lines.append(f"- {namespace}: {counts['hits']} hits, {counts['misses']} misses "
+                         f"({counts['coalesced']} shared an in-flight call), hit rate {hit_rate:.0%}")
+        lookups = self.offenders.hits + self.offenders.misses
+        lines.append(f"Offender profiles: {len(self.offenders)} cached, {self.offenders.hits} hits, "
+                     f"{self.offenders.misses} misses, hit rate {self.offenders.hits / lookups if lookups else 0:.0%}")
+        return "\n".join(lines)
 
     async def parse_for_regex_commands(self, message):
         if message.content.startswith("add_regex "):
             pattern = message.content[len("add_regex "):].strip()
-            c.execute('''
-            INSERT INTO regex_rules (guild_id, pattern)
-            VALUES (?, ?)
-            ''', (message.guild.id, pattern))
-            conn.commit()
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                await message.channel.send(f'Regex rule "{pattern}" is not a valid regular expression: {e}')
+                return True
+            await self.db.run(lambda db: db.execute('''
+            INSERT INTO regex_rules (guild_id, pattern, created_at)
+            VALUES (?, ?, ?)
+            ''', (message.guild.id, pattern, time.time())))
+            self.rules.reload_guild(self.conn.cursor(), message.guild.id)
             await message.channel.send(f'Regex rule "{pattern}" added successfully.')
             return True
 
         elif message.content.startswith("remove_regex "):
             pattern = message.content[len("remove_regex "):].strip()
-            c.execute('''
+            await self.db.run(lambda db: db.execute('''
             DELETE FROM regex_rules
             WHERE guild_id = ? AND pattern = ?
-            ''', (message.guild.id, pattern))
-            conn.commit()
+            ''', (message.guild.id, pattern)))
+            self.rules.reload_guild(self.conn.cursor(), message.guild.id)
             await message.channel.send(f'Regex rule "{pattern}" removed successfully.')
             return True
         return False
 
-    def eval_text(self, messages):
-        ''''
-        TODO: Once you know how you want to evaluate messages in your channel, 
-        insert your code here! This will primarily be used in Milestone 3. 
+    async def report_violation(self, message, verdict):
         '''
-        # The following executes our user reporting flow with automated detection and sends it to the mod channel
-        conversation = ""
-        for message in messages:
-            user_id , message = message[0], message[1]
-            conversation += f"User #{user_id}: {message}"
-
-        violation = query(conversation=PROMPTS["system_message"].format(content_policy=PROMPTS["content_policy"],
-                                                                        instructions=PROMPTS["instructions"].format(conversation=conversation)), assistant_completion="")
-        if "NO_VIOLATION" in violation:
-            print("NO VIOLATION")
-            return "NO VIOLATION"
-
+        Queues a report from the MOD_BOT for a message the classifier found in violation.
+        '''
+        # A verdict about the whole conversation doesn't say this message is the violating one, so only verdicts
+        # about the message itself make its near-copies deletable
+        if verdict.per_message:
+            self.fingerprints.mark_violation(message.guild.id, message.content,
+                                             verdict.specific_abuse_type or "a violation")
         author = SimpleNamespace(**{"name": "MOD_BOT", "id": BOT_AUTHOR_ID})
-        
-        # If we don't currently have an active report for this user, add one
-        if BOT_AUTHOR_ID not in self.reports:
-            # TODO: Check if this is how you get the author's name
-            self.reports[BOT_AUTHOR_ID] = Report(self, author)
-
-        report = self.reports[BOT_AUTHOR_ID]
-        
-        first_question = "Which of these violations does this conversation violate: SPAM, EXPLICIT_CONTENT, THREAT, or HARASSMENT? Please say one and only one violation, and nothing more."
-        first_assistant_completion = "VIOLATION TYPE:"
-        first_answer = query(conversation=PROMPTS["gen_system_message"].format(conversation=conversation, question=first_question),
-                             assistant_completion=first_assistant_completion)
-
-        cot_question = f"Previously, you have indicated that this violation is of type {first_answer}. Please provide a reason as to why you flagged it as such. Indicate this reason like so: Reason:"
-
-        cot_answer = query(conversation=PROMPTS["gen_system_message"].format(conversation=conversation, question=cot_question))
-        print(cot_answer)
-        
-        if "SPAM" in first_answer:
-            broad_abuse = BroadAbuseType.SPAM
-        elif "EXPLICIT_CONTENT" in first_answer:
-            broad_abuse = BroadAbuseType.EXPLICIT_CONTENT
-        elif "THREAT" in first_answer:
-            broad_abuse = BroadAbuseType.THREAT
-        elif "HARASSMENT" in first_answer:
-            broad_abuse = BroadAbuseType.HARASSMENT
-
-         
-        suffix = "Please say one and only one type. You must choose a type."
-        second_assistant_completion = "TYPE:("
-        if "SPAM" in first_answer:
-            second_question = f"Which type of spam is the conversation: SCAM, BOTMESSAGES, SOLICITING, IMPERSONATION, or MISINFORMATION? {suffix}"
-        elif "EXPLICIT" in first_answer:
-            second_question = f"Which type of explicit content is the conversation: SEXUAL_CONTENT, VIOLENCE, CHILD_GROOMING, or HATE_SPEECH? Please note that while CHILD_GROOMING is often SEXUAL_CONTENT, CHILD_GROOMING is a more severe instance of SEXUAL_CONTENT, so prioritize reporting CHILD_GROOMING in cases where there are both. {suffix}"
-        elif "THREAT" in first_answer:
-            second_question = f"Which type of threat is it: SELF_HARM, TERRORIST_PROPAGANDA, or DOXXING? {suffix}"
-        elif "HARASSMENT" in first_answer:
-            second_question = f"Which type of harrassment is it: BULLYING, SEXUAL, CONTINUOUS_CONTACT, or CHILD_GROOMING? {suffix}"
-        else:
-            raise Exception("Failure to pick from options")
-        
-        second_answer = query(conversation=PROMPTS["gen_system_message"].format(conversation=conversation, question=second_question), 
-                             assistant_completion=second_assistant_completion)
-        print(second_answer)
-    
-        if "SCAM" in second_answer:
-            abuse_type = SpecificAbuseType.SCAM
-        elif "BOT" in second_answer:
-            abuse_type = SpecificAbuseType.BOTMESSAGES
-        elif "SOLICIT" in second_answer:
-            abuse_type = SpecificAbuseType.SOLICITATION
-        elif "IMPERSON" in second_answer:
-            abuse_type = SpecificAbuseType.IMPERSONATION
-        elif "MISINFOR" in second_answer:
-            abuse_type = SpecificAbuseType.MISINFORMATION
-        elif "SEXUAL_CONT" in second_answer:
-            abuse_type = SpecificAbuseType.SEXUAL_CONTENT
-        elif "VIOLENCE" in second_answer:
-            abuse_type = SpecificAbuseType.VIOLENCE
-        elif "HATE" in second_answer:
-            abuse_type = SpecificAbuseType.HATE_SPEECH
-        elif "SELF_HARM" in second_answer:
-            abuse_type = SpecificAbuseType.SELF_HARM
-        elif "TERRORIST" in second_answer:
-            abuse_type = SpecificAbuseType.TERRORIST_PROPAGANDA
-        elif "DOXX" in second_answer:
-            abuse_type = SpecificAbuseType.DOXXING
-        elif "BULLY" in second_answer:
-            abuse_type = SpecificAbuseType.BULLYING
-        elif "SEXUAL" in second_answer:
-            abuse_type = SpecificAbuseType.SEXUAL
-        elif "CONTINOUS" in second_answer:
-            abuse_type = SpecificAbuseType.CONTINUOUS_CONTACT
-        elif "GROOMING" in second_answer:
-            abuse_type = SpecificAbuseType.GROOMING
-        else:
-            raise Exception("Failure to pick from options")
-        
-        third_question = f"Based on the conversation, is there an immediate and direct danger to someone's safety? Please just answer either YES or NO."
-        third_answer = query(conversation=PROMPTS["gen_system_message"].format(conversation=conversation, question=third_question))
-
-        signals = []
-        if abuse_type == SpecificAbuseType.GROOMING:
-            child_grooming_info = []
-            suffix = "Please just answer either YES, NO, or UNCLEAR."
-            assistant_comp = "Answer:("
-
-            first_grooming_question = f"Considering the conversation, have pictures been exchanged in the conversation? {suffix}"
-            first_grooming_answer = query(conversation=PROMPTS["gen_system_message"].format(conversation=conversation, question=first_grooming_question),
-                                          assistant_completion=assistant_comp)
-            child_grooming_info.append((first_grooming_answer, "pictures_exchanged"))
-
-            second_grooming_question = f"Considering the conversation, have the people in the conversation met in real life? {suffix}"
-            second_grooming_answer = query(conversation=PROMPTS["gen_system_message"].format(conversation=conversation, question=second_grooming_question),
-                                           assistant_completion=assistant_comp)
-            child_grooming_info.append((second_grooming_answer, "met_in_real_life"))
-
-            third_grooming_question = f"Considering the conversation, has one user asked another user personal questions? {suffix}"
-            third_grooming_answer = query(conversation=PROMPTS["gen_system_message"].format(conversation=conversation, question=third_grooming_question),
-                                          assistant_completion=assistant_comp)
-            child_grooming_info.append((third_grooming_answer, "personal_questions_asked"))
-
-            fourth_grooming_question = f"Is the conversation severe enough to the point where one user should be notified that they are being groomed? {suffix}"
-            fourth_grooming_answer = query(conversation=PROMPTS["gen_system_message"].format(conversation=conversation, question=fourth_grooming_question),
-                                           assistant_completion=assistant_comp)
-            child_grooming_info.append(fourth_grooming_answer)
-
-            for (answer, indicator, _) in child_grooming_info:
-                if "Y" in answer:
-                    signals.append(indicator)
+
+        # Classifications run concurrently, so every automated report gets its own Report object
+        report = Report(self, author)
 
         # Populate the fields of the report to send to the mod channel
-        report.guild_id = messages[-1][2].guild.id
+        report.guild_id = message.guild.id
 
-        report.reported_message = self.messages[-1][2]
-        report.abuse_type = broad_abuse
-        report.specific_abuse_type = abuse_type
-        
-        report.child_grooming_info = signals
-        report.danger_indicated = "Y" in third_answer
+        report.reported_message = message
+        report.abuse_type = verdict.abuse_type
+        report.specific_abuse_type = verdict.specific_abuse_type
+
+        report.child_grooming_info = verdict.child_grooming_info
+        report.danger_indicated = verdict.danger_indicated
 
         report.permission_given = False
-        report.specific_abuse_type = abuse_type
         report.state = State.REPORT_COMPLETE
 
-        self.pending_moderation.put((report.calculate_report_severity() * - 1, report))
-
-
-        response = f"There's a new report from the MOD_BOT!\n"
-        response += f"There are {self.pending_moderation.qsize()} report(s) in the queue.\n\n"
-        response += "Type \"show reports\" to see them or \"moderate\" to start moderating. \n\n\n"
-
-        return response
-
-
+        report.report_id = await self.save_report_to_db(BOT_AUTHOR_ID, report)
 
     def code_format(self, text):
         return text
 
-    def save_report_to_db(self, user_id, report):
-        c.execute('''
-        INSERT OR IGNORE INTO users (user_id, age, num_friends, hours_logged, new_chats_last_day, num_reports, num_violations, severity)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, None, None, None, None, 0, 0, 0))
-
-        c.execute('''
-        INSERT OR IGNORE INTO users (user_id, age, num_friends, hours_logged, new_chats_last_day, num_reports, num_violations, severity)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (report.reported_message.author.id, None, None, None, None, 0, 0, 0))
-
-        c.execute('''
-        UPDATE users
-        SET num_reports = num_reports + 1
-        WHERE user_id = ?
-        ''', (user_id,))
-
-        c.execute('''
-        UPDATE users
-        SET num_violations = num_violations + 1
-        WHERE user_id = ?
-        ''', (report.reported_message.author.id,))
-
-        c.execute('''
-        UPDATE users
-        SET severity = COALESCE(severity, 0) + ?
-        WHERE user_id = ?
-        ''', (report.calculate_report_severity(), report.reported_message.author.id))
-
-        c.execute('''
-        INSERT INTO reports (user_id, reported_user_id, violation_type, severity, status, immediate_danger, permission_given)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, report.reported_message.author.id, report.specific_abuse_type, report.calculate_report_severity(), "OPEN", report.danger_indicated, report.permission_given))
-
-        report_id = c.lastrowid
-
-        conn.commit()
+    def contacts_of(self, message):
+        '''
+        The users a message is addressed to: everyone it mentions and the author of the message it replies to.
+        '''
+        contacts = [user.id for user in getattr(message, "mentions", ()) if not user.bot]
+        reference = getattr(message, "reference", None)
+        if reference is not None and isinstance(reference.resolved, discord.Message):
+            contacts.append(reference.resolved.author.id)
+        return contacts
 
+    async def save_report_to_db(self, user_id, report):
+        '''
+        Files the report and updates both users' counters in one write job; returns the new report_id.
+        The reported user's previous violations and recent flooding or mass contacting weigh into the severity.
+        '''
+        reported_user_id = report.reported_message.author.id
+        report.report_severity_multiplier *= self.offenders.get(reported_user_id).severity_weight()
+        report.report_severity_multiplier *= self.user_activity.severity_weight(reported_user_id)
+        severity = report.calculate_report_severity()
+        now = time.time()
+        row = (user_id, reported_user_id, report.specific_abuse_type, severity, "OPEN", report.danger_indicated, report.permission_given,
+               now, report.guild_id, report.author.name, report.reported_message.author.name, report.reported_message.content, report.abuse_type,
+               json.dumps(list(report.child_grooming_info)), report.report_severity_multiplier)
+
+        def save(db):
+            record_report(db, user_id, reported_user_id, severity, now)
+
+            return db.execute('''
+            INSERT INTO reports (user_id, reported_user_id, violation_type, severity, status, immediate_danger, permission_given,
+                                 created_at, guild_id, reporter_name, reported_user_name, reported_content, abuse_type,
+                                 child_grooming_info, severity_multiplier)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', row).lastrowid
+
+        with metrics.timed("db_save_report"):
+            report_id = await self.db.run(save)
+        self.offenders.record_violation(reported_user_id, report_id, str(report.specific_abuse_type), severity, now)
         return report_id
 
-    def save_moderation_to_db(self, moderation):
-        c.execute('''
-        INSERT INTO moderations (report_id, moderator_id, action_taken, justification, severity)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (moderation.report.report_id, moderation.moderator.id, ' '.join(moderation.selected_actions), moderation.moderation_reasons, moderation.report.calculate_report_severity()))
-
-        c.execute('''
-        UPDATE reports
-        SET status = 'CLOSED'
-        WHERE report_id = ?
-        ''', (moderation.report.report_id,))
-
-        conn.commit()
-
-
-client = ModBot()
-client.run(discord_token)
+    async def save_moderation_to_db(self, moderation):
+        report_id = moderation.report.report_id
+        row = (report_id, moderation.moderator.id, ' '.join(moderation.selected_actions), moderation.moderation_reasons, moderation.report.calculate_report_severity(), time.time())
+
+        def save(db):
+            db.execute('''
+            INSERT INTO moderations (report_id, moderator_id, action_taken, justification, severity, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', row)
+
+            db.execute('''
+            UPDATE reports
+            SET status = 'CLOSED', claimed_by = NULL, lease_expires_at = NULL
+            WHERE report_id = ?
+            ''', (report_id,))
+
+        with metrics.timed("db_save_moderation"):
+            await self.db.run(save)
+
+
+def main():
+    global METRICS_PORT
+    parser = argparse.ArgumentParser(description="Run the moderation bot.")
+    parser.add_argument("--shard-count", type=int, default=SHARD_COUNT, help="total shards across all processes")
+    parser.add_argument("--shard-ids", help="comma-separated shards to run in this process (default: all)")
+    parser.add_argument("--queue", action="store_true", default=CLASSIFY_IN_WORKERS,
+                        help="leave classification to classify_worker.py processes")
+    parser.add_argument("--metrics-port", type=int,
+                        help=f"0 turns the endpoint off (default: {METRICS_PORT}, plus the first shard id with --shard-ids)")
+    parser.add_argument("--perspective-qps", type=float,
+                        help="this process's part of the Perspective quota; needed with --shard-ids")
+    args = parser.parse_args()
+    shard_ids = [int(shard) for shard in args.shard_ids.split(",")] if args.shard_ids else SHARD_IDS
+    if shard_ids is not None and args.shard_count is None:
+        parser.error("--shard-ids needs --shard-count")
+    if shard_ids is not None and args.perspective_qps is None:
+        parser.error("--shard-ids needs --perspective-qps, since every process shares the Perspective quota")
+    if args.metrics_port is not None:
+        METRICS_PORT = args.metrics_port
+    elif shard_ids is not None and METRICS_PORT:
+        # One port per process, as long as no two processes run the same shard
+        METRICS_PORT += min(shard_ids)
+
+    # Nothing is read or opened until the bot is actually started
+    setup_logging()
+    tokens = load_tokens()
+    client = ModBot(tokens['perspective'], DB_PATH, args.shard_count, shard_ids, args.queue,
+                    perspective_qps=args.perspective_qps)
+    client.run(tokens['discord'])
+
+
+if __name__ == "__main__":
+    main()
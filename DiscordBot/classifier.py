@@ -0,0 +1,473 @@
+import asyncio
+import logging
+import time
+from report import BroadAbuseType, SpecificAbuseType
+from claude import async_query, async_query_tool, track_usage, PROMPTS, TRIAGE_MODEL, ESCALATION_MODEL
+import metrics
+from prompt_builder import PromptBuilder
+
+logger = logging.getLogger('discord')
+
+# "structured" asks for every field in a single tool-use call, "cascade" asks one question per round trip
+CLASSIFICATION_MODES = ("structured", "cascade")
+
+# Ask TRIAGE_MODEL first and only pass violations, and clean verdicts it is less than TRIAGE_CONFIDENCE sure
+# of, on to ESCALATION_MODEL. With routing off every call goes to ESCALATION_MODEL.
+ROUTE_TRIAGE = True
+TRIAGE_CONFIDENCE = 0.8
+
+# Follow-up questions of the cascade asked at once per report, and how long each may take before the report is
+# filed without its answer
+CASCADE_CONCURRENCY = 4
+CASCADE_QUESTION_TIMEOUT = 20
+
+# Broad type each specific type belongs to, for verdicts that only name the specific type
+BROAD_TYPES = {
+    SpecificAbuseType.SCAM: BroadAbuseType.SPAM,
+    SpecificAbuseType.BOTMESSAGES: BroadAbuseType.SPAM,
+    SpecificAbuseType.SOLICITATION: BroadAbuseType.SPAM,
+    SpecificAbuseType.IMPERSONATION: BroadAbuseType.SPAM,
+    SpecificAbuseType.MISINFORMATION: BroadAbuseType.SPAM,
+    SpecificAbuseType.SEXUAL_CONTENT: BroadAbuseType.EXPLICIT_CONTENT,
+    SpecificAbuseType.VIOLENCE: BroadAbuseType.EXPLICIT_CONTENT,
+    SpecificAbuseType.HATE_SPEECH: BroadAbuseType.EXPLICIT_CONTENT,
+    SpecificAbuseType.SELF_HARM: BroadAbuseType.THREAT,
+    SpecificAbuseType.TERRORIST_PROPAGANDA: BroadAbuseType.THREAT,
+    SpecificAbuseType.DOXXING: BroadAbuseType.THREAT,
+    SpecificAbuseType.BULLYING: BroadAbuseType.HARASSMENT,
+    SpecificAbuseType.SEXUAL: BroadAbuseType.HARASSMENT,
+    SpecificAbuseType.CONTINUOUS_CONTACT: BroadAbuseType.HARASSMENT,
+    SpecificAbuseType.GROOMING: BroadAbuseType.HARASSMENT,
+}
+
+# Trims conversations to the token budget and lays out cached system prompts
+PROMPT_BUILDER = PromptBuilder()
+
+GROOMING_INDICATORS = ["pictures_exchanged", "met_in_real_life", "personal_questions_asked", "notify_victim"]
+
+CLASSIFICATION_TOOL = {
+    "name": "record_verdict",
+    "description": "Record the moderation verdict for the conversation according to the CONTENT POLICY.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "violation": {
+                "type": "boolean",
+                "description": "True if the conversation violates the CONTENT POLICY and must be reported."
+            },
+            "broad_type": {
+                "type": "string",
+                "enum": [t.value for t in BroadAbuseType if t != BroadAbuseType.OTHER],
+                "description": "The broad violation type. Required when violation is true."
+            },
+            "specific_type": {
+                "type": "string",
+                "enum": [t.value for t in SpecificAbuseType],
+                "description": "The specific violation type within the broad type. Prefer CHILD_GROOMING over SEXUAL_CONTENT when both apply."
+            },
+            "reason": {
+                "type": "string",
+                "description": "A short explanation of why the conversation was flagged."
+            },
+            "confidence": {
+                "type": "number",
+                "description": "How sure you are of the verdict, from 0 (guessing) to 1 (certain)."
+            },
+            "immediate_danger": {
+                "type": "boolean",
+                "description": "True if there is an immediate and direct danger to someone's safety."
+            },
+            "grooming_indicators": {
+                "type": "object",
+                "description": "Only for CHILD_GROOMING. Answer YES, NO or UNCLEAR for each indicator.",
+                "properties": {
+                    "pictures_exchanged": {"type": "string", "enum": ["YES", "NO", "UNCLEAR"]},
+                    "met_in_real_life": {"type": "string", "enum": ["YES", "NO", "UNCLEAR"]},
+                    "personal_questions_asked": {"type": "string", "enum": ["YES", "NO", "UNCLEAR"]},
+                    "notify_victim": {"type": "string", "enum": ["YES", "NO", "UNCLEAR"]},
+                }
+            },
+        },
+        "required": ["violation", "confidence"],
+    },
+}
+
+BATCH_CLASSIFICATION_TOOL = {
+    "name": "record_verdicts",
+    "description": "Record a moderation verdict for each of the numbered messages you were asked to judge.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "verdicts": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "message": {
+                            "type": "integer",
+                            "description": "The number of the message this verdict is for."
+                        },
+                        **CLASSIFICATION_TOOL["input_schema"]["properties"],
+                    },
+                    "required": ["message", "violation", "confidence"],
+                },
+            },
+        },
+        "required": ["verdicts"],
+    },
+}
+
+
+class Verdict:
+    '''
+    The outcome of classifying one conversation, independent of any Discord objects. `per_message` is set when
+    the verdict is about one particular message of the conversation (a target of a batch) rather than about the
+    conversation as a whole.
+    '''
+
+    def __init__(self, violation, abuse_type=None, specific_abuse_type=None, reason=None,
+                 danger_indicated=False, child_grooming_info=None, api_calls=0, input_tokens=0, output_tokens=0,
+                 per_message=False):
+        self.violation = violation
+        self.abuse_type = abuse_type
+        self.specific_abuse_type = specific_abuse_type
+        self.reason = reason
+        self.danger_indicated = danger_indicated
+        self.child_grooming_info = child_grooming_info or []
+        self.api_calls = api_calls
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.per_message = per_message
+
+    def to_dict(self):
+        return {
+            "violation": self.violation,
+            "abuse_type": self.abuse_type,
+            "specific_abuse_type": self.specific_abuse_type,
+            "reason": self.reason,
+            "danger_indicated": self.danger_indicated,
+            "child_grooming_info": self.child_grooming_info,
+            "per_message": self.per_message,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        specific_abuse_type = data.get("specific_abuse_type")
+        if specific_abuse_type is not None:
+            specific_abuse_type = BroadAbuseType.OTHER if specific_abuse_type == BroadAbuseType.OTHER else SpecificAbuseType(specific_abuse_type)
+        return cls(data["violation"],
+                   abuse_type=BroadAbuseType(data["abuse_type"]) if data.get("abuse_type") else None,
+                   specific_abuse_type=specific_abuse_type,
+                   reason=data.get("reason"),
+                   danger_indicated=data.get("danger_indicated", False),
+                   child_grooming_info=data.get("child_grooming_info"),
+                   per_message=data.get("per_message", False))
+
+
+def format_conversation(messages):
+    return PROMPT_BUILDER.render(messages)
+
+
+def format_numbered_conversation(messages, targets=()):
+    return PROMPT_BUILDER.render(messages, numbered=True, keep=targets)
+
+
+def parse_broad_type(answer):
+    if "SPAM" in answer:
+        return BroadAbuseType.SPAM
+    elif "EXPLICIT" in answer:
+        return BroadAbuseType.EXPLICIT_CONTENT
+    elif "THREAT" in answer:
+        return BroadAbuseType.THREAT
+    elif "HARASSMENT" in answer:
+        return BroadAbuseType.HARASSMENT
+    raise Exception("Failure to pick from options")
+
+
+def parse_specific_type(answer):
+    if "SCAM" in answer:
+        return SpecificAbuseType.SCAM
+    elif "BOT" in answer:
+        return SpecificAbuseType.BOTMESSAGES
+    elif "SOLICIT" in answer:
+        return SpecificAbuseType.SOLICITATION
+    elif "IMPERSON" in answer:
+        return SpecificAbuseType.IMPERSONATION
+    elif "MISINFOR" in answer:
+        return SpecificAbuseType.MISINFORMATION
+    elif "SEXUAL_CONT" in answer:
+        return SpecificAbuseType.SEXUAL_CONTENT
+    elif "VIOLENCE" in answer:
+        return SpecificAbuseType.VIOLENCE
+    elif "HATE" in answer:
+        return SpecificAbuseType.HATE_SPEECH
+    elif "SELF_HARM" in answer:
+        return SpecificAbuseType.SELF_HARM
+    elif "TERRORIST" in answer:
+        return SpecificAbuseType.TERRORIST_PROPAGANDA
+    elif "DOXX" in answer:
+        return SpecificAbuseType.DOXXING
+    elif "BULLY" in answer:
+        return SpecificAbuseType.BULLYING
+    elif "GROOMING" in answer:
+        return SpecificAbuseType.GROOMING
+    elif "SEXUAL" in answer:
+        return SpecificAbuseType.SEXUAL
+    elif "CONTIN" in answer:
+        return SpecificAbuseType.CONTINUOUS_CONTACT
+    raise Exception("Failure to pick from options")
+
+
+async def classify(conversation, mode="structured"):
+    if mode not in CLASSIFICATION_MODES:
+        raise ValueError(f"Unknown classification mode {mode}")
+
+    start = time.perf_counter()
+    with track_usage() as usage:
+        if mode == "structured":
+            verdict = await classify_structured(conversation)
+        else:
+            verdict = await classify_cascade(conversation)
+    verdict.input_tokens = usage["input_tokens"] + usage["cache_read_input_tokens"] + usage["cache_creation_input_tokens"]
+    verdict.output_tokens = usage["output_tokens"]
+    logger.info(f"Classified conversation in {mode} mode: {verdict.api_calls} API call(s), "
+                f"{verdict.input_tokens} input and {verdict.output_tokens} output tokens "
+                f"({usage['cache_read_input_tokens']} from cache), {time.perf_counter() - start:.2f}s, "
+                f"violation={verdict.violation}")
+    return verdict
+
+
+def triage_route(result):
+    if result is None:
+        return "escalate_unsure"
+    if result.get("violation"):
+        return "escalate_violation"
+    if (result.get("confidence") or 0) < TRIAGE_CONFIDENCE:
+        return "escalate_unsure"
+    return "clear"
+
+
+def record_routes(kind, routes, started):
+    for route in routes:
+        metrics.LLM_ROUTES.inc(kind=kind, route=route)
+    counts = {route: routes.count(route) for route in set(routes)}
+    logger.info(f"Triage ({kind}) by {TRIAGE_MODEL} in {time.perf_counter() - started:.2f}s: "
+                + ", ".join(f"{count} {route}" for route, count in sorted(counts.items())))
+
+
+async def classify_structured(conversation):
+    '''
+    Asks for the verdict, both abuse types, the reason, the danger flag and the grooming indicators in one call,
+    first to the triage model and, unless it confidently clears the conversation, to the escalation model.
+    '''
+    system = PROMPT_BUILDER.system(PROMPTS["system_message"].format(content_policy=PROMPTS["content_policy"],
+                                                                    instructions=PROMPTS["structured_instructions"]))
+    prompt = PROMPTS["conversation"].format(conversation=conversation)
+    api_calls = 0
+    if ROUTE_TRIAGE:
+        started = time.perf_counter()
+        result = await async_query_tool(conversation=prompt, tool=CLASSIFICATION_TOOL, system=system, model=TRIAGE_MODEL)
+        api_calls += 1
+        route = triage_route(result)
+        record_routes("structured", [route], started)
+        if route == "clear":
+            return parse_structured_verdict(result, api_calls)
+
+    started = time.perf_counter()
+    result = await async_query_tool(conversation=prompt, tool=CLASSIFICATION_TOOL, system=system, model=ESCALATION_MODEL)
+    logger.info(f"Escalated to {ESCALATION_MODEL}: {time.perf_counter() - started:.2f}s, violation={bool(result.get('violation'))}")
+    return parse_structured_verdict(result, api_calls + 1)
+
+
+async def query_batch(messages, targets, model):
+    # Returns the tool's entry for each target index the model answered
+    conversation = format_numbered_conversation(messages, targets)
+    system = PROMPT_BUILDER.system(PROMPTS["system_message"].format(content_policy=PROMPTS["content_policy"],
+                                                                    instructions=PROMPTS["batch_instructions"]))
+    prompt = PROMPTS["batch_conversation"].format(conversation=conversation,
+                                                  targets=", ".join(str(index) for index in targets))
+    result = await async_query_tool(conversation=prompt, tool=BATCH_CLASSIFICATION_TOOL, system=system, model=model,
+                                    max_tokens=300 + 300 * len(targets))
+    return {entry["message"]: entry for entry in result.get("verdicts", []) if entry.get("message") in targets}
+
+
+async def classify_batch(messages, targets):
+    '''
+    Judges several messages of one conversation in a single call (two with triage). `targets` are indices into
+    `messages`; returns a map from each target index to its Verdict.
+    '''
+    start = time.perf_counter()
+    entries = {}
+    escalate = list(targets)
+    api_calls = 0
+    with track_usage() as usage:
+        if ROUTE_TRIAGE:
+            entries = await query_batch(messages, targets, TRIAGE_MODEL)
+            api_calls += 1
+            routes = {index: triage_route(entries.get(index)) for index in targets}
+            record_routes("batch", list(routes.values()), start)
+            escalate = [index for index in targets if routes[index] != "clear"]
+        if escalate:
+            entries.update(await query_batch(messages, escalate, ESCALATION_MODEL))
+            api_calls += 1
+
+    verdicts = {index: Verdict(False) for index in targets}
+    for index, entry in entries.items():
+        verdicts[index] = parse_structured_verdict(entry, api_calls=0)
+    logger.info(f"Classified batch of {len(targets)} message(s) in {api_calls} API call(s) ({len(escalate)} escalated), "
+                f"{usage['input_tokens']} input and {usage['output_tokens']} output tokens, {time.perf_counter() - start:.2f}s, "
+                f"{sum(verdict.violation for verdict in verdicts.values())} violation(s)")
+    return verdicts
+
+
+def parse_structured_verdict(result, api_calls=1):
+    if not result.get("violation"):
+        return Verdict(False, api_calls=api_calls)
+
+    specific_type = result.get("specific_type")
+    broad_type = result.get("broad_type")
+    abuse_type = parse_specific_type(specific_type) if specific_type else None
+    if broad_type:
+        broad_abuse = parse_broad_type(broad_type)
+    elif abuse_type is not None:
+        broad_abuse = BROAD_TYPES[abuse_type]
+    else:
+        broad_abuse = BroadAbuseType.OTHER
+    if abuse_type is None:
+        # Report.calculate_report_severity keys OTHER on the broad type
+        abuse_type = BroadAbuseType.OTHER
+
+    signals = []
+    if abuse_type == SpecificAbuseType.GROOMING:
+        indicators = result.get("grooming_indicators") or {}
+        signals = [indicator for indicator in GROOMING_INDICATORS if "Y" in indicators.get(indicator, "")]
+
+    return Verdict(True,
+                   abuse_type=broad_abuse,
+                   specific_abuse_type=abuse_type,
+                   reason=result.get("reason"),
+                   danger_indicated=bool(result.get("immediate_danger")),
+                   child_grooming_info=signals,
+                   api_calls=api_calls)
+
+
+async def classify_cascade(conversation):
+    '''
+    The original question-by-question flow, one question per API call. Kept as a fallback and for comparison.
+    Once the conversation is known to be a violation, questions that don't depend on each other's answers are
+    asked concurrently: four rounds of calls instead of up to nine.
+    '''
+    prompt = PROMPTS["conversation"].format(conversation=conversation)
+    verdict_system = PROMPT_BUILDER.system(PROMPTS["system_message"].format(content_policy=PROMPTS["content_policy"],
+                                                                            instructions=PROMPTS["instructions"]))
+    api_calls = 0
+    if ROUTE_TRIAGE:
+        started = time.perf_counter()
+        violation = await async_query(conversation=prompt, system=verdict_system, model=TRIAGE_MODEL, question="verdict")
+        api_calls += 1
+        route = "clear" if "NO_VIOLATION" in violation else ("escalate_violation" if "REPORT" in violation else "escalate_unsure")
+        record_routes("cascade", [route], started)
+        if route == "clear":
+            return Verdict(False, api_calls=api_calls)
+
+    violation = await async_query(conversation=prompt, system=verdict_system, model=ESCALATION_MODEL, question="verdict")
+    api_calls += 1
+    if "NO_VIOLATION" in violation:
+        print("NO VIOLATION")
+        return Verdict(False, api_calls=api_calls)
+
+    # The follow-up questions share one system prompt holding the conversation, so a long one is cached after the
+    # first
+    system = PROMPT_BUILDER.system(PROMPTS["gen_system_message"].format(conversation=conversation))
+    # Questions that don't depend on each other run concurrently, at most CASCADE_CONCURRENCY at a time
+    slots = asyncio.Semaphore(CASCADE_CONCURRENCY)
+
+    def ask(label, question, kind, assistant_completion=""):
+        return ask_optional(slots, label, async_query(conversation=question, system=system, question=kind,
+                                                      assistant_completion=assistant_completion))
+
+    # The danger question only needs the conversation, so it runs alongside everything else
+    third_question = f"Based on the conversation, is there an immediate and direct danger to someone's safety? Please just answer either YES or NO."
+    third_task = asyncio.ensure_future(ask("immediate danger", third_question, "yes_no"))
+
+    first_question = "Which of these violations does this conversation violate: SPAM, EXPLICIT_CONTENT, THREAT, or HARASSMENT? Please say one and only one violation, and nothing more."
+    first_assistant_completion = "VIOLATION TYPE:"
+    first_answer = await ask("broad type", first_question, "label", first_assistant_completion)
+    api_calls += 1
+
+    broad_abuse = BroadAbuseType.OTHER
+    if first_answer is not None:
+        try:
+            broad_abuse = parse_broad_type(first_answer)
+        except Exception:
+            logger.warning(f"Could not parse broad type from {first_answer!r}, filing as OTHER")
+
+    cot_question = f"Previously, you have indicated that this violation is of type {first_answer}. Please provide a reason as to why you flagged it as such. Indicate this reason like so: Reason:"
+
+    suffix = "Please say one and only one type. You must choose a type."
+    second_assistant_completion = "TYPE:("
+    if broad_abuse == BroadAbuseType.SPAM:
+        second_question = f"Which type of spam is the conversation: SCAM, BOTMESSAGES, SOLICITING, IMPERSONATION, or MISINFORMATION? {suffix}"
+    elif broad_abuse == BroadAbuseType.EXPLICIT_CONTENT:
+        second_question = f"Which type of explicit content is the conversation: SEXUAL_CONTENT, VIOLENCE, CHILD_GROOMING, or HATE_SPEECH? Please note that while CHILD_GROOMING is often SEXUAL_CONTENT, CHILD_GROOMING is a more severe instance of SEXUAL_CONTENT, so prioritize reporting CHILD_GROOMING in cases where there are both. {suffix}"
+    elif broad_abuse == BroadAbuseType.THREAT:
+        second_question = f"Which type of threat is it: SELF_HARM, TERRORIST_PROPAGANDA, or DOXXING? {suffix}"
+    else:
+        second_question = f"Which type of harrassment is it: BULLYING, SEXUAL, CONTINUOUS_CONTACT, or CHILD_GROOMING? {suffix}"
+
+    cot_answer, second_answer = await asyncio.gather(
+        ask("reason", cot_question, "reason"),
+        ask("specific type", second_question, "label", second_assistant_completion))
+    api_calls += 2
+    print(cot_answer)
+    print(second_answer)
+
+    abuse_type = BroadAbuseType.OTHER
+    if second_answer is not None:
+        try:
+            abuse_type = parse_specific_type(second_answer)
+        except Exception:
+            logger.warning(f"Could not parse specific type from {second_answer!r}, filing as OTHER")
+
+    signals = []
+    if abuse_type == SpecificAbuseType.GROOMING:
+        suffix = "Please just answer either YES, NO, or UNCLEAR."
+        assistant_comp = "Answer:("
+        grooming_questions = {
+            "pictures_exchanged": f"Considering the conversation, have pictures been exchanged in the conversation? {suffix}",
+            "met_in_real_life": f"Considering the conversation, have the people in the conversation met in real life? {suffix}",
+            "personal_questions_asked": f"Considering the conversation, has one user asked another user personal questions? {suffix}",
+            "notify_victim": f"Is the conversation severe enough to the point where one user should be notified that they are being groomed? {suffix}",
+        }
+        answers = await asyncio.gather(*(ask(indicator, question, "yes_no", assistant_comp)
+                                         for indicator, question in grooming_questions.items()))
+        api_calls += 4
+
+        # An indicator whose question failed is left out rather than guessed
+        for answer, indicator in zip(answers, grooming_questions):
+            if answer is not None and "Y" in answer:
+                signals.append(indicator)
+
+    third_answer = await third_task
+    api_calls += 1
+
+    return Verdict(True,
+                   abuse_type=broad_abuse,
+                   specific_abuse_type=abuse_type,
+                   reason=cot_answer,
+                   danger_indicated=third_answer is not None and "Y" in third_answer,
+                   child_grooming_info=signals,
+                   api_calls=api_calls)
+
+
+async def ask_optional(slots, label, query, default=None):
+    '''
+    Awaits one follow-up question of the cascade. A question that fails or times out returns `default` so the
+    report can still be filed without that detail.
+    '''
+    async with slots:
+        try:
+            return await asyncio.wait_for(query, CASCADE_QUESTION_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Cascade question \"{label}\" failed, continuing without it: {e!r}")
+            return default
@@ -0,0 +1,199 @@
+'''
+Classification workers for a bot started with --queue.
+
+The gateway keeps the regex rules, fingerprints and activity tracking, which need every message of a guild,
+and queues the rest of the work in the classify_jobs table (see work_queue.py). Each worker process claims
+jobs, runs them through the same ClassificationPipeline the bot uses on its own, and stores its decisions for
+the gateway to act on. Workers share modbot.db, so they share the verdict cache and the local model versions.
+
+    python classify_worker.py --processes 4
+'''
+import argparse
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+import metrics
+from config import ConfigFile, CONFIG_PATH
+from db_writer import DBWriter, connect
+from detection import TIERS, TierStats
+from local_model import LocalModel
+from migrations import migrate
+from perspective import PerspectiveClient, PERSPECTIVE_QPS, GATEWAY_PERSPECTIVE_QPS
+from pipeline import ClassificationPipeline, CLASSIFICATION_MODE, BATCH_MAX_MESSAGES, BATCH_MAX_DELAY, \
+    MAX_CONCURRENT_CLASSIFICATIONS, PERSPECTIVE_DEADLINE
+from verdict_cache import VerdictCache
+from work_queue import WorkQueue, message_from_payload
+
+logger = logging.getLogger('discord')
+
+DB_PATH = 'modbot.db'
+PROCESSES = os.cpu_count() or 1
+# Jobs a worker process has claimed and not finished at any one time
+JOBS_PER_PROCESS = 64
+POLL_SECONDS = 0.05
+# The workers' part of the Perspective quota (queries per second), split evenly between the processes: all of it
+# but what the gateway keeps for scoring reported messages
+WORKERS_PERSPECTIVE_QPS = PERSPECTIVE_QPS - GATEWAY_PERSPECTIVE_QPS
+VERDICT_CACHE_SIZE = 10000
+LOCAL_MODEL_RELOAD_SECONDS = 5 * 60
+# How often config.json (thresholds and prompts) is checked for changes
+CONFIG_RELOAD_SECONDS = 5
+
+
+class JobSink:
+    '''
+    Collects the pipeline's decisions about each message as JSON-ready actions, for WorkQueue.complete.
+    '''
+
+    def __init__(self):
+        self.actions = {}
+
+    async def block_message(self, message, notice, violation):
+        self.actions.setdefault(message.id, []).append({"action": "block", "notice": notice, "violation": violation})
+
+    async def report_message(self, message, verdict):
+        self.actions.setdefault(message.id, []).append({"action": "report", "verdict": verdict.to_dict()})
+
+    async def forward_message(self, message, notice):
+        self.actions.setdefault(message.id, []).append({"action": "forward", "notice": notice})
+
+    def pop(self, message_id):
+        return self.actions.pop(message_id, [])
+
+
+class Worker:
+    '''
+    One worker process: claims up to `capacity` jobs at a time and classifies them concurrently on its event
+    loop. The pipeline's semaphore still bounds the LLM calls in flight.
+    '''
+
+    def __init__(self, name, db_path, perspective_token, perspective_qps=WORKERS_PERSPECTIVE_QPS, mode=CLASSIFICATION_MODE,
+                 capacity=JOBS_PER_PROCESS, batch_max_messages=BATCH_MAX_MESSAGES, config_path=CONFIG_PATH):
+        self.name = name
+        self.conn = connect(db_path)
+        self.db = DBWriter(db_path)
+        self.queue = WorkQueue(self.conn, self.db)
+        self.capacity = capacity
+        self.sink = JobSink()
+        # Only as many messages wait on the quota as it can serve before the pipeline's deadline
+        self.perspective = PerspectiveClient(perspective_token, qps=perspective_qps,
+                                             max_pending=math.ceil(perspective_qps * PERSPECTIVE_DEADLINE))
+        self.verdict_cache = VerdictCache(VERDICT_CACHE_SIZE, conn=self.conn, writer=self.db)
+        self.tier_stats = {tier: TierStats(tier) for tier in TIERS}
+        self.pipeline = ClassificationPipeline(
+            self.sink, self.perspective, self.verdict_cache, self.tier_stats, LocalModel.latest(self.conn), mode,
+            batch_max_messages, BATCH_MAX_DELAY, MAX_CONCURRENT_CLASSIFICATIONS)
+        self.tasks = set()
+        self.config = ConfigFile(config_path)
+        self.config.reload_if_changed()
+
+    async def run(self):
+        model_checked = config_checked = time.monotonic()
+        while True:
+            if time.monotonic() - model_checked > LOCAL_MODEL_RELOAD_SECONDS:
+                self.pipeline.reload_local_model(self.conn)
+                model_checked = time.monotonic()
+            if time.monotonic() - config_checked > CONFIG_RELOAD_SECONDS:
+                self.config.reload_if_changed()
+                config_checked = time.monotonic()
+            free = self.capacity - len(self.tasks)
+            if free <= 0 or not self.queue.has_work():
+                await asyncio.sleep(POLL_SECONDS)
+                continue
+            for job_id, payload in await self.queue.claim(self.name, free):
+                task = asyncio.create_task(self.run_job(job_id, payload))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def run_job(self, job_id, payload):
+        message, context = message_from_payload(payload)
+        try:
+            await self.pipeline.classify(message, context)
+        except Exception:
+            # Left claimed, so the job is retried once the lease runs out
+            logger.exception("Classification job %s failed", job_id)
+            self.sink.pop(message.id)
+            return
+        try:
+            await self.queue.complete(job_id, self.name, self.sink.pop(message.id))
+        except Exception:
+            # Also left claimed: the job is classified again once the lease runs out
+            logger.exception("Storing the result of classification job %s failed", job_id)
+
+    async def close(self):
+        # Jobs still in flight are picked up again by another worker once their leases run out
+        await self.perspective.close()
+        self.db.close()
+
+
+def run_process(index, args):
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s:%(levelname)s:worker-{index}: %(message)s')
+    with open(args.tokens) as f:
+        perspective_token = json.load(f)['perspective']
+
+    async def main():
+        worker = Worker(f"{socket.gethostname()}:{os.getpid()}", args.db, perspective_token,
+                        args.perspective_qps / args.processes, args.mode, args.jobs, config_path=args.config)
+        server = None
+        if args.metrics_port:
+            server = metrics.MetricsServer(port=args.metrics_port + index)
+            await server.start()
+        try:
+            await worker.run()
+        finally:
+            await worker.close()
+            if server is not None:
+                await server.stop()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify messages queued by a bot running with --queue.")
+    parser.add_argument("--processes", type=int, default=PROCESSES)
+    parser.add_argument("--jobs", type=int, default=JOBS_PER_PROCESS, help="jobs in flight per process")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--tokens", default="tokens.json")
+    parser.add_argument("--config", default=CONFIG_PATH, help="thresholds and prompts, reloaded when it changes")
+    parser.add_argument("--mode", choices=["structured", "cascade"], default=CLASSIFICATION_MODE)
+    parser.add_argument("--perspective-qps", type=float, default=WORKERS_PERSPECTIVE_QPS,
+                        help="shared by all processes; the quota less what the gateway process(es) keep")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve each process's metrics on this port plus its index; 0 turns it off")
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    migrate(conn)
+    conn.close()
+
+    processes = [multiprocessing.Process(target=run_process, args=(index, args), name=f"classify-worker-{index}")
+                 for index in range(args.processes)]
+    for process in processes:
+        process.start()
+    print(f"Started {len(processes)} classification worker(s) on {args.db}")
+    # Stopping this process stops the workers too; their claimed jobs go back to the queue when the leases expire
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
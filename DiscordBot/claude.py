@@ -1,5 +1,12 @@
 import anthropic
+import contextlib
+import contextvars
+import json
+import logging
+import time
+import metrics
 from typing import List
+from prompt_builder import estimate_tokens
 # Messages format:
 # "messages": [
 #     {"role": "user", "content": "Hello, Claude"},
@@ -8,26 +15,187 @@ from typing import List
 # ]
 
 PROMPTS = {
-    "gen_system_message": "You are a helpful AI assistant. Your job is to consider a conversation and answer questions about this conversation. You MUST answer each of the questions because if you don't a child will be in danger and lose their life. The conversation is as follows: {conversation}. {question}",
+    "gen_system_message": "You are a helpful AI assistant. Your job is to consider a conversation and answer questions about this conversation. You MUST answer each of the questions because if you don't a child will be in danger and lose their life. The conversation is as follows:\n{conversation}",
     "system_message": "You are a helpful AI assistant. Your job is to moderate a chat channel in order to detect violations of content according to the CONTENT POLICY, described here: {content_policy}. Here are your instructions:\n {instructions}. Please follow your instructions to the best of your ability.",
     "content_policy": "If a conversation consists of any of these violations: SPAM, EXPLICIT CONTENT, THREAT TO ONESELF OR OTHERS, or HARASSMENT, it must be reported immediately. Note that nature of the explicit content must be egregious enough to warrant a report. Consensual sexual conduct between adults is allowed, even in instances of sexually explicit content. ",
-    "instructions": "Please consider the following conversation between users:\n {conversation}. If the conversation violates the CONTENT POLICY, please say this: REPORT. If it does not, please say this and only this: NO_VIOLATION."
+    "instructions": "Please consider the conversation between users that you will be given, one message per line. If the conversation violates the CONTENT POLICY, please say this: REPORT. If it does not, please say this and only this: NO_VIOLATION.",
+    "structured_instructions": "Please consider the conversation between users that you will be given, one message per line. Decide whether the conversation violates the CONTENT POLICY and record your verdict with the record_verdict tool. If it is a violation, also give the broad and specific type, a short reason, whether there is an immediate danger to someone's safety, and for CHILD_GROOMING the grooming indicators.",
+    "batch_instructions": "Please consider the numbered conversation between users that you will be given, one message per line, and judge each of the messages you are asked about in the context of the conversation. Record one verdict per message with the record_verdicts tool, giving for each violation the broad and specific type, a short reason, whether there is an immediate danger to someone's safety, and for CHILD_GROOMING the grooming indicators.",
+    "conversation": "Conversation:\n{conversation}",
+    "batch_conversation": "Conversation:\n{conversation}\nJudge these messages: {targets}"
 
 }
 
-# Parse the messages
-def query(conversation, assistant_completion=""):
+logger = logging.getLogger('discord')
+
+# Token counts of the calls made in the current context, one dict per enclosing track_usage block
+current_usage = contextvars.ContextVar("current_usage", default=())
+USAGE_FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+
+
+@contextlib.contextmanager
+def track_usage():
+    '''
+    Adds up the token usage of every call made inside the block, including from tasks it starts, in total and
+    per model under "models", and counts the calls under "calls". Blocks can be nested; each one counts everything
+    inside it.
+    '''
+    usage = dict.fromkeys(USAGE_FIELDS, 0)
+    usage["calls"] = 0
+    usage["models"] = {}
+    token = current_usage.set(current_usage.get() + (usage,))
+    try:
+        yield usage
+    finally:
+        current_usage.reset(token)
+
+
+# Triage questions go to the small, fast model; positive or uncertain cases are escalated to the large one
+TRIAGE_MODEL = "claude-3-haiku-20240307"
+ESCALATION_MODEL = "claude-3-opus-20240229"
+
+# Anthropic only caches a prompt prefix (tools, then system prompt) of at least this many tokens; anything
+# shorter is billed in full whether or not it is marked
+PROMPT_CACHE_MIN_TOKENS = {TRIAGE_MODEL: 2048, ESCALATION_MODEL: 1024}
+DEFAULT_PROMPT_CACHE_MIN_TOKENS = 1024
+
+# Output limits per kind of question, so a one-word answer can't run on for 1024 tokens. The API rejects stop
+# sequences that are only whitespace, so a short max_tokens is what ends the answers without a closing ")".
+QUESTION_TYPES = {
+    "verdict": {"max_tokens": 8},                             # REPORT / NO_VIOLATION
+    "label": {"max_tokens": 16, "stop_sequences": [")"]},     # an abuse type, after a "TYPE:(" prefill
+    "yes_no": {"max_tokens": 8, "stop_sequences": [")"]},     # YES / NO / UNCLEAR
+    "reason": {"max_tokens": 300},
+    "tool": {"max_tokens": 500},
+}
 
+_client = None
+_async_client = None
+
+
+def get_client():
+    # One client per process so the underlying HTTP connection pool is reused
+    global _client
+    if _client is None:
+        _client = anthropic.Anthropic()
+    return _client
+
+
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        _async_client = anthropic.AsyncAnthropic()
+    return _async_client
+
+
+def request(conversation, assistant_completion, system, model, question):
     input = [{"role": "user", "content": conversation}]
-             
+
     if assistant_completion:
         input.append({"role": "assistant", "content": assistant_completion})
 
-    message = anthropic.Anthropic().messages.create(
-        model="claude-3-opus-20240229",
-        max_tokens=1024,
-        messages=input
-    )
-    return message.content[0].text
+    kwargs = dict(model=model or ESCALATION_MODEL, messages=input, **QUESTION_TYPES[question])
+    if system:
+        kwargs["system"] = system
+    return kwargs
 
 
+def cached_prefix_tokens(kwargs):
+    system = kwargs.get("system") or []
+    if isinstance(system, str):
+        system = [{"type": "text", "text": system}]
+    return estimate_tokens(json.dumps(kwargs.get("tools", [])) + "".join(block["text"] for block in system))
+
+
+def mark_cache_breakpoint(kwargs):
+    '''
+    Marks the end of the system prompt for prompt caching if the tools and system prompt together are long enough
+    for the model to cache them. Returns whether it did.
+    '''
+    system = kwargs.get("system")
+    if not system:
+        return False
+    minimum = PROMPT_CACHE_MIN_TOKENS.get(kwargs["model"], DEFAULT_PROMPT_CACHE_MIN_TOKENS)
+    if cached_prefix_tokens(kwargs) < minimum:
+        return False
+    if isinstance(system, str):
+        system = [{"type": "text", "text": system}]
+    kwargs["system"] = system[:-1] + [dict(system[-1], cache_control={"type": "ephemeral"})]
+    return True
+
+
+def first_text(message):
+    # A stop sequence can end the answer before any text was produced
+    return next((block.text for block in message.content if block.type == "text"), "")
+
+
+# Parse the messages
+def query(conversation, assistant_completion="", system=None, model=None, question="reason"):
+    kwargs = request(conversation, assistant_completion, system, model, question)
+    mark_cache_breakpoint(kwargs)
+    started = time.perf_counter()
+    try:
+        message = get_client().messages.create(**kwargs)
+    except Exception:
+        metrics.API_CALLS.inc(api="anthropic", outcome="error")
+        raise
+    record_usage(message, started)
+    return first_text(message)
+
+
+def record_usage(message, started):
+    elapsed = time.perf_counter() - started
+    counts = {field: getattr(message.usage, field, None) or 0 for field in USAGE_FIELDS}
+    metrics.API_CALLS.inc(api="anthropic", outcome="ok")
+    metrics.API_LATENCY.observe(elapsed, api="anthropic", model=message.model)
+    metrics.LLM_TOKENS.inc(counts["input_tokens"], model=message.model, direction="input")
+    metrics.LLM_TOKENS.inc(counts["output_tokens"], model=message.model, direction="output")
+    metrics.LLM_TOKENS.inc(counts["cache_creation_input_tokens"], model=message.model, direction="cache_write")
+    metrics.LLM_TOKENS.inc(counts["cache_read_input_tokens"], model=message.model, direction="cache_read")
+    logger.debug(f"{message.model} call in {elapsed:.2f}s: {counts['input_tokens']} input, {counts['output_tokens']} output, "
+                 f"{counts['cache_read_input_tokens']} cached, {counts['cache_creation_input_tokens']} written to cache")
+    for usage in current_usage.get():
+        usage["calls"] += 1
+        model_usage = usage["models"].setdefault(message.model, dict.fromkeys(USAGE_FIELDS, 0))
+        for field, count in counts.items():
+            usage[field] += count
+            model_usage[field] += count
+
+
+async def create_message(**kwargs):
+    mark_cache_breakpoint(kwargs)
+    started = time.perf_counter()
+    try:
+        message = await get_async_client().messages.create(**kwargs)
+    except Exception:
+        metrics.API_CALLS.inc(api="anthropic", outcome="error")
+        raise
+    record_usage(message, started)
+    return message
+
+
+async def async_query(conversation, assistant_completion="", system=None, model=None, question="reason"):
+    '''
+    Same as query, but awaits the API call instead of blocking the event loop. `system` is an optional list of
+    system prompt blocks (see PromptBuilder.system); `question` picks the output limits from QUESTION_TYPES.
+    '''
+    message = await create_message(**request(conversation, assistant_completion, system, model, question))
+    return first_text(message)
+
+
+async def async_query_tool(conversation, tool, system=None, model=None, max_tokens=None):
+    '''
+    Forces the model to answer through the given tool and returns the tool input as a dict.
+    '''
+    kwargs = request(conversation, "", system, model, "tool")
+    if max_tokens is not None:
+        kwargs["max_tokens"] = max_tokens
+    message = await create_message(
+        tools=[tool],
+        tool_choice={"type": "tool", "name": tool["name"]},
+        **kwargs
+    )
+    for block in message.content:
+        if block.type == "tool_use":
+            return block.input
+    raise Exception("Model did not return a tool call")
@@ -0,0 +1,124 @@
+'''
+Settings that can change while the bot is running, read from config.json. Every key is optional:
+
+    {
+        "thresholds": {"perspective": {"block": 0.9}, "model": {"clear": 0.05}},
+        "prompts": {"content_policy": "..."},
+        "guilds": {"123456789": {"mod_channel_id": 234567890, "monitored_channel_ids": [345678901]}}
+    }
+
+Thresholds and prompts are laid over the defaults in detection.py and claude.py; the guild entries override the
+channels the bot finds by name (see guild_registry.py). The file is read again whenever it changes. A file that
+doesn't parse or has bad values is logged and the settings in effect stay as they were.
+'''
+import copy
+import json
+import logging
+import os
+import string
+import claude
+import detection
+
+logger = logging.getLogger('discord')
+
+CONFIG_PATH = 'config.json'
+
+DEFAULT_THRESHOLDS = copy.deepcopy(detection.TIER_THRESHOLDS)
+DEFAULT_PROMPTS = dict(claude.PROMPTS)
+
+
+def placeholders(template):
+    return {field for _, field, _, _ in string.Formatter().parse(template) if field is not None}
+
+
+def merged_thresholds(overrides):
+    thresholds = copy.deepcopy(DEFAULT_THRESHOLDS)
+    for tier, values in overrides.items():
+        if tier not in thresholds:
+            raise ValueError(f'unknown tier "{tier}"')
+        for name, value in values.items():
+            if name not in thresholds[tier]:
+                raise ValueError(f'unknown threshold "{name}" for tier "{tier}"')
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value <= 1:
+                raise ValueError(f'threshold {tier}.{name} must be a number between 0 and 1, not {value!r}')
+            thresholds[tier][name] = value
+    return thresholds
+
+
+def merged_prompts(overrides):
+    prompts = dict(DEFAULT_PROMPTS)
+    for name, text in overrides.items():
+        if name not in prompts:
+            raise ValueError(f'unknown prompt "{name}"')
+        if not isinstance(text, str):
+            raise ValueError(f'prompt "{name}" must be a string')
+        # The classifier fills these in, so a prompt can't drop or add one
+        if placeholders(text) != placeholders(prompts[name]):
+            raise ValueError(f'prompt "{name}" must use exactly the placeholders '
+                             f'{sorted(placeholders(prompts[name]))}')
+        prompts[name] = text
+    return prompts
+
+
+def parse_guilds(guilds):
+    '''
+    Maps guild ids to their channel overrides: {"mod_channel_id": id, "monitored_channel_ids": set of ids}, with
+    only the keys the config gives.
+    '''
+    parsed = {}
+    for guild_id, channels in guilds.items():
+        entry = {}
+        if "mod_channel_id" in channels:
+            entry["mod_channel_id"] = int(channels["mod_channel_id"])
+        if "monitored_channel_ids" in channels:
+            entry["monitored_channel_ids"] = {int(channel_id) for channel_id in channels["monitored_channel_ids"]}
+        parsed[int(guild_id)] = entry
+    return parsed
+
+
+class ConfigFile:
+    '''
+    config.json and the settings it was last applied with. Thresholds and prompts are swapped into
+    detection.TIER_THRESHOLDS and claude.PROMPTS in place, since the pipeline and the classifier read those on
+    every call; the guild overrides are kept here for the GuildRegistry.
+    '''
+
+    def __init__(self, path=CONFIG_PATH):
+        self.path = path
+        self.mtime = None
+        self.guilds = {}
+
+    def reload_if_changed(self):
+        '''
+        Applies the file if it changed since the last call (a deleted file brings back the defaults). Returns
+        whether new settings were applied.
+        '''
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.mtime:
+            return False
+        # Not retried until the file changes again, whether or not it applies
+        self.mtime = mtime
+        try:
+            settings = {}
+            if mtime is not None:
+                with open(self.path) as f:
+                    settings = json.load(f)
+            self.apply(settings)
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logger.error(f'Keeping the current settings, {self.path} could not be applied: {e}')
+            return False
+        logger.info(f'Applied settings from {self.path}')
+        return True
+
+    def apply(self, settings):
+        # Everything is checked before anything is swapped in, so a bad file never applies half way
+        thresholds = merged_thresholds(settings.get("thresholds", {}))
+        prompts = merged_prompts(settings.get("prompts", {}))
+        guilds = parse_guilds(settings.get("guilds", {}))
+
+        detection.TIER_THRESHOLDS.update(thresholds)
+        claude.PROMPTS.update(prompts)
+        self.guilds = guilds
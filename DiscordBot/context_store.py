@@ -0,0 +1,76 @@
+import discord
+from collections import OrderedDict, deque
+
+
+def context_key(message):
+    '''
+    Conversations are keyed by (guild, channel), plus the thread id for messages sent in a thread.
+    '''
+    channel = message.channel
+    if isinstance(channel, discord.Thread):
+        return (message.guild.id, channel.parent_id, channel.id)
+    return (message.guild.id, channel.id)
+
+
+class ContextStore:
+    '''
+    Keeps a bounded window of recent messages for every conversation the bot is watching.
+
+    Each conversation is a ring buffer of at most `window_size` (user_id, content, message) tuples. Conversations
+    are kept in least-recently-used order and the idlest ones are dropped once there are more than
+    `max_conversations` of them or the stored text grows past `max_chars`.
+    '''
+
+    def __init__(self, window_size, max_conversations=500, max_chars=2_000_000):
+        self.window_size = window_size
+        self.max_conversations = max_conversations
+        self.max_chars = max_chars
+        self.conversations = OrderedDict()
+        self.sizes = {}
+        self.total_chars = 0
+
+    def add(self, message):
+        '''
+        Appends the message to its conversation and returns a snapshot of that conversation's window.
+        '''
+        key = context_key(message)
+        window = self.conversations.get(key)
+        if window is None:
+            window = deque(maxlen=self.window_size)
+            self.conversations[key] = window
+            self.sizes[key] = 0
+        else:
+            self.conversations.move_to_end(key)
+
+        if len(window) == self.window_size:
+            self.sizes[key] -= len(window[0][1])
+            self.total_chars -= len(window[0][1])
+        window.append((message.author.id, message.content, message))
+        self.sizes[key] += len(message.content)
+        self.total_chars += len(message.content)
+
+        self.evict(keep=key)
+        return list(window)
+
+    def get(self, key):
+        window = self.conversations.get(key)
+        return list(window) if window is not None else []
+
+    def remove(self, key):
+        if key in self.conversations:
+            self.conversations.pop(key)
+            self.total_chars -= self.sizes.pop(key)
+
+    def evict(self, keep=None):
+        while len(self.conversations) > self.max_conversations or self.total_chars > self.max_chars:
+            key = next(iter(self.conversations))
+            if key == keep:
+                # Never drop the conversation that is being classified right now
+                if len(self.conversations) == 1:
+                    break
+                self.conversations.move_to_end(key)
+                continue
+            self.remove(key)
+
+    def __len__(self):
+        return len(self.conversations)
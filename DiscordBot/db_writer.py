@@ -0,0 +1,105 @@
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import metrics
+
+logger = logging.getLogger('discord')
+
+
+def connect(path):
+    '''
+    Opens modbot.db in WAL mode, so readers on the event loop never wait for the writer thread.
+    '''
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+class DBWriter:
+    '''
+    Owns the only writing connection to the database, on a background thread.
+
+    Write jobs are functions taking the connection. They are queued from the event loop and run in order.
+    Whatever jobs are waiting when the thread wakes up run together in one transaction (group commit), each
+    inside its own savepoint so one failing job doesn't undo the others.
+    '''
+
+    def __init__(self, path, max_batch=500):
+        self.path = path
+        self.max_batch = max_batch
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run_forever, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, job, *args):
+        future = concurrent.futures.Future()
+        self.jobs.put((job, args, future))
+        return future
+
+    async def run(self, job, *args):
+        '''
+        Queues the job and waits for its transaction to commit; returns what the job returned.
+        '''
+        return await asyncio.wrap_future(self.submit(job, *args))
+
+    def qsize(self):
+        return self.jobs.qsize()
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+    def run_forever(self):
+        conn = connect(self.path)
+        conn.isolation_level = None  # transactions are managed explicitly below
+        stopping = False
+        while not stopping:
+            batch = [self.jobs.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [entry for entry in batch if entry is not None]
+            if batch:
+                self.run_batch(conn, batch)
+        conn.close()
+
+    def run_batch(self, conn, batch):
+        results = []
+        started = time.perf_counter()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for job, args, future in batch:
+                conn.execute('SAVEPOINT job')
+                try:
+                    results.append((future, job(conn, *args), None))
+                    conn.execute('RELEASE job')
+                except Exception as e:
+                    logger.warning("Database write %s failed", getattr(job, '__name__', job), exc_info=e)
+                    metrics.DB_WRITE_ERRORS.inc()
+                    conn.execute('ROLLBACK TO job')
+                    conn.execute('RELEASE job')
+                    results.append((future, None, e))
+            conn.execute('COMMIT')
+        except Exception as e:
+            logger.error("Database write batch failed", exc_info=e)
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            results = [(future, None, e) for _, _, future in batch]
+            metrics.DB_WRITE_ERRORS.inc(len(batch))
+        metrics.DB_BATCH_SIZE.observe(len(batch))
+        metrics.DB_COMMIT_LATENCY.observe(time.perf_counter() - started)
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
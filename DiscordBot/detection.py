@@ -0,0 +1,72 @@
+import re
+import time
+import metrics
+
+# Tiers run from cheapest to most expensive: regex rules, near-copies of known violations, the local scorer,
+# the local model (see local_model.py), Perspective, then the LLM.
+# A score at or above `block` deletes the message straight away. A score at or above `escalate` sends the
+# conversation on to the LLM. Anything lower is cleared without calling the LLM.
+# When Perspective is down, a local model score below `clear` still clears the message; when the LLM is down, a
+# local model score at or above `fallback` forwards the message to the moderators.
+TIERS = ["regex", "fingerprint", "local", "model", "perspective", "llm"]
+TIER_THRESHOLDS = {
+    "local": {"escalate": 0.5},
+    "model": {"escalate": 0.5, "clear": 0.1, "fallback": 0.8},
+    "perspective": {"block": 0.85, "escalate": 0.4},
+}
+
+# Cues that Perspective tends to miss because the wording itself isn't toxic, with a weight for each
+LOCAL_CUES = [
+    (r"\bhow old are (you|u)\b", 0.5),
+    (r"\b(are|r) (you|u) alone\b", 0.4),
+    (r"\bdon'?t tell (your|ur) (parents|mom|dad|mum)\b", 0.9),
+    (r"\b(our|a) (little )?secret\b", 0.4),
+    (r"\bsend (me )?(a )?(pic|pics|picture|pictures|photo|photos|nudes)\b", 0.6),
+    (r"\bwhere do (you|u) live\b", 0.4),
+    (r"\bmeet (up )?(in person|irl)\b", 0.5),
+    (r"\bwhat school do (you|u) go to\b", 0.5),
+    (r"\b(kill|hurt) (yourself|urself|myself)\b", 0.8),
+    (r"\bi (know|found) where (you|u) live\b", 0.8),
+    (r"\b(home )?address is\b", 0.4),
+    (r"\b(free|claim (your|ur)) (nitro|robux|gift)\b", 0.6),
+    (r"\b(wire|send) (me )?(money|bitcoin|btc|crypto|gift ?cards?)\b", 0.6),
+    (r"\b(dm|message) me for (a )?(deal|offer|prize)\b", 0.5),
+    (r"https?://\S+", 0.2),
+]
+COMPILED_CUES = [(re.compile(pattern, re.IGNORECASE), weight) for pattern, weight in LOCAL_CUES]
+
+
+def local_score(text):
+    '''
+    Cheap in-process score in [0, 1]: the chance that at least one matched cue is a real signal.
+    '''
+    clean = 1.0
+    for regex, weight in COMPILED_CUES:
+        if regex.search(text):
+            clean *= 1 - weight
+    return 1 - clean
+
+
+class TierStats:
+    '''
+    How often a tier ran, what it decided, and how long it took.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.outcomes = {}
+        self.total_latency = 0.0
+
+    def record(self, outcome, started):
+        elapsed = time.perf_counter() - started
+        self.calls += 1
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        self.total_latency += elapsed
+        metrics.TIER_DECISIONS.observe(elapsed, tier=self.name, outcome=outcome)
+
+    def summary(self):
+        if not self.calls:
+            return f"{self.name}: not run yet"
+        outcomes = ", ".join(f"{outcome} {count / self.calls:.0%}" for outcome, count in sorted(self.outcomes.items()))
+        return f"{self.name}: {self.calls} call(s), {outcomes}, avg {self.total_latency / self.calls * 1000:.1f}ms"
@@ -0,0 +1,412 @@
+'''
+Offline evaluation of the detection tiers on a labeled dataset, without Discord.
+
+Each line of the dataset is "LABEL<TAB>message". LABEL is a SpecificAbuseType value (e.g. SCAM,
+CHILD_GROOMING), OTHER, or NONE for a message that breaks no rule. Every message goes through the fingerprint
+index and then ClassificationPipeline.run_tiers itself: the local scorer, the latest local model in --db (if one
+was trained), Perspective within the pipeline's deadline, then the LLM in the chosen classification mode. A pool
+of workers scores the messages. The script then prints precision and recall per abuse type, and latency and cost
+per message.
+
+Results are appended to a JSONL checkpoint as they finish, so an interrupted run picks up where it stopped.
+API responses are cached in a SQLite file. LLM verdicts are keyed by the message and by a fingerprint of the
+prompts, models and triage settings. So a re-run after a threshold change costs nothing, while a prompt
+change is re-scored.
+
+    python evaluate.py p4dataset2024.txt --workers 8
+    python evaluate.py p4dataset2024.txt --tiers llm --mode cascade --output cascade.jsonl
+'''
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+import classifier
+import claude
+from classifier import CLASSIFICATION_MODES
+from claude import track_usage
+from db_writer import DBWriter, connect
+from detection import TIERS, TierStats
+from fingerprint import FingerprintIndex
+from local_model import LocalModel
+from migrations import migrate
+from perspective import PerspectiveClient, load_perspective_token
+from pipeline import MAX_CONCURRENT_CLASSIFICATIONS, PERSPECTIVE_DEADLINE, ClassificationPipeline
+from report import BroadAbuseType, SpecificAbuseType
+from verdict_cache import VerdictCache, content_hash
+
+NO_VIOLATION = "NONE"
+LABELS = {abuse_type.value for abuse_type in SpecificAbuseType} | {BroadAbuseType.OTHER.value, NO_VIOLATION}
+# Cached API responses are reused for this long; the fingerprint already invalidates them when prompts change
+EVAL_CACHE_TTL = 90 * 24 * 60 * 60
+EVAL_CACHE_SIZE = 100000
+# USD per million tokens, for the cost estimate; cache writes cost 1.25x and cache reads 0.1x the input price
+MODEL_PRICES = {
+    "claude-3-haiku-20240307": {"input": 0.25, "output": 1.25},
+    "claude-3-opus-20240229": {"input": 15.0, "output": 75.0},
+}
+# Perspective blocks a message without saying which kind of abuse it is
+UNTYPED = "(untyped)"
+# Every dataset line is posted by the same user in the same guild, so near-copies share a fingerprint cluster
+EVAL_GUILD_ID = 0
+EVAL_AUTHOR_ID = 1
+
+# The result dict of the message the current worker is evaluating, filled in by the cache, tier stats and sink
+current_result = contextvars.ContextVar("current_result")
+
+
+def read_dataset(path):
+    '''
+    Yields (index, label, text) for each usable line; lines with an unknown label are reported and skipped.
+    '''
+    with open(path, encoding='utf-8') as f:
+        for index, line in enumerate(f):
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            label, _, text = line.partition('\t')
+            label = label.strip().upper() or NO_VIOLATION
+            if label not in LABELS or not text.strip():
+                print(f"Skipping line {index + 1}: expected LABEL<TAB>message with LABEL one of {', '.join(sorted(LABELS))}")
+                continue
+            yield index, label, text
+
+
+def load_checkpoint(path):
+    '''
+    Returns the results already in the checkpoint, by dataset line index.
+    '''
+    results = {}
+    if not os.path.isfile(path):
+        return results
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may have been cut off when the previous run was interrupted
+                continue
+            results[result["index"]] = result
+    return results
+
+
+def fingerprint(mode):
+    settings = {
+        "mode": mode,
+        "prompts": claude.PROMPTS,
+        "models": [claude.TRIAGE_MODEL, claude.ESCALATION_MODEL],
+        "tool": classifier.CLASSIFICATION_TOOL,
+        "triage": [classifier.ROUTE_TRIAGE, classifier.TRIAGE_CONFIDENCE],
+        "budget": [classifier.PROMPT_BUILDER.max_conversation_tokens, classifier.PROMPT_BUILDER.max_message_tokens],
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+def cost(models):
+    total = 0.0
+    for model, usage in models.items():
+        prices = MODEL_PRICES.get(model)
+        if prices is None:
+            continue
+        total += (usage["input_tokens"] * prices["input"] + usage["output_tokens"] * prices["output"]
+                  + usage["cache_creation_input_tokens"] * prices["input"] * 1.25
+                  + usage["cache_read_input_tokens"] * prices["input"] * 0.1) / 1_000_000
+    return total
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class EvaluationCache(VerdictCache):
+    '''
+    The VerdictCache the pipeline runs with during an evaluation. Entries are kept for EVAL_CACHE_TTL, LLM
+    namespaces are suffixed with the settings fingerprint, and each LLM value is stored with the calls, token
+    usage and latency it took, so a cached verdict still counts towards the cost. What each lookup cost is added to
+    the result of the message being evaluated.
+    '''
+
+    def __init__(self, fingerprint, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fingerprint = fingerprint
+
+    async def get_or_compute(self, namespace, key, compute, ttl=None):
+        result = current_result.get()
+        if not namespace.startswith("llm:"):
+            async def counted():
+                result["perspective_calls"] += 1
+                result["fresh"] = True
+                return await compute()
+
+            return await super().get_or_compute(namespace, key, counted, EVAL_CACHE_TTL)
+
+        async def measured():
+            result["fresh"] = result["llm_fresh"] = True
+            started = time.perf_counter()
+            with track_usage() as usage:
+                value = await compute()
+            return {"value": value, "api_calls": usage["calls"], "models": usage["models"],
+                    "latency": time.perf_counter() - started}
+
+        response = await super().get_or_compute(f"{namespace}:{self.fingerprint}", key, measured, EVAL_CACHE_TTL)
+        result["api_calls"] += response["api_calls"]
+        for model, usage in response["models"].items():
+            totals = result["models"].setdefault(model, dict.fromkeys(usage, 0))
+            for field, count in usage.items():
+                totals[field] += count
+        result["llm_latency"] = result.get("llm_latency", 0) + response["latency"]
+        return response["value"]
+
+
+class EvaluationTierStats(TierStats):
+    '''
+    TierStats that also note, in the result of the message being evaluated, the last tier that ran and what it
+    decided: the tier that decided the message.
+    '''
+
+    def record(self, outcome, started):
+        super().record(outcome, started)
+        current_result.get().update(tier=self.name, outcome=outcome)
+
+
+class RecordingSink:
+    '''
+    Stands in for the bot as the pipeline's sink: decisions are written to the result of the message being
+    evaluated instead of acted on. Violations are marked in the fingerprint index, as the bot does.
+    '''
+
+    def __init__(self, fingerprints):
+        self.fingerprints = fingerprints
+
+    async def block_message(self, message, notice, violation):
+        self.fingerprints.mark_violation(message.guild.id, message.content, violation)
+        current_result.get().update(violation=True, predicted=UNTYPED)
+
+    async def report_message(self, message, verdict):
+        if verdict.per_message:
+            self.fingerprints.mark_violation(message.guild.id, message.content,
+                                             verdict.specific_abuse_type or "a violation")
+        predicted = verdict.specific_abuse_type.value if verdict.specific_abuse_type is not None else UNTYPED
+        current_result.get().update(violation=True, predicted=predicted)
+
+    async def forward_message(self, message, notice):
+        current_result.get().update(violation=True, predicted=UNTYPED)
+
+
+class Evaluator:
+    '''
+    Runs one message through the fingerprint index and ClassificationPipeline.run_tiers, as the bot does after
+    its regex rules (which are per guild, so not part of an evaluation). With `perspective` None, every message
+    goes straight to the pipeline's LLM tier. API responses go through an EvaluationCache backed by `cache_path`.
+    '''
+
+    def __init__(self, mode, cache_path, perspective=None, local_model=None, concurrency=MAX_CONCURRENT_CLASSIFICATIONS,
+                 perspective_deadline=PERSPECTIVE_DEADLINE):
+        self.perspective = perspective
+        conn = connect(cache_path)
+        migrate(conn)
+        self.writer = DBWriter(cache_path)
+        self.cache = EvaluationCache(fingerprint(mode), EVAL_CACHE_SIZE, EVAL_CACHE_TTL, conn=conn, writer=self.writer)
+        self.tier_stats = {tier: EvaluationTierStats(tier) for tier in TIERS}
+        self.fingerprints = FingerprintIndex()
+        # Every message is judged on its own: the dataset lines aren't one conversation
+        self.pipeline = ClassificationPipeline(
+            RecordingSink(self.fingerprints), perspective, self.cache, self.tier_stats, local_model, mode,
+            batch_max_messages=1, max_concurrent=concurrency, perspective_deadline=perspective_deadline)
+
+    async def close(self):
+        if self.perspective is not None:
+            await self.perspective.close()
+        self.writer.close()
+
+    async def evaluate(self, index, text):
+        result = {"tier": None, "outcome": None, "violation": False, "predicted": None, "api_calls": 0,
+                  "perspective_calls": 0, "fresh": False, "models": {}}
+        current_result.set(result)
+        message = SimpleNamespace(id=index, content=text, author=SimpleNamespace(id=EVAL_AUTHOR_ID, name="user"),
+                                  guild=SimpleNamespace(id=EVAL_GUILD_ID), channel=None)
+        messages = [(EVAL_AUTHOR_ID, text, message)]
+
+        if self.perspective is None:
+            await self.pipeline.classify_alone(message, messages)
+        else:
+            started = time.perf_counter()
+            cluster = self.fingerprints.add(EVAL_GUILD_ID, EVAL_AUTHOR_ID, text)
+            if cluster is not None and cluster.violation is not None:
+                self.tier_stats["fingerprint"].record("block", started)
+                typed = isinstance(cluster.violation, (SpecificAbuseType, BroadAbuseType))
+                result.update(violation=True, predicted=cluster.violation.value if typed else UNTYPED)
+                return result
+            self.tier_stats["fingerprint"].record("pass", started)
+            await self.pipeline.run_tiers(message, messages)
+
+        if result["tier"] == "llm" and result["outcome"] in ("error", "fallback"):
+            # Not checkpointed, so the next run asks the LLM again
+            raise RuntimeError("the LLM could not judge the message")
+        return result
+
+
+async def run(args):
+    perspective = None
+    if args.tiers == "all":
+        try:
+            perspective = PerspectiveClient(load_perspective_token(args.tokens), qps=args.perspective_qps)
+        except Exception as e:
+            sys.exit(f"{e} Use --tiers llm to evaluate the LLM alone.")
+    local_model = None
+    if args.tiers == "all" and os.path.isfile(args.db):
+        conn = connect(args.db)
+        migrate(conn)
+        local_model = LocalModel.latest(conn)
+        conn.close()
+    evaluator = Evaluator(args.mode, args.cache, perspective, local_model, args.workers, args.perspective_deadline)
+
+    results = load_checkpoint(args.output)
+    resumed = len(results)
+    # Line indices scored in this run rather than read from the checkpoint
+    scored = set()
+    queue = asyncio.Queue(maxsize=args.workers * 4)
+    errors = []
+    started = time.perf_counter()
+
+    async def produce():
+        count = 0
+        for index, label, text in read_dataset(args.dataset):
+            if args.limit and count >= args.limit:
+                break
+            count += 1
+            # Lines already in the checkpoint are skipped unless the text changed since
+            done = results.get(index)
+            if done is not None and done["hash"] == content_hash(text):
+                continue
+            await queue.put((index, label, text))
+        for _ in range(args.workers):
+            await queue.put(None)
+
+    async def work(checkpoint):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            index, label, text = item
+            item_started = time.perf_counter()
+            try:
+                result = await evaluator.evaluate(index, text)
+            except Exception as e:
+                # Not checkpointed, so the next run retries it
+                errors.append((index, repr(e)))
+                continue
+            result.update(index=index, hash=content_hash(text), label=label,
+                          latency=time.perf_counter() - item_started)
+            results[index] = result
+            scored.add(index)
+            checkpoint.write(json.dumps(result) + "\n")
+            checkpoint.flush()
+            if len(scored) % args.progress == 0:
+                print(f"Scored {len(scored)} message(s), {len(scored) / (time.perf_counter() - started):.1f}/sec")
+
+    try:
+        with open(args.output, "a", encoding='utf-8') as checkpoint:
+            await asyncio.gather(produce(), *(work(checkpoint) for _ in range(args.workers)))
+    finally:
+        await evaluator.close()
+
+    if not results:
+        sys.exit(f"No labeled messages in {args.dataset}")
+    print_summary(list(results.values()), scored, errors, time.perf_counter() - started)
+
+
+def print_summary(results, scored, errors, elapsed):
+    def predicted(result):
+        return result["predicted"] if result["violation"] else NO_VIOLATION
+
+    new = [result for result in results if result["index"] in scored]
+    fresh = [result for result in new if result["fresh"]]
+    print(f"Messages:            {len(results)} ({len(results) - len(new)} from the checkpoint, "
+          f"{len(fresh)} needed an API call, "
+          f"{len(errors)} failed) in {elapsed:.1f}s")
+    for index, error in errors[:5]:
+        print(f"  line {index + 1}: {error}")
+
+    true_positives = sum(1 for result in results if result["violation"] and result["label"] != NO_VIOLATION)
+    flagged = sum(1 for result in results if result["violation"])
+    violations = sum(1 for result in results if result["label"] != NO_VIOLATION)
+    print(f"Any violation:       precision {true_positives / flagged if flagged else 0:.3f}, "
+          f"recall {true_positives / violations if violations else 0:.3f} ({violations} labeled, {flagged} flagged)")
+
+    labels = sorted(({result["label"] for result in results} | {predicted(result) for result in results})
+                    - {NO_VIOLATION, UNTYPED})
+    print(f"{'Abuse type':<22} {'support':>8} {'precision':>10} {'recall':>8} {'f1':>6}")
+    for label in labels:
+        support = sum(1 for result in results if result["label"] == label)
+        predicted_count = sum(1 for result in results if predicted(result) == label)
+        correct = sum(1 for result in results if result["label"] == label and predicted(result) == label)
+        precision = correct / predicted_count if predicted_count else 0
+        recall = correct / support if support else 0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0
+        print(f"{label:<22} {support:>8} {precision:>10.3f} {recall:>8.3f} {f1:>6.3f}")
+    untyped = sum(1 for result in results if predicted(result) == UNTYPED)
+    if untyped:
+        print(f"{untyped} message(s) were flagged without an abuse type (Perspective blocks) and count as misses above")
+
+    tiers = {}
+    for result in results:
+        tiers[result["tier"]] = tiers.get(result["tier"], 0) + 1
+    print("Decided by:          " + ", ".join(f"{tier} {count / len(results):.0%}" for tier, count in sorted(tiers.items())))
+
+    latencies = [result["latency"] for result in new]
+    llm_latencies = [result["llm_latency"] for result in results if "llm_latency" in result]
+    if latencies:
+        print(f"Latency per message: p50 {percentile(latencies, 50) * 1000:.1f}ms, "
+              f"p95 {percentile(latencies, 95) * 1000:.1f}ms in this run, cached responses included")
+    if llm_latencies:
+        print(f"LLM latency:         p50 {percentile(llm_latencies, 50):.2f}s, p95 {percentile(llm_latencies, 95):.2f}s "
+              f"as measured when each verdict was first computed")
+
+    total_cost = sum(cost(result["models"]) for result in results)
+    spent = sum(cost(result["models"]) for result in fresh if result["api_calls"])
+    api_calls = sum(result["api_calls"] for result in results)
+    tokens = {}
+    for result in results:
+        for model, usage in result["models"].items():
+            tokens.setdefault(model, [0, 0])
+            tokens[model][0] += usage["input_tokens"] + usage["cache_creation_input_tokens"] + usage["cache_read_input_tokens"]
+            tokens[model][1] += usage["output_tokens"]
+    print(f"LLM calls:           {api_calls} ({api_calls / len(results):.3f}/message), "
+          f"Perspective calls this run: {sum(result['perspective_calls'] for result in new)}")
+    for model, (input_tokens, output_tokens) in sorted(tokens.items()):
+        print(f"  {model}: {input_tokens / len(results):.0f} input and {output_tokens / len(results):.1f} output tokens/message")
+    print(f"Cost:                ${total_cost / len(results) * 1000:.4f} per 1000 messages, "
+          f"${spent:.4f} spent on this run")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the detection tiers on a labeled dataset.")
+    parser.add_argument("dataset", help="file with one LABEL<TAB>message per line")
+    parser.add_argument("--mode", choices=CLASSIFICATION_MODES, default="structured")
+    parser.add_argument("--tiers", choices=["all", "llm"], default="all",
+                        help="run the fingerprint index and every pipeline tier like the bot, or send everything to the LLM")
+    parser.add_argument("--workers", type=int, default=8, help="messages scored at the same time")
+    parser.add_argument("--output", default="evaluation.jsonl", help="checkpoint with one result per line")
+    parser.add_argument("--cache", default="evaluation_cache.db", help="SQLite file for cached API responses")
+    parser.add_argument("--tokens", default="tokens.json", help="tokens.json with the Perspective key")
+    parser.add_argument("--perspective-qps", type=float, default=1)
+    parser.add_argument("--perspective-deadline", type=float, default=PERSPECTIVE_DEADLINE,
+                        help="seconds the pipeline waits for a Perspective score; the bot's deadline by default, "
+                             "raise it when the quota is below the rate messages are scored at")
+    parser.add_argument("--db", default="modbot.db", help="the bot's database, for the latest local model")
+    parser.add_argument("--limit", type=int, default=0, help="only the first N labeled messages")
+    parser.add_argument("--progress", type=int, default=100, help="print progress every N messages")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import collections
+import hashlib
+import itertools
+import re
+import struct
+import time
+
+# MinHash signatures of NUM_HASHES 16-bit values over the character 4-grams of a message. For LSH the signature
+# is split into BANDS bands; two messages share a bucket when a whole band matches, which with 8 bands of 4 values
+# happens ~65% of the time at 60% shingle overlap and ~99% at 80%. Candidates are confirmed when the share of
+# equal signature values (an estimate of the overlap) is at least SIMILARITY.
+NUM_HASHES = 32
+BANDS = 8
+ROWS = NUM_HASHES // BANDS
+SIMILARITY = 0.6
+SHINGLE_SIZE = 4
+# Short messages ("lol", "gm everyone") are repeated innocently all the time
+MIN_LENGTH = 20
+RAID_WINDOW = 5 * 60
+RAID_ACCOUNTS = 8
+MAX_CLUSTERS = 10000
+SIGNATURE_FORMAT = struct.Struct(f"<{NUM_HASHES}H")
+
+
+def normalize(text):
+    return " ".join(re.sub(r"[^\w\s]", " ", text.casefold()).split())
+
+
+def minhash(text):
+    '''
+    MinHash signature of the normalized text, or None if the text is too short to tell a raid copy from a
+    coincidence. One 64-byte BLAKE2 digest per shingle supplies all 32 hash values.
+    '''
+    normalized = normalize(text)
+    if len(normalized) < MIN_LENGTH:
+        return None
+    shingles = {normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+    hashes = [SIGNATURE_FORMAT.unpack(hashlib.blake2b(shingle.encode('utf-8'), digest_size=64).digest())
+              for shingle in shingles]
+    return tuple(map(min, zip(*hashes)))
+
+
+def similarity(a, b):
+    return sum(x == y for x, y in zip(a, b)) / NUM_HASHES
+
+
+def bands(signature):
+    return [(band, signature[band * ROWS:(band + 1) * ROWS]) for band in range(BANDS)]
+
+
+class Cluster:
+    '''
+    Near-copies of one message seen in a guild within the window, keyed by the signature of the first copy.
+    '''
+
+    def __init__(self, cluster_id, signature, text):
+        self.id = cluster_id
+        self.signature = signature
+        self.text = text
+        self.members = collections.deque()  # (time, author id)
+        # What a copy was judged to be, once one has been found in violation
+        self.violation = None
+        self.raid_alerted = False
+
+    def accounts(self):
+        return len({author_id for _, author_id in self.members})
+
+    def last_seen(self):
+        return self.members[-1][0]
+
+
+class FingerprintIndex:
+    '''
+    Groups each guild's recent messages into clusters of near-copies, so a spam raid (the same text with small
+    changes, posted from many accounts) is caught locally.
+
+    Clusters older than `window` seconds are dropped. Once a copy is judged a violation, later copies are flagged
+    straight away, and a cluster that reaches `raid_accounts` distinct authors raises one raid alert. A lookup is
+    a MinHash signature plus a few dictionary probes, so it costs microseconds rather than an API call.
+    '''
+
+    def __init__(self, window=RAID_WINDOW, raid_accounts=RAID_ACCOUNTS, max_clusters=MAX_CLUSTERS):
+        self.window = window
+        self.raid_accounts = raid_accounts
+        self.max_clusters = max_clusters
+        self.ids = itertools.count()
+        self.clusters = {}  # guild id -> OrderedDict of cluster id -> Cluster, least recently active first
+        self.buckets = {}   # guild id -> {(band, value): set of cluster ids}
+
+    def find(self, guild_id, signature):
+        clusters = self.clusters.get(guild_id, {})
+        buckets = self.buckets.get(guild_id, {})
+        best, best_similarity = None, SIMILARITY
+        seen = set()
+        for key in bands(signature):
+            for cluster_id in buckets.get(key, ()):
+                if cluster_id in seen:
+                    continue
+                seen.add(cluster_id)
+                cluster = clusters[cluster_id]
+                overlap = similarity(signature, cluster.signature)
+                if overlap >= best_similarity:
+                    best, best_similarity = cluster, overlap
+        return best
+
+    def add(self, guild_id, author_id, text, now=None):
+        '''
+        Adds the message to its cluster, starting a new one if it is not a near-copy of anything recent.
+        Returns the cluster, or None for messages too short to fingerprint.
+        '''
+        signature = minhash(text)
+        if signature is None:
+            return None
+        now = now if now is not None else time.time()
+        self.expire(guild_id, now)
+
+        cluster = self.find(guild_id, signature)
+        clusters = self.clusters.setdefault(guild_id, collections.OrderedDict())
+        if cluster is None:
+            cluster = Cluster(next(self.ids), signature, text)
+            clusters[cluster.id] = cluster
+            buckets = self.buckets.setdefault(guild_id, {})
+            for key in bands(signature):
+                buckets.setdefault(key, set()).add(cluster.id)
+            while len(clusters) > self.max_clusters:
+                self.remove(guild_id, next(iter(clusters.values())))
+        else:
+            clusters.move_to_end(cluster.id)
+            # Copies older than the window no longer count towards a raid
+            while cluster.members and cluster.members[0][0] < now - self.window:
+                cluster.members.popleft()
+        cluster.members.append((now, author_id))
+        return cluster
+
+    def mark_violation(self, guild_id, text, description):
+        '''
+        Records that a message was judged a violation, so its near-copies are flagged without another check.
+        '''
+        signature = minhash(text)
+        if signature is None:
+            return
+        cluster = self.find(guild_id, signature)
+        if cluster is not None and cluster.violation is None:
+            cluster.violation = description
+
+    def raid_alert_due(self, cluster):
+        '''
+        True the first time the cluster's copies come from `raid_accounts` different authors.
+        '''
+        if cluster.raid_alerted or len(cluster.members) < self.raid_accounts:
+            return False
+        if cluster.accounts() < self.raid_accounts:
+            return False
+        cluster.raid_alerted = True
+        return True
+
+    def expire(self, guild_id, now):
+        clusters = self.clusters.get(guild_id)
+        if not clusters:
+            return
+        cutoff = now - self.window
+        while clusters:
+            cluster = next(iter(clusters.values()))
+            if cluster.last_seen() >= cutoff:
+                break
+            self.remove(guild_id, cluster)
+
+    def remove(self, guild_id, cluster):
+        self.clusters[guild_id].pop(cluster.id, None)
+        buckets = self.buckets[guild_id]
+        for key in bands(cluster.signature):
+            members = buckets.get(key)
+            if members is not None:
+                members.discard(cluster.id)
+                if not members:
+                    del buckets[key]
+
+    def __len__(self):
+        return sum(len(clusters) for clusters in self.clusters.values())
@@ -0,0 +1,127 @@
+import time
+
+# Mod channel ids of guilds on other processes' shards are read from guild_channels again after this long
+REMOTE_MAX_AGE = 60
+
+MOD_CHANNEL_SQL = 'SELECT mod_channel_id FROM guild_channels WHERE guild_id = ?'
+
+
+class GuildChannels:
+    '''
+    The channels the bot uses in one guild: where moderators work, and which channels (and their threads) have
+    their messages checked.
+    '''
+
+    def __init__(self, mod_channel_id=None, monitored_channel_ids=()):
+        self.mod_channel_id = mod_channel_id
+        self.monitored_channel_ids = set(monitored_channel_ids)
+
+
+class GuildRegistry:
+    '''
+    Mod and monitored channel ids per guild, so deciding what to do with a message is a dict lookup and an id
+    comparison instead of matching channel names.
+
+    A guild's channels are found by name (mod_name, monitored_name) once, when the guild becomes available, and
+    then kept up to date from channel create, update and delete events. Entries in config.json take precedence
+    over what was found by name. Mod channel ids are saved to the guild_channels table, so that processes
+    running other shards can post to them.
+
+    Reads use `conn`; every write goes through the DBWriter.
+    '''
+
+    def __init__(self, conn, writer, mod_name=None, monitored_name=None):
+        self.conn = conn
+        self.writer = writer
+        self.mod_name = mod_name
+        self.monitored_name = monitored_name
+        self.found = {}  # guild id -> GuildChannels found by name
+        self.overrides = {}  # guild id -> channel overrides from config.json
+        self.guilds = {}  # guild id -> GuildChannels in effect
+        self.remote = {}  # guild id -> (loaded at, mod channel id) for guilds this process doesn't see
+
+    def set_names(self, mod_name, monitored_name):
+        self.mod_name = mod_name
+        self.monitored_name = monitored_name
+
+    def get(self, guild_id):
+        return self.guilds.get(guild_id)
+
+    def scan_guild(self, guild):
+        entry = GuildChannels()
+        for channel in guild.text_channels:
+            if channel.name == self.mod_name:
+                entry.mod_channel_id = channel.id
+            elif channel.name == self.monitored_name:
+                entry.monitored_channel_ids.add(channel.id)
+        self.found[guild.id] = entry
+        self.update(guild.id)
+
+    def add_channel(self, channel):
+        if channel.name != self.mod_name and channel.name != self.monitored_name:
+            return
+        entry = self.found.setdefault(channel.guild.id, GuildChannels())
+        if channel.name == self.mod_name:
+            entry.mod_channel_id = channel.id
+        else:
+            entry.monitored_channel_ids.add(channel.id)
+        self.update(channel.guild.id)
+
+    def remove_channel(self, channel):
+        entry = self.found.get(channel.guild.id)
+        if entry is None:
+            return
+        if entry.mod_channel_id == channel.id:
+            entry.mod_channel_id = None
+        entry.monitored_channel_ids.discard(channel.id)
+        self.update(channel.guild.id)
+
+    def rename_channel(self, before, after):
+        if before.name != after.name:
+            self.remove_channel(before)
+            self.add_channel(after)
+
+    def remove_guild(self, guild_id):
+        self.found.pop(guild_id, None)
+        if self.guilds.pop(guild_id, None) is not None:
+            self.writer.submit(lambda db: db.execute('DELETE FROM guild_channels WHERE guild_id = ?', (guild_id,)))
+
+    def set_overrides(self, overrides):
+        changed = set(self.overrides) | set(overrides)
+        self.overrides = overrides
+        for guild_id in changed:
+            if guild_id in self.found:
+                self.update(guild_id)
+        self.remote.clear()
+
+    def update(self, guild_id):
+        found = self.found[guild_id]
+        override = self.overrides.get(guild_id, {})
+        entry = GuildChannels(override.get("mod_channel_id", found.mod_channel_id),
+                              override.get("monitored_channel_ids", found.monitored_channel_ids))
+        previous = self.guilds.get(guild_id)
+        self.guilds[guild_id] = entry
+        if previous is None or previous.mod_channel_id != entry.mod_channel_id:
+            row = (guild_id, entry.mod_channel_id, time.time())
+            self.writer.submit(save_guild_channels, [row])
+
+    def mod_channel_id(self, guild_id):
+        '''
+        The guild's mod channel id, or None if it has none. A guild on another process's shards is looked up in
+        the guild_channels table.
+        '''
+        entry = self.guilds.get(guild_id)
+        if entry is not None:
+            return entry.mod_channel_id
+        cached = self.remote.get(guild_id)
+        if cached is None or time.monotonic() - cached[0] > REMOTE_MAX_AGE:
+            row = self.conn.execute(MOD_CHANNEL_SQL, (guild_id,)).fetchone()
+            cached = self.remote[guild_id] = (time.monotonic(), row[0] if row is not None else None)
+        return cached[1]
+
+
+def save_guild_channels(db, rows):
+    db.executemany('''
+    INSERT INTO guild_channels (guild_id, mod_channel_id, updated_at) VALUES (?, ?, ?)
+    ON CONFLICT (guild_id) DO UPDATE SET mod_channel_id = excluded.mod_channel_id, updated_at = excluded.updated_at
+    ''', rows)
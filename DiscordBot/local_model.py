@@ -0,0 +1,324 @@
+'''
+A small violation classifier that runs in-process: hashed word and character n-gram features and logistic
+regression, trained from past moderation outcomes and the labeled dataset.
+
+Training data:
+- Reports a moderator acted on are violations, and reports they dismissed (no action taken) are not.
+- Reports nobody has moderated yet count as violations at REPORT_WEIGHT.
+- Every line of the dataset (LABEL<TAB>message, see evaluate.py) counts, with NONE as the clean label.
+
+Each training run stores a new version of the model in the local_models table, together with its holdout
+metrics. By default a run continues from the latest version: it learns from the reports and moderations added
+since, together with a random sample of older examples of each class, and the new version is only saved if it
+does at least as well on the holdout as the one it continued from. --full retrains from scratch.
+
+    python local_model.py train --dataset p4dataset2024.txt
+    python local_model.py train --full
+    python local_model.py list
+    python local_model.py score "free nitro at http://example.com"
+'''
+import argparse
+import array
+import hashlib
+import json
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+import zlib
+from fingerprint import normalize
+from migrations import migrate
+
+FEATURE_BITS = 18
+FEATURE_MASK = (1 << FEATURE_BITS) - 1
+CHAR_GRAM = 4
+# Weight of a report nobody has moderated yet, relative to a moderator's decision or a dataset label
+REPORT_WEIGHT = 0.5
+LEARNING_RATE = 0.2
+L2 = 1e-6
+EPOCHS = 5
+# A continued run makes fewer passes over only the new examples and the replayed ones
+INCREMENTAL_EPOCHS = 2
+# New rows are mostly reports, i.e. violations, so a continued run also replays up to this many older examples
+# of each class; otherwise every run would push the model further towards flagging everything
+REPLAY_PER_CLASS = 500
+# Share of examples held out to measure each version, chosen by a hash of the text so it is stable across runs
+HOLDOUT = 0.1
+# Below this many examples of either class, a model would only learn the class balance
+MIN_EXAMPLES_PER_CLASS = 20
+
+
+def features(text):
+    '''
+    Indices of the hashed features: words, word pairs and character 4-grams of the normalized text.
+    '''
+    normalized = normalize(text)
+    words = normalized.split()
+    grams = words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+    padded = f" {normalized} "
+    grams += ["#" + padded[i:i + CHAR_GRAM] for i in range(len(padded) - CHAR_GRAM + 1)]
+    return {zlib.crc32(gram.encode('utf-8')) & FEATURE_MASK for gram in grams}
+
+
+def sigmoid(z):
+    if z < -30:
+        return 0.0
+    return 1 / (1 + math.exp(-z))
+
+
+class LocalModel:
+    '''
+    Logistic regression over hashed binary features. Each feature counts 1/sqrt(n) for a message with n
+    features, so long messages don't saturate the score. Scoring a message takes tens of microseconds.
+    '''
+
+    def __init__(self, weights=None, bias=0.0, version=None, info=None):
+        self.weights = weights if weights is not None else array.array('d', bytes(8 << FEATURE_BITS))
+        self.bias = bias
+        self.version = version
+        self.info = info or {}
+
+    def linear(self, indices):
+        if not indices:
+            return self.bias
+        weights = self.weights
+        return self.bias + sum(weights[i] for i in indices) / math.sqrt(len(indices))
+
+    def score(self, text):
+        '''
+        Probability that the message violates the policy.
+        '''
+        return sigmoid(self.linear(features(text)))
+
+    def fit(self, examples, epochs=EPOCHS, learning_rate=LEARNING_RATE, seed=152):
+        '''
+        SGD over (feature indices, label, weight) examples, starting from the current weights. The two classes
+        are weighted to count equally.
+        '''
+        positives = sum(weight for _, label, weight in examples if label)
+        negatives = sum(weight for _, label, weight in examples if not label)
+        balance = {True: (positives + negatives) / (2 * positives) if positives else 1,
+                   False: (positives + negatives) / (2 * negatives) if negatives else 1}
+        examples = list(examples)
+        rng = random.Random(seed)
+        weights = self.weights
+        for epoch in range(epochs):
+            rng.shuffle(examples)
+            rate = learning_rate / (1 + epoch)
+            for indices, label, weight in examples:
+                if not indices:
+                    continue
+                scale = 1 / math.sqrt(len(indices))
+                gradient = (sigmoid(self.linear(indices)) - label) * weight * balance[label]
+                self.bias -= rate * gradient
+                for i in indices:
+                    weights[i] -= rate * (gradient * scale + L2 * weights[i])
+
+    def evaluate(self, examples, threshold=0.5):
+        counts = {"tp": 0, "fp": 0, "fn": 0, "tn": 0}
+        for indices, label, _ in examples:
+            flagged = sigmoid(self.linear(indices)) >= threshold
+            counts[("t" if flagged == label else "f") + ("p" if flagged else "n")] += 1
+        flagged = counts["tp"] + counts["fp"]
+        violations = counts["tp"] + counts["fn"]
+        precision = counts["tp"] / flagged if flagged else 0
+        recall = counts["tp"] / violations if violations else 0
+        return {
+            "examples": len(examples),
+            "accuracy": (counts["tp"] + counts["tn"]) / len(examples) if examples else 0,
+            "precision": precision,
+            "recall": recall,
+            "f1": 2 * precision * recall / (precision + recall) if precision + recall else 0,
+        }
+
+    def save(self, conn, parent_version, examples, through_report_id, through_moderation_id, dataset_hash, metrics):
+        blob = zlib.compress(array.array('f', self.weights).tobytes())
+        cursor = conn.execute('''
+        INSERT INTO local_models (parent_version, created_at, examples, through_report_id, through_moderation_id,
+                                  dataset_hash, metrics, weights)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (parent_version, time.time(), examples, through_report_id, through_moderation_id, dataset_hash,
+              json.dumps(dict(metrics, bias=self.bias)), blob))
+        conn.commit()
+        self.version = cursor.lastrowid
+        return self.version
+
+    @classmethod
+    def latest(cls, conn):
+        '''
+        The newest stored version, or None if no model has been trained yet.
+        '''
+        row = conn.execute('''
+        SELECT version, through_report_id, through_moderation_id, dataset_hash, metrics, weights
+        FROM local_models ORDER BY version DESC LIMIT 1
+        ''').fetchone()
+        if row is None:
+            return None
+        version, through_report_id, through_moderation_id, dataset_hash, metrics, blob = row
+        metrics = json.loads(metrics)
+        weights = array.array('f')
+        weights.frombytes(zlib.decompress(blob))
+        info = {"through_report_id": through_report_id, "through_moderation_id": through_moderation_id,
+                "dataset_hash": dataset_hash, "metrics": metrics}
+        return cls(array.array('d', weights), metrics.get("bias", 0.0), version, info)
+
+
+def latest_version(conn):
+    return conn.execute('SELECT MAX(version) FROM local_models').fetchone()[0]
+
+
+def moderation_examples(conn, after_report_id=0, after_moderation_id=0):
+    '''
+    (text, label, weight) for reports and moderations newer than the given ids, plus the highest ids seen.
+    '''
+    rows = conn.execute('''
+    SELECT r.report_id, r.reported_content, m.moderation_id, m.action_taken
+    FROM reports r LEFT JOIN moderations m ON m.report_id = r.report_id
+    WHERE r.reported_content IS NOT NULL AND r.reported_content != ''
+      AND (r.report_id > ? OR m.moderation_id > ?)
+    ''', (after_report_id, after_moderation_id)).fetchall()
+    examples = []
+    through_report_id, through_moderation_id = after_report_id, after_moderation_id
+    for report_id, content, moderation_id, action_taken in rows:
+        through_report_id = max(through_report_id, report_id)
+        if moderation_id is not None:
+            through_moderation_id = max(through_moderation_id, moderation_id)
+        examples.append(moderation_example(content, moderation_id, action_taken))
+    return examples, through_report_id, through_moderation_id
+
+
+def history_examples(conn, through_report_id, through_moderation_id):
+    '''
+    (text, label, weight) for the reports and moderations up to the given ids, i.e. those a model trained
+    through them has already learned from.
+    '''
+    rows = conn.execute('''
+    SELECT r.reported_content, m.moderation_id, m.action_taken
+    FROM reports r LEFT JOIN moderations m ON m.report_id = r.report_id
+    WHERE r.reported_content IS NOT NULL AND r.reported_content != ''
+      AND r.report_id <= ? AND (m.moderation_id IS NULL OR m.moderation_id <= ?)
+    ''', (through_report_id, through_moderation_id)).fetchall()
+    return [moderation_example(content, moderation_id, action_taken) for content, moderation_id, action_taken in rows]
+
+
+def moderation_example(content, moderation_id, action_taken):
+    if moderation_id is None:
+        return content, True, REPORT_WEIGHT
+    return content, bool((action_taken or "").strip()), 1.0
+
+
+def replay_sample(examples, per_class, seed=152):
+    '''
+    Up to `per_class` examples of each class, picked at random.
+    '''
+    rng = random.Random(seed)
+    sample = []
+    for label in (True, False):
+        matching = [example for example in examples if example[1] == label]
+        sample += rng.sample(matching, min(per_class, len(matching)))
+    return sample
+
+
+def dataset_examples(path):
+    # evaluate.py runs the pipeline, which loads this module
+    from evaluate import NO_VIOLATION, read_dataset
+    if not path or not os.path.isfile(path):
+        return [], None
+    with open(path, 'rb') as f:
+        dataset_hash = hashlib.sha256(f.read()).hexdigest()
+    return [(text, label != NO_VIOLATION, 1.0) for _, label, text in read_dataset(path)], dataset_hash
+
+
+def in_holdout(text):
+    return zlib.crc32(text.encode('utf-8')) % 1000 < HOLDOUT * 1000
+
+
+def train(conn, dataset=None, full=False):
+    '''
+    Trains and stores a new model version; returns it, or None if there was nothing (or too little) to learn or a
+    continued run did worse on the holdout than the version it continued from.
+    '''
+    parent = None if full else LocalModel.latest(conn)
+    info = parent.info if parent is not None else {}
+    examples, through_report_id, through_moderation_id = moderation_examples(
+        conn, info.get("through_report_id") or 0, info.get("through_moderation_id") or 0)
+    extra, dataset_hash = dataset_examples(dataset)
+    # A continued run only relearns the dataset if it changed; otherwise it is part of the history to replay
+    history = []
+    if parent is None or dataset_hash != info.get("dataset_hash"):
+        examples += extra
+    else:
+        history += extra
+    if not examples:
+        print("No new reports, moderations or dataset lines to learn from")
+        return None
+
+    encoded = [(features(text), label, weight, in_holdout(text)) for text, label, weight in examples]
+    training = [(indices, label, weight) for indices, label, weight, held_out in encoded if not held_out]
+    holdout = [(indices, label, weight) for indices, label, weight, held_out in encoded if held_out]
+    new_examples = len(training)
+    baseline = None
+    if parent is None:
+        positives = sum(1 for _, label, _ in training if label)
+        if min(positives, len(training) - positives) < MIN_EXAMPLES_PER_CLASS:
+            print(f"Need at least {MIN_EXAMPLES_PER_CLASS} violations and {MIN_EXAMPLES_PER_CLASS} clean messages "
+                  f"to train, have {positives} and {len(training) - positives}")
+            return None
+    else:
+        history += history_examples(conn, info.get("through_report_id") or 0, info.get("through_moderation_id") or 0)
+        encoded = [(features(text), label, weight, in_holdout(text)) for text, label, weight in history]
+        training += replay_sample([(indices, label, weight) for indices, label, weight, held_out in encoded
+                                   if not held_out], REPLAY_PER_CLASS)
+        # Both versions are measured on everything held out so far, not just on the new rows
+        holdout += [(indices, label, weight) for indices, label, weight, held_out in encoded if held_out]
+        baseline = parent.evaluate(holdout)
+
+    parent_version = parent.version if parent is not None else None
+    model = parent if parent is not None else LocalModel()
+    started = time.perf_counter()
+    model.fit(training, INCREMENTAL_EPOCHS if parent is not None else EPOCHS)
+    metrics = model.evaluate(holdout)
+    metrics["train_seconds"] = round(time.perf_counter() - started, 2)
+    if baseline is not None and metrics["f1"] < baseline["f1"]:
+        print(f"Not saved: holdout F1 {metrics['f1']:.3f} is below {baseline['f1']:.3f} for version {parent_version}, "
+              f"which stays the latest")
+        return None
+    version = model.save(conn, parent_version, len(training), through_report_id, through_moderation_id,
+                         dataset_hash or info.get("dataset_hash"), metrics)
+    print(f"Saved local model version {version} ({f'continued from {parent_version}' if parent else 'from scratch'}): "
+          f"{len(training)} training examples ({len(training) - new_examples} replayed), holdout {json.dumps(metrics)}")
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train and inspect the local violation classifier.")
+    parser.add_argument("command", choices=["train", "list", "score"])
+    parser.add_argument("text", nargs="?", help="message to score")
+    parser.add_argument("--db", default="modbot.db")
+    parser.add_argument("--dataset", default="p4dataset2024.txt", help="LABEL<TAB>message file to learn from too")
+    parser.add_argument("--full", action="store_true", help="retrain from scratch instead of continuing")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    migrate(conn)
+    if args.command == "train":
+        if train(conn, args.dataset, args.full) is None:
+            sys.exit(1)
+    elif args.command == "list":
+        for version, parent_version, created_at, examples, metrics in conn.execute(
+                'SELECT version, parent_version, created_at, examples, metrics FROM local_models ORDER BY version'):
+            print(f"v{version} (from {f'v{parent_version}' if parent_version else 'scratch'}) "
+                  f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(created_at))}: {examples} examples, {metrics}")
+    else:
+        model = LocalModel.latest(conn)
+        if model is None:
+            sys.exit("No local model trained yet")
+        started = time.perf_counter()
+        score = model.score(args.text or "")
+        print(f"v{model.version}: {score:.3f} ({(time.perf_counter() - started) * 1e6:.0f}us)")
+
+
+if __name__ == "__main__":
+    main()
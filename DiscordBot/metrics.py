@@ -0,0 +1,247 @@
+'''
+Prometheus-style metrics for the bot, served as text on a local /metrics endpoint.
+
+Counters, gauges and histograms are plain in-process objects; no Prometheus client library is needed. A metric
+can also be given a `collect` function, called on every scrape, for values that already live elsewhere (tier
+stats, cache counters, queue depth).
+
+If the opentelemetry package is installed and tracing is enabled, `span` also opens an OpenTelemetry span,
+so each message gets a trace with one child span per stage.
+'''
+import asyncio
+import bisect
+import contextlib
+import logging
+import threading
+import time
+from aiohttp import web
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+logger = logging.getLogger('discord')
+
+# Upper bounds in seconds, from a regex match to a slow LLM call
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500)
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # Optional function returning {label values tuple: value}, used instead of the stored values
+        self.collect = collect
+        self.values = {}
+        # Some metrics are updated from the database writer thread
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self):
+        values = self.collect() if self.collect is not None else self.values
+        for labels, value in sorted(values.items()):
+            yield self.name, labels, (), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            samples = list(self.samples())
+        for name, labels, extra, value in samples:
+            lines.append(f"{name}{format_labels(self.labelnames, labels, extra)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                # Per-bucket (not cumulative) counts, the sum and the count
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", labels, (("le", format_value(float(bound))),), cumulative
+            yield f"{self.name}_sum", labels, (), total
+            yield f"{self.name}_count", labels, (), count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        # Re-registering a name (e.g. a second ModBot in the same process) replaces the old metric
+        self.metrics = [existing for existing in self.metrics if existing.name != metric.name]
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=(), collect=None):
+        return self.register(Counter(name, help, labelnames, collect))
+
+    def gauge(self, name, help, labelnames=(), collect=None):
+        return self.register(Gauge(name, help, labelnames, collect))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        rendered = []
+        for metric in self.metrics:
+            try:
+                rendered.append(metric.render())
+            except Exception as e:
+                logger.error(f"Could not collect metric {metric.name}", exc_info=e)
+        return "\n".join(rendered) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_LATENCY = REGISTRY.histogram(
+    "modbot_stage_seconds", "Time spent in each stage of handling a message", ["stage"])
+TIER_DECISIONS = REGISTRY.histogram(
+    "modbot_tier_seconds", "Time each detection tier took, by the decision it made", ["tier", "outcome"])
+API_CALLS = REGISTRY.counter(
+    "modbot_api_calls_total", "Requests to external APIs", ["api", "outcome"])
+API_LATENCY = REGISTRY.histogram(
+    "modbot_api_seconds", "Latency of single external API requests", ["api", "model"])
+LLM_ROUTES = REGISTRY.counter(
+    "modbot_llm_routes_total", "Triage outcomes: cleared by the small model or escalated to the large one", ["kind", "route"])
+LLM_TOKENS = REGISTRY.counter(
+    "modbot_llm_tokens_total", "Tokens sent to and received from the LLM", ["model", "direction"])
+LOOP_LAG = REGISTRY.histogram(
+    "modbot_event_loop_lag_seconds", "How late the event loop woke up a sleeping task")
+DB_BATCH_SIZE = REGISTRY.histogram(
+    "modbot_db_batch_jobs", "Write jobs committed together in one transaction", buckets=SIZE_BUCKETS)
+DB_COMMIT_LATENCY = REGISTRY.histogram(
+    "modbot_db_commit_seconds", "Time to run and commit one batch of database writes")
+DB_WRITE_ERRORS = REGISTRY.counter(
+    "modbot_db_write_errors_total", "Database write jobs that failed and were rolled back")
+OUTBOUND_WAIT = REGISTRY.histogram(
+    "modbot_outbound_wait_seconds", "Time a Discord action waited in the outbound queue, by kind", ["kind"])
+
+tracing_enabled = False
+
+
+def enable_tracing():
+    global tracing_enabled
+    if trace is None:
+        logger.warning("opentelemetry is not installed, message tracing stays off")
+        return
+    tracing_enabled = True
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    '''
+    Opens an OpenTelemetry span when tracing is on; does nothing otherwise.
+    '''
+    if not tracing_enabled:
+        yield
+        return
+    with trace.get_tracer("modbot").start_as_current_span(name, attributes=attributes):
+        yield
+
+
+@contextlib.contextmanager
+def timed(stage, **attributes):
+    '''
+    Records how long the block took under `stage`, inside a span of the same name.
+    '''
+    with span(stage, **attributes), STAGE_LATENCY.time(stage=stage):
+        yield
+
+
+async def monitor_loop_lag(interval=0.5):
+    while True:
+        before = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - before - interval))
+
+
+class MetricsServer:
+    '''
+    Serves REGISTRY on http://host:port/metrics. Bind to localhost unless a scraper elsewhere needs it.
+    '''
+
+    def __init__(self, registry=REGISTRY, host="127.0.0.1", port=9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def handle_metrics(self, request):
+        return web.Response(text=self.registry.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Prometheus-Format": "0.0.4"})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        print(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
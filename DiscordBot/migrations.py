@@ -0,0 +1,285 @@
+'''
+Versioned schema for modbot.db.
+
+The schema version lives in PRAGMA user_version. Each migration runs once, in its own transaction, and bumps
+the version when it commits, so a crash half way through a migration leaves the database at the previous
+version. Add new migrations to the end of MIGRATIONS; never edit one that has shipped.
+
+    python migrations.py              # migrate modbot.db
+    python migrations.py --check      # migrate, then check the hot queries use indexes
+'''
+import argparse
+import sqlite3
+import sys
+
+
+def add_columns(conn, table, columns):
+    # Databases created before migrations existed may already have some of these columns
+    existing = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    for column, column_type in columns.items():
+        if column not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+
+def create_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        age INTEGER,
+        num_friends INTEGER,
+        hours_logged REAL,
+        new_chats_last_day INTEGER,
+        num_reports INTEGER DEFAULT 0,
+        num_violations INTEGER DEFAULT 0,
+        severity INTEGER DEFAULT 0
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS reports (
+        report_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        reported_user_id INTEGER,
+        violation_type TEXT,
+        severity INTEGER,
+        status TEXT,
+        immediate_danger BOOLEAN DEFAULT FALSE,
+        permission_given BOOLEAN DEFAULT FALSE,
+        FOREIGN KEY (user_id) REFERENCES users (user_id),
+        FOREIGN KEY (reported_user_id) REFERENCES users (user_id)
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS moderations (
+        moderation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        report_id INTEGER,
+        moderator_id INTEGER,
+        action_taken TEXT,
+        justification TEXT,
+        severity INTEGER,
+        FOREIGN KEY (report_id) REFERENCES reports (report_id)
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS regex_rules (
+        rule_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        guild_id INTEGER,
+        pattern TEXT,
+        FOREIGN KEY (guild_id) REFERENCES guilds (id)
+    )
+    ''')
+
+
+def add_queue_columns(conn):
+    # What the moderation queue needs to rebuild a Report after a restart
+    add_columns(conn, 'reports', {
+        "created_at": "REAL",
+        "claimed_by": "INTEGER",
+        "lease_expires_at": "REAL",
+        "guild_id": "INTEGER",
+        "reporter_name": "TEXT",
+        "reported_user_name": "TEXT",
+        "reported_content": "TEXT",
+        "abuse_type": "TEXT",
+        "child_grooming_info": "TEXT",
+        "severity_multiplier": "REAL DEFAULT 1",
+    })
+
+
+def add_timestamps(conn):
+    # SQLite can't add a column with a non-constant default, so the bot fills these in (Unix time).
+    # Existing rows are stamped with the migration time.
+    add_columns(conn, 'users', {"created_at": "REAL", "updated_at": "REAL"})
+    add_columns(conn, 'moderations', {"created_at": "REAL"})
+    add_columns(conn, 'regex_rules', {"created_at": "REAL"})
+    for table in ('users', 'moderations', 'regex_rules'):
+        conn.execute(f"UPDATE {table} SET created_at = CAST(strftime('%s', 'now') AS REAL) WHERE created_at IS NULL")
+    conn.execute("UPDATE users SET updated_at = created_at WHERE updated_at IS NULL")
+    conn.execute("UPDATE reports SET created_at = CAST(strftime('%s', 'now') AS REAL) WHERE created_at IS NULL")
+
+
+def add_indexes(conn):
+    # Rule lookup by guild, covering and already in rule order
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_regex_rules_guild ON regex_rules (guild_id, rule_id, pattern)')
+    # Open reports, most severe and then oldest first. Also serves lease expiry (status = 'CLAIMED').
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_reports_queue ON reports (status, severity DESC, created_at)')
+    # Offender history
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_reports_reported_user ON reports (reported_user_id, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_moderations_report ON moderations (report_id)')
+
+
+def create_local_models(conn):
+    # Versions of the local classifier trained by local_model.py; weights are a zlib-compressed float32 array
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS local_models (
+        version INTEGER PRIMARY KEY AUTOINCREMENT,
+        parent_version INTEGER,
+        created_at REAL,
+        examples INTEGER,
+        through_report_id INTEGER,
+        through_moderation_id INTEGER,
+        dataset_hash TEXT,
+        metrics TEXT,
+        weights BLOB
+    )
+    ''')
+
+
+def create_work_queue(conn):
+    # Classification jobs handed from the gateway to classify_worker.py processes, see work_queue.py
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS classify_jobs (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        shard INTEGER,
+        guild_id INTEGER,
+        status TEXT,
+        worker TEXT,
+        lease_expires_at REAL,
+        attempts INTEGER DEFAULT 0,
+        payload TEXT,
+        result TEXT,
+        created_at REAL
+    )
+    ''')
+    # Claims take the oldest queued job; lease expiry looks for CLAIMED jobs
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_classify_jobs_queue ON classify_jobs (status, job_id)')
+    # Each gateway process picks up the results for its own shards
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_classify_jobs_results ON classify_jobs (status, shard, job_id)')
+    # Mod channel of every guild, so a process can post to guilds that are on another process's shards
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS guild_channels (
+        guild_id INTEGER PRIMARY KEY,
+        mod_channel_id INTEGER,
+        updated_at REAL
+    )
+    ''')
+
+
+def create_verdict_cache(conn):
+    # Persistent side of verdict_cache.VerdictCache. Older databases already have the table, created by the cache.
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS verdict_cache (
+        namespace TEXT,
+        key TEXT,
+        value TEXT,
+        expires_at REAL,
+        PRIMARY KEY (namespace, key)
+    )
+    ''')
+    # Expired entries are deleted on startup
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_verdict_cache_expiry ON verdict_cache (expires_at)')
+
+
+# (version, description, migration); the version is the user_version once the migration has run
+MIGRATIONS = [
+    (1, "create tables", create_tables),
+    (2, "moderation queue columns on reports", add_queue_columns),
+    (3, "created_at/updated_at timestamps", add_timestamps),
+    (4, "indexes for the hot queries", add_indexes),
+    (5, "local model versions", create_local_models),
+    (6, "classification work queue and mod channel ids", create_work_queue),
+    (7, "verdict cache table", create_verdict_cache),
+]
+
+def hot_queries():
+    '''
+    The statements the bot runs per message or per moderation step, as {name: (sql, example params)}; none of
+    them may scan a whole table. The SQL is the modules' own, so this can't drift from what actually runs.
+    '''
+    import guild_registry
+    import moderation_queue
+    import offenders
+    import regex_rules
+    import verdict_cache
+    import work_queue
+
+    shards = work_queue.shard_placeholders((0, 1))
+    return {
+        "regex rules for a guild": (regex_rules.GUILD_RULES_SQL, (1,)),
+        "expire moderation leases": (moderation_queue.EXPIRE_LEASES_SQL, (0,)),
+        "claim next open report": (moderation_queue.CLAIM_SQL, (1, 0)),
+        "renew a report lease": (moderation_queue.RENEW_SQL, (0, 1, 1)),
+        "release a report": (moderation_queue.RELEASE_SQL, (1, 1)),
+        "open reports": (moderation_queue.LIST_OPEN_SQL, (10,)),
+        "open report count": (moderation_queue.OPEN_COUNT_SQL, ()),
+        "user counters": (offenders.USER_COUNTERS_SQL, (1,)),
+        "offender history": (offenders.RECENT_VIOLATIONS_SQL, (1, 5)),
+        "offender's last report": (offenders.LAST_REPORT_SQL, (1,)),
+        "cached verdict": (verdict_cache.LOOKUP_SQL, ("perspective", "key")),
+        "expire cached verdicts": (verdict_cache.DELETE_EXPIRED_SQL, (0,)),
+        "classification work waiting": (work_queue.HAS_WORK_SQL, (0,)),
+        "expire classification claims": (work_queue.EXPIRE_CLAIMS_SQL, (3, 0)),
+        "claim classification jobs": (work_queue.CLAIM_SQL, ("worker", 0, 10)),
+        "complete a classification job": (work_queue.COMPLETE_SQL, ("[]", 1, "worker")),
+        "classification results waiting": (work_queue.HAS_RESULTS_SQL.format(shards=shards), (0, 1)),
+        "take classification results": (work_queue.TAKE_RESULTS_SQL.format(shards=shards), (0, 1, 100)),
+        "mod channel of a guild": (guild_registry.MOD_CHANNEL_SQL, (1,)),
+    }
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    '''
+    Brings the database up to the latest schema version. Returns the versions that were applied.
+    '''
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        if version <= schema_version(conn):
+            continue
+        conn.commit()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Migrated database to schema version {version}: {description}")
+        applied.append(version)
+    return applied
+
+
+def full_scans(plan):
+    # Plan details look like "SCAN reports" or "SEARCH reports USING INDEX ..."; a SCAN that names an index
+    # (e.g. "SCAN reports USING COVERING INDEX ...") still walks the whole table. "SCAN CONSTANT ROW" is a
+    # SELECT without a FROM, e.g. around EXISTS subqueries.
+    return [detail for _, _, _, detail in plan if detail.startswith("SCAN ") and detail != "SCAN CONSTANT ROW"]
+
+
+def check_query_plans(conn):
+    '''
+    Returns a list of (query name, plan detail) for hot queries that would scan a whole table.
+    '''
+    problems = []
+    for name, (sql, params) in hot_queries().items():
+        for detail in full_scans(conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()):
+            problems.append((name, detail))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate modbot.db to the latest schema.")
+    parser.add_argument("path", nargs="?", default="modbot.db")
+    parser.add_argument("--check", action="store_true", help="fail if a hot query would do a full table scan")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.path)
+    migrate(conn)
+    print(f"{args.path} is at schema version {schema_version(conn)}")
+    if args.check:
+        problems = check_query_plans(conn)
+        for name, detail in problems:
+            print(f"Full table scan in {name}: {detail}")
+        if problems:
+            sys.exit(1)
+        print(f"All {len(hot_queries())} hot queries use an index")
+
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,7 @@ class State(Enum):
 class ModerateReport:
     START_KEYWORD = "moderate"
     SHOW_REPORTS_KEYWORD = "show reports"
+    CANCEL_KEYWORD = "cancel"
 
     def __init__(self, client, report, moderator):
         self.state = State.MODERATE_START
@@ -28,21 +29,22 @@ class ModerateReport:
         self.report = report
         self.selected_actions = []
         self.moderation_reasons = None
-        self.num_offenses = 1
+        self.offender = None
 
-    async def handle_message(self, message, num_offenses):
+    async def handle_message(self, message, offender):
         '''
         This function makes up the meat of the moderator-side reporting flow. It defines how we transition between states and what 
         prompts to offer at each of those states.
         '''
 
-        self.num_offenses = num_offenses
+        self.offender = offender
 
         if self.state == State.MODERATE_START:
             reply = "Thank you for starting the moderating process. \n"
             reply += f"Please review the following report filed by {self.report.author.name}:\n\n\n"
-            reply += f"{self.report.compile_report_to_moderate(num_offenses)}"
-            reply += f"Does this seem like a legitimate report that you'd like to proceed with? (Yes/no)"
+            reply += f"{self.report.compile_report_to_moderate(offender)}"
+            reply += f"Does this seem like a legitimate report that you'd like to proceed with? (Yes/no)\n"
+            reply += f"Say `{self.CANCEL_KEYWORD}` at any time to put the report back in the queue for someone else."
             self.state = State.LEGITIMATE_REPORT
             return [reply]
 
@@ -150,9 +152,7 @@ class ModerateReport:
         return view
 
     async def send_DM(self, user_id, message_content):
-        user = await self.client.fetch_user(user_id)
-        dm_channel = await user.create_dm()
-        await dm_channel.send(message_content)
+        await self.client.outbound.send_dm(user_id, message_content)
 
     def moderate_complete(self):
         return self.state == State.MODERATE_COMPLETE
@@ -0,0 +1,140 @@
+import json
+import time
+from types import SimpleNamespace
+from report import Report, BroadAbuseType, SpecificAbuseType, State
+
+REPORT_COLUMNS = ("report_id, user_id, reported_user_id, violation_type, severity, immediate_danger, permission_given, "
+                  "guild_id, reporter_name, reported_user_name, reported_content, abuse_type, child_grooming_info, "
+                  "severity_multiplier")
+
+# The statements the queue runs, also checked for full table scans by tests/test_query_plans.py
+EXPIRE_LEASES_SQL = '''
+UPDATE reports
+SET status = 'OPEN', claimed_by = NULL, lease_expires_at = NULL
+WHERE status = 'CLAIMED' AND lease_expires_at < ?
+'''
+CLAIM_SQL = f'''
+UPDATE reports
+SET status = 'CLAIMED', claimed_by = ?, lease_expires_at = ?
+WHERE report_id = (
+    SELECT report_id FROM reports
+    WHERE status = 'OPEN'
+    ORDER BY severity DESC, created_at
+    LIMIT 1
+) AND status = 'OPEN'
+RETURNING {REPORT_COLUMNS}
+'''
+RENEW_SQL = '''
+UPDATE reports
+SET lease_expires_at = ?
+WHERE report_id = ? AND status = 'CLAIMED' AND claimed_by = ?
+'''
+RELEASE_SQL = '''
+UPDATE reports
+SET status = 'OPEN', claimed_by = NULL, lease_expires_at = NULL
+WHERE report_id = ? AND status = 'CLAIMED' AND claimed_by = ?
+'''
+LIST_OPEN_SQL = f'''
+SELECT {REPORT_COLUMNS} FROM reports
+WHERE status = 'OPEN'
+ORDER BY severity DESC, created_at
+LIMIT ?
+'''
+OPEN_COUNT_SQL = "SELECT COUNT(*) FROM reports WHERE status = 'OPEN'"
+
+
+class ModerationQueue:
+    '''
+    The moderation queue, stored in the reports table of modbot.db instead of in process memory. The columns and
+    index it relies on are created by migrations.py.
+
+    Open reports are served highest severity first, oldest first on ties, straight off the
+    (status, severity DESC, created_at) index. A moderator claims a report with a lease; the claim is a single
+    UPDATE, so two moderators (or two bot processes) can never get the same report. Claims that aren't renewed
+    before the lease runs out go back to the queue when the next report is claimed, or when the owner calls
+    expire_leases (the bot does every MODERATION_LEASE_EXPIRY_SECONDS). Listing and counting the queue are plain
+    reads and never write.
+
+    Reads use `conn`; every write goes through the DBWriter so it never blocks the event loop.
+    '''
+
+    def __init__(self, conn, writer, client=None, lease_seconds=30 * 60):
+        self.conn = conn
+        self.writer = writer
+        self.client = client
+        self.lease_seconds = lease_seconds
+
+    async def expire_leases(self):
+        now = time.time()
+
+        def expire(conn):
+            conn.execute(EXPIRE_LEASES_SQL, (now,))
+
+        await self.writer.run(expire)
+
+    async def claim(self, moderator_id):
+        '''
+        Atomically assigns the most severe open report to the moderator. Returns the Report, or None if the
+        queue is empty.
+        '''
+        now = time.time()
+
+        def claim(conn):
+            conn.execute(EXPIRE_LEASES_SQL, (now,))
+            return conn.execute(CLAIM_SQL, (moderator_id, now + self.lease_seconds)).fetchone()
+
+        row = await self.writer.run(claim)
+        return self.report_from_row(row) if row is not None else None
+
+    async def renew(self, report_id, moderator_id):
+        '''
+        Extends the moderator's lease. Returns False if the claim has been lost to someone else in the meantime.
+        '''
+        expires_at = time.time() + self.lease_seconds
+
+        def renew(conn):
+            return conn.execute(RENEW_SQL, (expires_at, report_id, moderator_id)).rowcount == 1
+
+        return await self.writer.run(renew)
+
+    async def release(self, report_id, moderator_id):
+        def release(conn):
+            conn.execute(RELEASE_SQL, (report_id, moderator_id))
+
+        await self.writer.run(release)
+
+    def list_open(self, limit=None):
+        rows = self.conn.execute(LIST_OPEN_SQL, (limit if limit is not None else -1,)).fetchall()
+        return [self.report_from_row(row) for row in rows]
+
+    def qsize(self):
+        return self.conn.execute(OPEN_COUNT_SQL).fetchone()[0]
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def report_from_row(self, row):
+        (report_id, user_id, reported_user_id, violation_type, severity, immediate_danger, permission_given,
+         guild_id, reporter_name, reported_user_name, reported_content, abuse_type, child_grooming_info,
+         severity_multiplier) = row
+
+        report = Report(self.client, SimpleNamespace(id=user_id, name=reporter_name or f"User #{user_id}"))
+        report.report_id = report_id
+        report.guild_id = guild_id
+        report.reported_message = SimpleNamespace(
+            content=reported_content or "",
+            author=SimpleNamespace(id=reported_user_id, name=reported_user_name or f"User #{reported_user_id}"),
+        )
+        report.abuse_type = BroadAbuseType(abuse_type) if abuse_type else None
+        if violation_type in SpecificAbuseType._value2member_map_:
+            report.specific_abuse_type = SpecificAbuseType(violation_type)
+        else:
+            report.specific_abuse_type = BroadAbuseType.OTHER
+        report.report_severity_multiplier = severity_multiplier if severity_multiplier is not None else 1
+        # The stored severity (weighted by the reported user's earlier violations), which orders the queue
+        report.severity = severity if severity is not None else 0
+        report.child_grooming_info = json.loads(child_grooming_info) if child_grooming_info else []
+        report.danger_indicated = bool(immediate_danger)
+        report.permission_given = bool(permission_given)
+        report.state = State.REPORT_COMPLETE
+        return report
@@ -0,0 +1,131 @@
+import collections
+import time
+
+# Each prior violation raises the severity of a new report against the same user by this much, up to the cap
+REPEAT_OFFENDER_WEIGHT = 0.25
+REPEAT_OFFENDER_CAP = 4
+# Violations kept per profile for moderators to see
+RECENT_VIOLATIONS = 5
+
+# Profile lookups, also checked for full table scans by tests/test_query_plans.py
+USER_COUNTERS_SQL = 'SELECT num_violations, severity FROM users WHERE user_id = ?'
+RECENT_VIOLATIONS_SQL = '''
+SELECT report_id, violation_type, severity, created_at FROM reports
+WHERE reported_user_id = ?
+ORDER BY created_at DESC
+LIMIT ?
+'''
+LAST_REPORT_SQL = 'SELECT MAX(report_id) FROM reports WHERE reported_user_id = ?'
+
+
+def record_report(db, reporter_id, reported_user_id, severity, now):
+    '''
+    Write job: bumps the reporter's report count and the reported user's violation count and total severity.
+    '''
+    db.execute('''
+    INSERT INTO users (user_id, num_reports, created_at, updated_at) VALUES (?, 1, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET num_reports = num_reports + 1, updated_at = excluded.updated_at
+    ''', (reporter_id, now, now))
+
+    db.execute('''
+    INSERT INTO users (user_id, num_violations, severity, created_at, updated_at) VALUES (?, 1, ?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET num_violations = num_violations + 1,
+                                        severity = COALESCE(severity, 0) + excluded.severity,
+                                        updated_at = excluded.updated_at
+    ''', (reported_user_id, severity, now, now))
+
+
+class OffenderProfile:
+    '''
+    A user's moderation history: how often they've been reported, the total severity and their latest violations.
+    '''
+
+    def __init__(self, user_id, num_violations=0, total_severity=0, recent=None, through_report_id=0):
+        self.user_id = user_id
+        self.num_violations = num_violations
+        self.total_severity = total_severity
+        # (report_id, violation_type, severity, created_at), newest first
+        self.recent = collections.deque(recent or [], maxlen=RECENT_VIOLATIONS)
+        # Reports up to this id are already counted
+        self.through_report_id = through_report_id
+        self.loaded_at = time.monotonic()
+
+    def severity_weight(self):
+        '''
+        Multiplier for a new report against this user, based on their violations so far.
+        '''
+        return 1 + REPEAT_OFFENDER_WEIGHT * min(self.num_violations, REPEAT_OFFENDER_CAP)
+
+    def add(self, report_id, violation_type, severity, created_at):
+        if report_id <= self.through_report_id:
+            return
+        self.num_violations += 1
+        self.total_severity += severity
+        self.recent.appendleft((report_id, violation_type, severity, created_at))
+        self.through_report_id = report_id
+
+    def describe(self, name, exclude_report_id=None):
+        '''
+        Text for the moderator, leaving out the report being moderated.
+        '''
+        past = [entry for entry in self.recent if entry[0] != exclude_report_id]
+        excluded = [entry for entry in self.recent if entry[0] == exclude_report_id]
+        count = self.num_violations - len(excluded)
+        if count <= 0:
+            return f"{name} has not been reported before.\n"
+        total_severity = self.total_severity - sum(entry[2] for entry in excluded)
+        described = f"{name} has been reported {count} time(s) in the past (total severity {total_severity:g}).\n"
+        if past:
+            described += "Most recent: " + ", ".join(f"{violation_type} ({severity:g})" for _, violation_type, severity, _ in past) + "\n"
+        return described
+
+
+class OffenderService:
+    '''
+    Offender profiles read from the users and reports tables, with the most recently used ones kept in memory.
+
+    Profiles are loaded with indexed lookups on a miss. New reports are written through: the bot saves
+    them with record_report() in its write job and then calls record_violation(), so cached profiles stay
+    current without reading them back. Reports filed by other bot processes aren't seen that way, so with
+    `max_age` set a profile is read again once it is that many seconds old.
+    '''
+
+    def __init__(self, conn, max_entries=5000, max_age=None):
+        self.conn = conn
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.profiles = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        profile = self.profiles.get(user_id)
+        if profile is not None and self.max_age is not None and time.monotonic() - profile.loaded_at > self.max_age:
+            profile = None
+        if profile is not None:
+            self.profiles.move_to_end(user_id)
+            self.hits += 1
+            return profile
+
+        self.misses += 1
+        profile = self.load(user_id)
+        self.profiles[user_id] = profile
+        self.profiles.move_to_end(user_id)
+        while len(self.profiles) > self.max_entries:
+            self.profiles.popitem(last=False)
+        return profile
+
+    def load(self, user_id):
+        row = self.conn.execute(USER_COUNTERS_SQL, (user_id,)).fetchone()
+        recent = self.conn.execute(RECENT_VIOLATIONS_SQL, (user_id, RECENT_VIOLATIONS)).fetchall()
+        through_report_id = self.conn.execute(LAST_REPORT_SQL, (user_id,)).fetchone()[0] or 0
+        num_violations, total_severity = row if row is not None else (0, 0)
+        return OffenderProfile(user_id, num_violations or 0, total_severity or 0, recent, through_report_id)
+
+    def record_violation(self, user_id, report_id, violation_type, severity, created_at):
+        profile = self.profiles.get(user_id)
+        if profile is not None:
+            profile.add(report_id, violation_type, severity, created_at)
+
+    def __len__(self):
+        return len(self.profiles)
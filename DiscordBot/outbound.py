@@ -0,0 +1,200 @@
+import asyncio
+import collections
+import functools
+import itertools
+import logging
+import time
+import discord
+import metrics
+from ratelimit import TokenBucket
+
+logger = logging.getLogger('discord')
+
+# Lower runs first: removing harmful content beats telling people about it
+PRIORITIES = {"delete": 0, "dm": 1, "post": 2}
+# (requests per second, burst) per route and channel, under Discord's limit of about 5 requests per 5 seconds
+ROUTE_LIMITS = {"delete": (1, 5), "dm": (1, 5), "post": (1, 5)}
+STAGES = {"delete": "discord_delete", "dm": "discord_dm", "post": "mod_channel_send"}
+MAX_MESSAGE_LENGTH = 2000
+
+
+def chunk_texts(texts, limit=MAX_MESSAGE_LENGTH, separator="\n\n"):
+    '''
+    Joins texts into as few messages of at most `limit` characters as possible, splitting any text that is
+    too long on its own.
+    '''
+    chunks, current = [], ""
+    for text in texts:
+        while len(text) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(text[:limit])
+            text = text[limit:]
+        if current and len(current) + len(separator) + len(text) > limit:
+            chunks.append(current)
+            current = ""
+        current = current + separator + text if current else text
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class OutboundScheduler:
+    '''
+    Sends the bot's Discord actions (deleting messages, DMs, mod-channel posts) from a priority queue.
+
+    Each route (action kind and channel or user) has its own token bucket. A worker that finds an action's bucket
+    empty puts it back for when a token is due and moves on, so a busy mod channel never holds up deletions.
+    Informational posts to the same channel within `coalesce_delay` seconds are merged into as few messages as
+    fit, and DM channels are cached per user.
+    '''
+
+    def __init__(self, client, workers=4, coalesce_delay=1.0, route_limits=ROUTE_LIMITS, max_dm_channels=1000):
+        self.client = client
+        self.workers = workers
+        self.coalesce_delay = coalesce_delay
+        self.route_limits = route_limits
+        self.max_dm_channels = max_dm_channels
+        self.buckets = {}
+        self.queue = None
+        self.tasks = []
+        self.sequence = itertools.count()
+        # Actions put aside until their route has a token again, and an event set whenever there are none
+        self.delayed = 0
+        self.undelayed = None
+        self.posts = {}  # channel id -> (channel, [texts]) waiting to be coalesced
+        self.flush_timers = {}
+        self.dm_channels = collections.OrderedDict()
+
+    def start(self):
+        # Started on first use so the queue and workers belong to the running event loop
+        if self.queue is None:
+            self.queue = asyncio.PriorityQueue()
+            self.undelayed = asyncio.Event()
+            self.undelayed.set()
+            self.tasks = [asyncio.create_task(self.run_worker()) for _ in range(self.workers)]
+
+    def bucket(self, kind, route_key):
+        bucket = self.buckets.get((kind, route_key))
+        if bucket is None:
+            rate, burst = self.route_limits[kind]
+            bucket = self.buckets[(kind, route_key)] = TokenBucket(rate, burst)
+        return bucket
+
+    def submit(self, kind, route_key, action):
+        '''
+        Queues `action` (a coroutine function taking no arguments); returns a future for its result. Failures are
+        logged, so callers only need to await the future if they care about the outcome.
+        '''
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self.queue.put_nowait((PRIORITIES[kind], next(self.sequence), kind, route_key, action, future, time.perf_counter()))
+        return future
+
+    def delete(self, message):
+        return self.submit("delete", message.channel.id, message.delete)
+
+    async def send_dm(self, user_id, content):
+        return await self.submit("dm", user_id, functools.partial(self.deliver_dm, user_id, content))
+
+    async def deliver_dm(self, user_id, content):
+        channel = self.dm_channels.get(user_id)
+        if channel is None:
+            user = self.client.get_user(user_id) or await self.client.fetch_user(user_id)
+            channel = user.dm_channel or await user.create_dm()
+            self.dm_channels[user_id] = channel
+            while len(self.dm_channels) > self.max_dm_channels:
+                self.dm_channels.popitem(last=False)
+        else:
+            self.dm_channels.move_to_end(user_id)
+        await channel.send(content)
+
+    def post(self, channel, text):
+        '''
+        Queues an informational message for the channel, to be sent together with any others that arrive within
+        `coalesce_delay` seconds.
+        '''
+        self.start()
+        entry = self.posts.get(channel.id)
+        # Send what is waiting once this text would no longer fit in the same message
+        if entry is not None and sum(len(waiting) + 2 for waiting in entry[1]) + len(text) > MAX_MESSAGE_LENGTH:
+            self.flush_posts(channel.id)
+            entry = None
+        if entry is None:
+            entry = self.posts[channel.id] = (channel, [])
+            self.flush_timers[channel.id] = asyncio.get_running_loop().call_later(
+                self.coalesce_delay, self.flush_posts, channel.id)
+        entry[1].append(text)
+
+    def flush_posts(self, channel_id):
+        timer = self.flush_timers.pop(channel_id, None)
+        if timer is not None:
+            timer.cancel()
+        entry = self.posts.pop(channel_id, None)
+        if entry is None:
+            return
+        channel, texts = entry
+        for chunk in chunk_texts(texts):
+            self.submit("post", channel_id, functools.partial(channel.send, chunk))
+
+    def requeue(self, item):
+        # Back in the queue before it stops counting as delayed, so drain never sees it in neither
+        self.queue.put_nowait(item)
+        self.delayed -= 1
+        if not self.delayed:
+            self.undelayed.set()
+
+    async def run_worker(self):
+        while True:
+            item = await self.queue.get()
+            _, _, kind, route_key, action, future, queued = item
+            try:
+                wait = self.bucket(kind, route_key).try_acquire()
+                if wait:
+                    self.delayed += 1
+                    self.undelayed.clear()
+                    asyncio.get_running_loop().call_later(wait, self.requeue, item)
+                    continue
+                metrics.OUTBOUND_WAIT.observe(time.perf_counter() - queued, kind=kind)
+                with metrics.timed(STAGES[kind]):
+                    result = await action()
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                if isinstance(e, discord.NotFound):
+                    logger.warning(f"Outbound {kind} skipped, target no longer exists: {e}")
+                else:
+                    logger.error(f"Outbound {kind} failed", exc_info=e)
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    def qsize(self):
+        waiting = sum(len(texts) for _, texts in self.posts.values())
+        return waiting + self.delayed + (self.queue.qsize() if self.queue is not None else 0)
+
+    async def drain(self):
+        '''
+        Sends everything queued so far, including posts still waiting to be coalesced.
+        '''
+        for channel_id in list(self.posts):
+            self.flush_posts(channel_id)
+        if self.queue is None:
+            return
+        # A delayed action is done as far as the queue is concerned until it is put back
+        while True:
+            await self.queue.join()
+            if not self.delayed:
+                return
+            await self.undelayed.wait()
+
+    async def close(self, timeout=10):
+        try:
+            await asyncio.wait_for(self.drain(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Dropping {self.qsize()} outbound action(s) on shutdown")
+        for task in self.tasks:
+            task.cancel()
@@ -1,44 +1,130 @@
+import aiohttp
+import asyncio
 import json
+import logging
 import os
-import requests
-
-# There should be a file called 'tokens.json' inside the same folder as this file
-token_path = 'tokens.json'
-if not os.path.isfile(token_path):
-    raise Exception(f"{token_path} not found!")
-with open(token_path) as f:
-    tokens = json.load(f)
-    perspective_token = tokens['perspective']
-
-def get_perspective_scores(text):
-    url = "https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze"
-    headers = {
-        "Content-Type": "application/json",
-    }
-    data = {
-        "comment": {
-            "text": text
-        },
-        "languages": ["en"],
-        "requestedAttributes": {
-            "TOXICITY": {},
-            "SEVERE_TOXICITY": {},
-            "IDENTITY_ATTACK": {},
-            "INSULT": {},
-            "PROFANITY": {},
-            "THREAT": {},
-            "SEXUALLY_EXPLICIT": {},
-            "FLIRTATION": {}
+import random
+import time
+import metrics
+from ratelimit import TokenBucket
+
+logger = logging.getLogger('discord')
+
+PERSPECTIVE_URL = "https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze"
+REQUESTED_ATTRIBUTES = ["TOXICITY", "SEVERE_TOXICITY", "IDENTITY_ATTACK", "INSULT",
+                        "PROFANITY", "THREAT", "SEXUALLY_EXPLICIT", "FLIRTATION"]
+# The API quota in queries per second, for every process using the key
+PERSPECTIVE_QPS = 1
+# Of that, a gateway started with --queue keeps this much for scoring reported messages; the classify_worker.py
+# processes split the rest
+GATEWAY_PERSPECTIVE_QPS = 0.1
+# Status codes worth retrying: rate limited or a server-side failure
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def load_perspective_token(token_path='tokens.json'):
+    # There should be a file called 'tokens.json' inside the same folder as this file
+    if not os.path.isfile(token_path):
+        raise Exception(f"{token_path} not found!")
+    with open(token_path) as f:
+        tokens = json.load(f)
+        return tokens['perspective']
+
+
+class PerspectiveClient:
+    '''
+    Async client for the Perspective API.
+
+    All requests share one pooled aiohttp session, wait on a token bucket sized to the API's QPS quota and are
+    retried with exponential backoff on 429s, 5xx responses and network errors. `url` can point at a local stub
+    server for testing.
+
+    With `max_pending`, at most that many texts are being scored (waiting on the bucket, in flight or backing
+    off) at once; further calls return None straight away instead of queueing behind the quota.
+    '''
+
+    def __init__(self, api_key, url=PERSPECTIVE_URL, qps=1, timeout=10, max_retries=4, backoff=1.0,
+                 max_connections=10, max_pending=None):
+        self.api_key = api_key
+        self.url = url
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_connections = max_connections
+        self.bucket = TokenBucket(qps)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.session = None
+
+    def get_session(self):
+        # Created lazily so the session is bound to the running event loop
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                timeout=self.timeout,
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    async def score(self, text):
+        '''
+        Returns a map from attribute to summary score for the text, or None if the API could not score it or
+        too many texts are already waiting to be scored.
+        '''
+        if self.max_pending is not None and self.pending >= self.max_pending:
+            metrics.API_CALLS.inc(api="perspective", outcome="shed")
+            return None
+        self.pending += 1
+        try:
+            return await self.request(text)
+        finally:
+            self.pending -= 1
+
+    async def request(self, text):
+        data = {
+            "comment": {
+                "text": text
+            },
+            "languages": ["en"],
+            "requestedAttributes": {attribute: {} for attribute in REQUESTED_ATTRIBUTES}
         }
-    }
-    
-    response = requests.post(url, headers=headers, json=data, params={"key": perspective_token})
-    if response.status_code == 200:
-        response_json = response.json()
-        scores = {attribute: response_json['attributeScores'][attribute]['summaryScore']['value'] 
-                  for attribute in response_json['attributeScores']}
-        return scores
-    else:
-        print(f"Error: {response.status_code}, {response.text}")
-        return None
 
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            retry_after = None
+            started = time.perf_counter()
+            try:
+                async with self.get_session().post(self.url, json=data, params={"key": self.api_key}) as response:
+                    if response.status == 200:
+                        response_json = await response.json()
+                        metrics.API_CALLS.inc(api="perspective", outcome="ok")
+                        metrics.API_LATENCY.observe(time.perf_counter() - started, api="perspective")
+                        return {attribute: response_json['attributeScores'][attribute]['summaryScore']['value']
+                                for attribute in response_json['attributeScores']}
+                    body = await response.text()
+                    if response.status not in RETRY_STATUSES:
+                        metrics.API_CALLS.inc(api="perspective", outcome="error")
+                        logger.error(f"Perspective request failed: {response.status}, {body}")
+                        return None
+                    retry_after = response.headers.get("Retry-After")
+                    error = f"{response.status}, {body}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = repr(e)
+            metrics.API_CALLS.inc(api="perspective", outcome="retry" if attempt < self.max_retries else "error")
+
+            if attempt == self.max_retries:
+                logger.error(f"Perspective request failed, giving up after {attempt + 1} attempts: {error}")
+                return None
+            delay = self.backoff * 2 ** attempt * (1 + random.random())
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            await asyncio.sleep(delay)
+
+    async def score_many(self, texts):
+        '''
+        Scores many texts concurrently; the token bucket still keeps the overall rate within quota.
+        '''
+        return await asyncio.gather(*(self.score(text) for text in texts))
@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import time
+import metrics
+from batcher import MessageBatcher
+from classifier import classify, classify_batch, format_conversation, format_numbered_conversation, Verdict
+from context_store import context_key
+from detection import TIER_THRESHOLDS, local_score
+from local_model import LocalModel, latest_version
+from verdict_cache import content_hash
+
+logger = logging.getLogger('discord')
+
+# Upper bound on classifications talking to the APIs at the same time
+MAX_CONCURRENT_CLASSIFICATIONS = 4
+# How long cached verdicts stay valid
+PERSPECTIVE_CACHE_TTL = 24 * 60 * 60
+LLM_CACHE_TTL = 60 * 60
+# Perspective gets this many seconds (retries included) before the local model decides without it
+PERSPECTIVE_DEADLINE = 3
+# "structured" makes one tool-use call per classification, "cascade" is the original question-by-question flow
+CLASSIFICATION_MODE = "structured"
+# Escalated messages of a conversation are judged together in one LLM call once this many have arrived or the
+# first has waited BATCH_MAX_DELAY seconds. Only used in structured mode; 1 turns batching off.
+BATCH_MAX_MESSAGES = 5
+BATCH_MAX_DELAY = 1.5
+
+
+class ClassificationPipeline:
+    '''
+    The detection tiers after the regex rules and fingerprints: the local scorer, the local model and Perspective
+    decide cheaply, and only messages they find suspicious but not clear-cut are escalated to the LLM.
+
+    Decisions are handed to `sink`, which acts on them straight away (the bot) or records them for the gateway
+    to act on (classify_worker.py):
+    - await sink.block_message(message, notice, violation): delete the message and tell the moderators
+    - await sink.report_message(message, verdict): file a report for the LLM's verdict and forward the message
+    - await sink.forward_message(message, notice): tell the moderators about the message
+
+    Messages only need .id, .content, .author (.id, .name), .guild.id and .channel, so the workers can run the
+    pipeline on plain stand-ins built from a queued job.
+    '''
+
+    def __init__(self, sink, perspective, verdict_cache, tier_stats, local_model=None, mode=CLASSIFICATION_MODE,
+                 batch_max_messages=BATCH_MAX_MESSAGES, batch_max_delay=BATCH_MAX_DELAY,
+                 max_concurrent=MAX_CONCURRENT_CLASSIFICATIONS, perspective_deadline=PERSPECTIVE_DEADLINE):
+        self.sink = sink
+        self.perspective = perspective
+        self.verdict_cache = verdict_cache
+        self.tier_stats = tier_stats
+        self.local_model = local_model
+        self.mode = mode
+        self.perspective_deadline = perspective_deadline
+        # Upper bound on classifications talking to the APIs at the same time
+        self.classification_slots = asyncio.Semaphore(max_concurrent)
+        self.batcher = MessageBatcher(self.classify_batch, batch_max_messages, batch_max_delay)
+
+    def reload_local_model(self, conn):
+        '''
+        Switches to the newest trained version of the local model, if there is one we aren't using yet.
+        '''
+        current = self.local_model.version if self.local_model is not None else None
+        if latest_version(conn) == current:
+            return False
+        self.local_model = LocalModel.latest(conn)
+        logger.info("Loaded local model version %s", self.local_model.version)
+        return True
+
+    async def classify(self, message, messages):
+        '''
+        Runs the tiers on the message with its conversation window; returns once every decision about it has been
+        handed to the sink, including those of the LLM batch it ends up in.
+        '''
+        with metrics.span("classify_message", message_id=message.id):
+            await self.run_tiers(message, messages)
+
+    async def run_tiers(self, message, messages):
+        started = time.perf_counter()
+        suspicious = local_score(message.content) >= TIER_THRESHOLDS["local"]["escalate"]
+        self.tier_stats["local"].record("escalate" if suspicious else "pass", started)
+
+        model_score = None
+        if self.local_model is not None:
+            started = time.perf_counter()
+            model_score = self.local_model.score(message.content)
+            if model_score >= TIER_THRESHOLDS["model"]["escalate"]:
+                suspicious = True
+                self.tier_stats["model"].record("escalate", started)
+            else:
+                self.tier_stats["model"].record("pass", started)
+
+        started = time.perf_counter()
+        try:
+            perspective_scores = await asyncio.wait_for(self.score_perspective(message.content),
+                                                        self.perspective_deadline)
+        except asyncio.TimeoutError:
+            # The request carries on in the background and its result is still cached. The client's max_pending
+            # bounds how many of these can pile up.
+            perspective_scores = None
+        top_score = max(perspective_scores.values(), default=0) if perspective_scores is not None else None
+        if top_score is not None and top_score >= TIER_THRESHOLDS["perspective"]["block"]:
+            self.tier_stats["perspective"].record("block", started)
+            formatted_scores = "\n".join(
+                [f"{attribute}: {score:.2f}" for attribute, score in perspective_scores.items()])
+            await self.sink.block_message(
+                message,
+                f'Message from:\n'
+                f'{message.author.name}: "{message.content}"\n\n'
+                f'Perspective scores:\n'
+                f'{formatted_scores}\n\n'
+                f'This message has been deleted and the user should be reviewed.',
+                "toxic by Perspective"
+            )
+            return
+
+        # Without Perspective, escalate unless the local model is confident the message is clean. Until a model
+        # has been trained, only what the local scorer already found suspicious goes on: escalating everything
+        # would send most messages to the LLM whenever the Perspective quota runs out.
+        if top_score is None:
+            self.tier_stats["perspective"].record("unavailable", started)
+            if model_score is not None and model_score >= TIER_THRESHOLDS["model"]["clear"]:
+                suspicious = True
+        elif top_score >= TIER_THRESHOLDS["perspective"]["escalate"]:
+            suspicious = True
+            self.tier_stats["perspective"].record("escalate", started)
+        else:
+            self.tier_stats["perspective"].record("clear", started)
+        if not suspicious:
+            return
+
+        if self.mode == "structured" and self.batcher.max_messages > 1:
+            # Resolved once the batch the message ends up in has been judged
+            judged = asyncio.get_running_loop().create_future()
+            self.batcher.add(context_key(message), (message, messages, judged))
+            await judged
+            return
+
+        await self.classify_alone(message, messages)
+
+    async def classify_batch(self, key, items):
+        '''
+        Judges a batch of escalated messages from one conversation with a single LLM call over the latest
+        context window, then reports each violating message.
+        '''
+        messages = items[-1][1]
+        positions = {entry[2].id: index for index, entry in enumerate(messages)}
+        targets = [(message, positions[message.id]) for message, _, _ in items if message.id in positions]
+
+        # Anything that already scrolled out of the latest window is judged on its own
+        alone = [self.classify_alone(message, context) for message, context, _ in items if message.id not in positions]
+        try:
+            await asyncio.gather(self.judge_batch(messages, targets), *alone)
+        finally:
+            for _, _, judged in items:
+                if not judged.done():
+                    judged.set_result(None)
+
+    async def judge_batch(self, messages, targets):
+        if not targets:
+            return
+        started = time.perf_counter()
+        try:
+            async with self.classification_slots:
+                with metrics.timed("llm_classify_batch", size=len(targets)):
+                    verdicts = await self.eval_batch(messages, [index for _, index in targets])
+        except Exception:
+            logger.exception("LLM batch classification failed")
+            for message, _ in targets:
+                await self.llm_unavailable(message, started)
+            return
+        for message, index in targets:
+            verdict = verdicts[index]
+            self.tier_stats["llm"].record("report" if verdict.violation else "clear", started)
+            if verdict.violation:
+                await self.sink.report_message(message, verdict)
+
+    async def classify_alone(self, message, messages):
+        started = time.perf_counter()
+        try:
+            async with self.classification_slots:
+                with metrics.timed("llm_classify"):
+                    verdict = await self.eval_text(messages)
+        except Exception:
+            logger.exception("LLM classification failed")
+            await self.llm_unavailable(message, started)
+            return
+        self.tier_stats["llm"].record("report" if verdict.violation else "clear", started)
+        if verdict.violation:
+            await self.sink.report_message(message, verdict)
+
+    async def llm_unavailable(self, message, started):
+        '''
+        Falls back to the local model for a message the LLM could not judge: moderators are told about it if the
+        model is confident it is a violation.
+        '''
+        score = self.local_model.score(message.content) if self.local_model is not None else None
+        if score is None or score < TIER_THRESHOLDS["model"]["fallback"]:
+            self.tier_stats["llm"].record("error", started)
+            return
+        self.tier_stats["llm"].record("fallback", started)
+        await self.sink.forward_message(
+            message,
+            f'Forwarded message (LLM unavailable, local model v{self.local_model.version} score {score:.2f}):\n'
+            f'{message.author.name}: "{message.content}"'
+        )
+
+    async def score_perspective(self, text):
+        return await self.verdict_cache.get_or_compute(
+            "perspective", content_hash(text), lambda: self.perspective.score(text), PERSPECTIVE_CACHE_TTL)
+
+    async def eval_text(self, messages):
+        '''
+        Classifies the conversation in the pipeline's mode; returns the Verdict for its last message.
+        '''
+        conversation = format_conversation(messages)
+
+        async def compute():
+            verdict = await classify(conversation, self.mode)
+            return verdict.to_dict()
+
+        return Verdict.from_dict(await self.verdict_cache.get_or_compute(
+            f"llm:{self.mode}", content_hash(conversation), compute, LLM_CACHE_TTL))
+
+    async def eval_batch(self, messages, targets):
+        '''
+        Classifies the target messages (indices into messages) in one call; returns a map from index to Verdict.
+        '''
+        key = content_hash(format_numbered_conversation(messages, targets) + repr(targets))
+
+        async def compute():
+            verdicts = await classify_batch(messages, targets)
+            return {str(index): verdict.to_dict() for index, verdict in verdicts.items()}
+
+        verdicts = await self.verdict_cache.get_or_compute("llm:batch", key, compute, LLM_CACHE_TTL)
+        return {int(index): Verdict.from_dict(dict(verdict, per_message=True)) for index, verdict in verdicts.items()}
+
+    def pending(self):
+        '''
+        Escalated messages waiting for their batch to flush.
+        '''
+        return sum(len(items) for items in self.batcher.pending.values())
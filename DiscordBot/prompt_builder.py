@@ -0,0 +1,62 @@
+'''
+Builds the prompts sent to the LLM.
+
+The static part (role, content policy, task instructions) goes in the system prompt, ahead of the conversation,
+so it can be served from Anthropic's prompt cache once it is long enough (see claude.mark_cache_breakpoint).
+The conversation goes in the user turn, one message per line, trimmed to a token budget by dropping the oldest messages first and shortening
+any single message that is too long on its own.
+'''
+
+# Rough characters per token for English chat; only used to stay under the budget, not for billing
+CHARS_PER_TOKEN = 3.5
+# Budget for the conversation part of a prompt, and for any one message in it
+MAX_CONVERSATION_TOKENS = 3000
+MAX_MESSAGE_TOKENS = 400
+TRUNCATED_MARKER = " [...]"
+
+
+def estimate_tokens(text):
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+class PromptBuilder:
+    def __init__(self, max_conversation_tokens=MAX_CONVERSATION_TOKENS, max_message_tokens=MAX_MESSAGE_TOKENS):
+        self.max_conversation_tokens = max_conversation_tokens
+        self.max_message_tokens = max_message_tokens
+
+    def system(self, text):
+        '''
+        System prompt blocks for the Messages API; the tool definitions and these blocks form the cacheable prefix.
+        '''
+        return [{"type": "text", "text": text}]
+
+    def shorten(self, text):
+        limit = int(self.max_message_tokens * CHARS_PER_TOKEN)
+        if len(text) <= limit:
+            return text
+        return text[:limit] + TRUNCATED_MARKER
+
+    def render(self, messages, numbered=False, keep=()):
+        '''
+        Renders (user id, content, ...) tuples as "User #id: content" lines, oldest first. With `numbered`, each
+        line starts with its index in `messages`, so the numbers stay valid when older lines are dropped.
+        Messages whose index is in `keep` are never dropped.
+        '''
+        lines = []
+        for index, message in enumerate(messages):
+            # Newlines inside a message would look like the start of another message
+            content = self.shorten(" ".join(str(message[1]).split()))
+            prefix = f"[{index}] " if numbered else ""
+            lines.append(f"{prefix}User #{message[0]}: {content}\n")
+
+        total = sum(estimate_tokens(line) for line in lines)
+        dropped = 0
+        first_kept = min(keep, default=len(lines) - 1)
+        while total > self.max_conversation_tokens and dropped < min(first_kept, len(lines) - 1):
+            total -= estimate_tokens(lines[dropped])
+            dropped += 1
+
+        rendered = "".join(lines[dropped:])
+        if dropped:
+            rendered = f"({dropped} earlier message(s) omitted)\n" + rendered
+        return rendered
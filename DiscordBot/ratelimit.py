@@ -0,0 +1,40 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    '''
+    Async token bucket: `rate` tokens are added per second, up to `capacity`. `acquire` waits until a token is
+    available, so callers are spread out to match an API's queries-per-second quota.
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def try_acquire(self):
+        '''
+        Takes a token if one is available and returns 0; otherwise returns how many seconds until there is one.
+        '''
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
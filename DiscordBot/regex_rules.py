@@ -0,0 +1,181 @@
+import logging
+import re
+
+logger = logging.getLogger('discord')
+
+
+REGEX_METACHARACTERS = set('.^$*+?{}[]\\|()')
+QUANTIFIERS = set('*+?{')
+
+GUILD_RULES_SQL = 'SELECT pattern FROM regex_rules WHERE guild_id = ? ORDER BY rule_id'
+
+
+def top_level_alternation(pattern):
+    '''
+    Whether the pattern has a "|" outside any group or character class, i.e. splits into whole alternatives.
+    '''
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            i += 2
+            continue
+        if in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+            # A "]" straight after "[" or "[^" is a literal, not the end of the class
+            if pattern[i + 1:i + 2] == '^':
+                i += 1
+            if pattern[i + 1:i + 2] == ']':
+                i += 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+def literal_prefix(pattern):
+    '''
+    The plain-text characters every match of the pattern has to start with, e.g. "free " for "free (nitro|money)".
+    Patterns with a top-level "|" get no prefix, since the prefix would only belong to the first alternative.
+    '''
+    if top_level_alternation(pattern):
+        return ''
+    end = 0
+    while end < len(pattern) and pattern[end] not in REGEX_METACHARACTERS:
+        end += 1
+    # A quantifier applies to the character just before it, so that one isn't guaranteed
+    if end < len(pattern) and pattern[end] in QUANTIFIERS:
+        end -= 1
+    return pattern[:max(end, 0)]
+
+
+def trie_pattern(rules):
+    '''
+    Combines (prefix, remainder) rules into one regex shaped like a trie over the prefixes, e.g. "cat" and
+    "car" become "ca(?:r|t)". re then branches on one character at a time instead of trying every rule at
+    every position, which keeps matching fast with thousands of rules.
+    '''
+    trie = {}
+    for prefix, remainder in rules:
+        node = trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault('', []).append(remainder)
+
+    def build(node):
+        endings = node.get('', [])
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        branches += [f'(?:{remainder})' for remainder in endings if remainder]
+        optional = '' in endings
+        if not branches:
+            return ''
+        if len(branches) == 1 and not optional:
+            return branches[0]
+        pattern = '(?:' + '|'.join(branches) + ')'
+        return pattern + '?' if optional else pattern
+
+    return build(trie)
+
+
+class GuildRuleSet:
+    '''
+    All regex rules of one guild compiled into a single pattern, so a message is scanned once no matter how
+    many rules there are. Rules are merged into a trie over their literal prefixes; when the combined pattern
+    matches, only the rules whose prefix starts the matched text are re-checked to report which one hit.
+
+    Rules that can't share a pattern (numbered backreferences, global inline flags, clashing group names)
+    are matched one by one afterwards.
+    '''
+
+    def __init__(self, patterns):
+        self.patterns = []
+        self.combined = None
+        self.by_prefix = {}
+        self.separate = []
+
+        compiled = []
+        for pattern in patterns:
+            try:
+                compiled.append((pattern, re.compile(pattern)))
+            except re.error as e:
+                logger.warning(f'Skipping invalid regex rule "{pattern}": {e}')
+        self.patterns = [pattern for pattern, _ in compiled]
+
+        combinable = []
+        for pattern, regex in compiled:
+            # Numbered backreferences would point at the wrong group once the rules are combined
+            if re.search(r'\\[1-9]', pattern) or regex.flags & ~re.UNICODE:
+                self.separate.append((pattern, regex))
+            else:
+                combinable.append((pattern, regex))
+
+        if combinable:
+            pieces = []
+            for pattern, regex in combinable:
+                prefix = literal_prefix(pattern)
+                pieces.append((prefix, pattern[len(prefix):]))
+                self.by_prefix.setdefault(prefix, []).append((pattern, regex))
+            try:
+                self.combined = re.compile(trie_pattern(pieces))
+            except re.error:
+                self.by_prefix = {}
+                self.separate.extend(combinable)
+
+    def match(self, text):
+        '''
+        Returns the pattern of a rule that matches the text, or None.
+        '''
+        if self.combined is not None:
+            m = self.combined.search(text)
+            if m:
+                matched = m.group(0)
+                for length in range(len(matched), -1, -1):
+                    for pattern, regex in self.by_prefix.get(matched[:length], ()):
+                        if regex.match(text, m.start()):
+                            return pattern
+        for pattern, regex in self.separate:
+            if regex.search(text):
+                return pattern
+        return None
+
+    def __len__(self):
+        return len(self.patterns)
+
+
+class RuleEngine:
+    '''
+    In-memory copy of the regex_rules table. Loaded once at startup and rebuilt per guild whenever a rule is
+    added or removed, so matching a message never touches the database.
+    '''
+
+    def __init__(self):
+        self.rule_sets = {}
+
+    def load(self, cursor):
+        rules = {}
+        cursor.execute('SELECT guild_id, pattern FROM regex_rules ORDER BY rule_id')
+        for guild_id, pattern in cursor.fetchall():
+            rules.setdefault(guild_id, []).append(pattern)
+        self.rule_sets = {guild_id: GuildRuleSet(patterns) for guild_id, patterns in rules.items()}
+
+    def reload_guild(self, cursor, guild_id):
+        cursor.execute(GUILD_RULES_SQL, (guild_id,))
+        patterns = [row[0] for row in cursor.fetchall()]
+        if patterns:
+            self.rule_sets[guild_id] = GuildRuleSet(patterns)
+        else:
+            self.rule_sets.pop(guild_id, None)
+
+    def match(self, guild_id, text):
+        rule_set = self.rule_sets.get(guild_id)
+        if rule_set is None:
+            return None
+        return rule_set.match(text)
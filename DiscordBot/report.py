@@ -4,7 +4,6 @@ import re
 from discord.components import SelectOption
 from discord.ui import Select, View
 from discord.ext import commands
-from perspective import get_perspective_scores
 
 PERSPECTIVE_SCORE_THRESHOLD = 0.5
 
@@ -123,23 +122,30 @@ class Report:
 
         if self.state == State.AWAITING_MESSAGE:
             # Parse out the three ID strings from the message link
-            m = re.search('/(\d+)/(\d+)/(\d+)', message.content)
+            m = re.search(r'/(\d+)/(\d+)/(\d+)', message.content)
             if not m:
                 return ["I'm sorry, I couldn't read that link. Please try again or say `cancel` to cancel."]
-            guild = self.client.get_guild(int(m.group(1)))
-            if not guild:
-                return ["I cannot accept reports of messages from guilds that I'm not in. Please have the guild owner add me to the guild and try again."]
-            self.guild_id = guild.id
-            channel = guild.get_channel(int(m.group(2)))
-            if not channel:
+            guild_id, channel_id, message_id = (int(group) for group in m.groups())
+            guild = self.client.get_guild(guild_id)
+            channel = guild.get_channel(channel_id) if guild is not None else None
+            if channel is None:
+                # Guilds on another process's shards aren't in this process's cache, so ask Discord
+                try:
+                    channel = await self.client.fetch_channel(channel_id)
+                except discord.errors.NotFound:
+                    channel = None
+                except discord.errors.Forbidden:
+                    return ["I cannot accept reports of messages from guilds that I'm not in. Please have the guild owner add me to the guild and try again."]
+            if channel is None or getattr(channel, "guild", None) is None or channel.guild.id != guild_id:
                 return ["It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."]
+            self.guild_id = guild_id
             try:
-                message = await channel.fetch_message(int(m.group(3)))
+                message = await channel.fetch_message(message_id)
             except discord.errors.NotFound:
                 return ["It seems this message was deleted or never existed. Please try again or say `cancel` to cancel."]
 
-            perspective_scores = get_perspective_scores(message.content)
-            score_list = list(perspective_scores.values())
+            perspective_scores = await self.client.score_perspective(message.content)
+            score_list = list(perspective_scores.values()) if perspective_scores is not None else []
             perspective_violation = True in [
                 ele > PERSPECTIVE_SCORE_THRESHOLD for ele in score_list]
 
@@ -495,7 +501,7 @@ class Report:
     def calculate_report_severity(self):
         return round(float(severities[self.specific_abuse_type] * self.report_severity_multiplier + len(self.child_grooming_info)), 2)
 
-    def compile_report_to_moderate(self, num_offenses):
+    def compile_report_to_moderate(self, offender=None):
         compiled = f"The following message was reported: \n\n"
         reported_content = self.reported_message.content[:1000] + ('...' if len(self.reported_message.content) > 1000 else '')
         compiled += f"```{self.reported_message.author.name}: {reported_content}```\n"
@@ -515,8 +521,8 @@ class Report:
         elif self.specific_abuse_type == SpecificAbuseType.GROOMING:
             compiled += "The reporter has *not* given permission to review their message history.\n"
 
-        if num_offenses:
-            compiled += f"{self.reported_message.author.name} has been reported {num_offenses - 1} time(s) in the past.\n"
+        if offender is not None:
+            compiled += offender.describe(self.reported_message.author.name, self.report_id)
 
         compiled += "\n\n\n"
         return compiled
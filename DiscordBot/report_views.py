@@ -0,0 +1,133 @@
+import time
+import discord
+from discord.components import SelectOption
+from discord.ui import Button, Select, View
+from report import BroadAbuseType
+
+REPORTS_PER_PAGE = 10
+# Minimum severities moderators can filter on; 0 shows everything
+SEVERITY_FILTERS = (0, 2, 3, 4, 5)
+# Buttons stop responding after this many seconds; "show reports" again gives a fresh listing
+VIEW_TIMEOUT = 15 * 60
+SNIPPET_LENGTH = 150
+
+
+class ReportListView(View):
+    '''
+    "show reports" as one message: an embed listing a page of open reports, with buttons to page through them
+    and menus to filter by abuse type and minimum severity.
+
+    Pages come from a snapshot of the queue taken when the listing is created (or refreshed), already sorted the
+    way moderators are served, so paging and filtering only edit this message and never query the database.
+    '''
+
+    def __init__(self, queue, reports, per_page=REPORTS_PER_PAGE):
+        super().__init__(timeout=VIEW_TIMEOUT)
+        self.queue = queue
+        self.per_page = per_page
+        self.abuse_type = None
+        self.min_severity = 0
+        self.page = 0
+        self.set_snapshot(reports)
+
+        self.previous_button = Button(label="Previous", emoji="◀️", style=discord.ButtonStyle.secondary, row=0)
+        self.next_button = Button(label="Next", emoji="▶️", style=discord.ButtonStyle.secondary, row=0)
+        self.refresh_button = Button(label="Refresh", emoji="🔄", style=discord.ButtonStyle.primary, row=0)
+        self.previous_button.callback = self.show_previous
+        self.next_button.callback = self.show_next
+        self.refresh_button.callback = self.refresh
+        self.abuse_type_menu = Select(placeholder="Filter by abuse type", options=self.abuse_type_options(), row=1)
+        self.abuse_type_menu.callback = self.filter_abuse_type
+        self.severity_menu = Select(placeholder="Filter by severity", options=self.severity_options(), row=2)
+        self.severity_menu.callback = self.filter_severity
+        for item in (self.previous_button, self.next_button, self.refresh_button,
+                     self.abuse_type_menu, self.severity_menu):
+            self.add_item(item)
+        self.update_buttons()
+
+    def set_snapshot(self, reports):
+        self.reports = reports
+        self.taken_at = time.time()
+
+    def filtered(self):
+        return [report for report in self.reports
+                if (self.abuse_type is None or report.abuse_type == self.abuse_type)
+                and report.severity >= self.min_severity]
+
+    def page_count(self, reports):
+        return max(1, -(-len(reports) // self.per_page))
+
+    def abuse_type_options(self):
+        options = [SelectOption(label="All abuse types", value="ALL", default=self.abuse_type is None)]
+        for abuse_type in BroadAbuseType:
+            options.append(SelectOption(label=abuse_type.value.replace("_", " ").title(), value=abuse_type.value,
+                                        default=self.abuse_type == abuse_type))
+        return options
+
+    def severity_options(self):
+        return [SelectOption(label=f"Severity {severity} and up" if severity else "Any severity", value=str(severity),
+                             default=self.min_severity == severity)
+                for severity in SEVERITY_FILTERS]
+
+    def update_buttons(self):
+        pages = self.page_count(self.filtered())
+        self.page = min(self.page, pages - 1)
+        self.previous_button.disabled = self.page == 0
+        self.next_button.disabled = self.page >= pages - 1
+        self.abuse_type_menu.options = self.abuse_type_options()
+        self.severity_menu.options = self.severity_options()
+
+    def render(self):
+        reports = self.filtered()
+        pages = self.page_count(reports)
+        first = self.page * self.per_page
+
+        if not self.reports:
+            description = "No reports to moderate! Rest easy :)"
+        elif not reports:
+            description = f"None of the {len(self.reports)} open report(s) match these filters."
+        else:
+            description = (f"{len(reports)} of {len(self.reports)} open report(s), most severe first.\n"
+                           "Type \"moderate\" to start moderating.")
+        embed = discord.Embed(title="Open reports", description=description, color=discord.Color.orange())
+
+        for index, report in enumerate(reports[first:first + self.per_page], start=first + 1):
+            content = " ".join(report.reported_message.content.split())
+            if len(content) > SNIPPET_LENGTH:
+                content = content[:SNIPPET_LENGTH] + "..."
+            embed.add_field(
+                name=f"{index}. {report.specific_abuse_type} (severity {report.severity:.2f})",
+                value=f"{report.reported_message.author.name}: \"{content}\"\nReported by {report.author.name}",
+                inline=False,
+            )
+
+        snapshot = time.strftime("%H:%M:%S", time.localtime(self.taken_at))
+        embed.set_footer(text=f"Page {self.page + 1}/{pages} · queue as of {snapshot}")
+        return embed
+
+    async def update(self, interaction):
+        self.update_buttons()
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    async def show_previous(self, interaction):
+        self.page = max(0, self.page - 1)
+        await self.update(interaction)
+
+    async def show_next(self, interaction):
+        self.page += 1
+        await self.update(interaction)
+
+    async def refresh(self, interaction):
+        self.set_snapshot(self.queue.list_open())
+        await self.update(interaction)
+
+    async def filter_abuse_type(self, interaction):
+        value = self.abuse_type_menu.values[0]
+        self.abuse_type = None if value == "ALL" else BroadAbuseType(value)
+        self.page = 0
+        await self.update(interaction)
+
+    async def filter_severity(self, interaction):
+        self.min_severity = int(self.severity_menu.values[0])
+        self.page = 0
+        await self.update(interaction)
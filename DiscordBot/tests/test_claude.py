@@ -0,0 +1,28 @@
+import pytest
+from claude import QUESTION_TYPES, ESCALATION_MODEL, TRIAGE_MODEL, request
+
+
+@pytest.mark.parametrize("question", sorted(QUESTION_TYPES))
+def test_request_kwargs(question):
+    kwargs = request("Conversation:\nuser1: hi", "", None, TRIAGE_MODEL, question)
+    assert kwargs["model"] == TRIAGE_MODEL
+    assert kwargs["messages"] == [{"role": "user", "content": "Conversation:\nuser1: hi"}]
+    assert "system" not in kwargs
+    assert 0 < kwargs["max_tokens"] <= 1024
+    # Whitespace-only stop sequences are rejected by the Messages API
+    for stop in kwargs.get("stop_sequences", []):
+        assert stop.strip(), f"{question} has a whitespace-only stop sequence {stop!r}"
+
+
+def test_request_short_answers_stay_short():
+    for question in ("verdict", "label", "yes_no"):
+        assert request("q", "", None, None, question)["max_tokens"] <= 16
+
+
+def test_request_prefill_and_system():
+    system = [{"type": "text", "text": "policy"}]
+    kwargs = request("q", "TYPE:(", system, None, "label")
+    assert kwargs["model"] == ESCALATION_MODEL
+    assert kwargs["messages"][-1] == {"role": "assistant", "content": "TYPE:("}
+    assert kwargs["system"] == system
+    assert kwargs["stop_sequences"] == [")"]
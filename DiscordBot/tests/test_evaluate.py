@@ -0,0 +1,75 @@
+import asyncio
+import pipeline
+from classifier import Verdict
+from evaluate import UNTYPED, Evaluator
+from report import BroadAbuseType, SpecificAbuseType
+
+
+class StubPerspective:
+    def __init__(self, scores):
+        self.scores = scores
+        self.calls = 0
+
+    async def score(self, text):
+        self.calls += 1
+        return {"TOXICITY": self.scores.get(text, 0.0)}
+
+    async def close(self):
+        pass
+
+
+def run_evaluator(tmp_path, monkeypatch, perspective, texts, verdicts=None):
+    verdicts = verdicts or {}
+
+    async def classify(conversation, mode="structured"):
+        text = conversation.split(": ", 1)[1].strip()
+        violation = text in verdicts
+        return Verdict(violation, BroadAbuseType.SPAM if violation else None, verdicts.get(text), api_calls=1)
+
+    monkeypatch.setattr(pipeline, "classify", classify)
+
+    async def main():
+        evaluator = Evaluator("structured", str(tmp_path / "cache.db"), perspective)
+        try:
+            return [await evaluator.evaluate(index, text) for index, text in enumerate(texts)]
+        finally:
+            await evaluator.close()
+
+    return asyncio.run(main())
+
+
+def test_each_tier_decides_like_the_pipeline(tmp_path, monkeypatch):
+    perspective = StubPerspective({"you are awful": 0.95, "buy cheap coins now": 0.5})
+    block, report, clear = run_evaluator(tmp_path, monkeypatch, perspective,
+                                         ["you are awful", "buy cheap coins now", "hello there"],
+                                         {"buy cheap coins now": SpecificAbuseType.SCAM})
+
+    assert (block["tier"], block["violation"], block["predicted"]) == ("perspective", True, UNTYPED)
+    assert (report["tier"], report["violation"], report["predicted"]) == ("llm", True, "SCAM")
+    assert (clear["tier"], clear["violation"]) == ("perspective", False)
+    assert perspective.calls == 3
+
+
+def test_near_copies_of_a_blocked_message_are_caught_by_the_fingerprint_tier(tmp_path, monkeypatch):
+    perspective = StubPerspective({"you are an awful awful person": 0.95})
+    first, copy = run_evaluator(tmp_path, monkeypatch, perspective,
+                                ["you are an awful awful person", "you are an awful awful person!!"])
+
+    assert first["tier"] == "perspective"
+    assert (copy["tier"], copy["predicted"]) == ("fingerprint", UNTYPED)
+    assert perspective.calls == 1
+
+
+def test_a_conversation_level_llm_verdict_does_not_fingerprint_the_message(tmp_path, monkeypatch):
+    text = "buy cheap coins now at coinz dot com"
+    perspective = StubPerspective({text: 0.5, text + "!!": 0.5})
+    first, copy = run_evaluator(tmp_path, monkeypatch, perspective, [text, text + "!!"],
+                                {text: SpecificAbuseType.SCAM, text + "!!": SpecificAbuseType.SCAM})
+
+    assert first["tier"] == copy["tier"] == "llm"
+
+
+def test_without_perspective_every_message_goes_to_the_llm(tmp_path, monkeypatch):
+    results = run_evaluator(tmp_path, monkeypatch, None, ["hello there", "hello there"])
+    assert [result["tier"] for result in results] == ["llm", "llm"]
+    assert [result["fresh"] for result in results] == [True, False]
@@ -0,0 +1,64 @@
+import array
+import random
+import sqlite3
+from local_model import LocalModel, latest_version, train
+from migrations import migrate
+
+SPAM = ["buy cheap crypto coins now", "free nitro giveaway click this link", "claim your prize at scam dot com",
+        "double your bitcoin today guaranteed"]
+CLEAN = ["see you at lunch tomorrow", "the match last night was great", "can someone help with the homework",
+         "happy birthday hope you have fun"]
+
+
+def message(templates, rng):
+    return f"{rng.choice(templates)} {rng.choice(['ok', 'pls', 'guys', 'lol', 'now', 'hey'])} {rng.randrange(1000)}"
+
+
+def open_db(tmp_path):
+    rng = random.Random(7)
+    dataset = tmp_path / "dataset.txt"
+    dataset.write_text("".join(f"SCAM\t{message(SPAM, rng)}\n" for _ in range(150))
+                       + "".join(f"NONE\t{message(CLEAN, rng)}\n" for _ in range(150)), encoding='utf-8')
+    conn = sqlite3.connect(str(tmp_path / "modbot.db"))
+    migrate(conn)
+    return conn, str(dataset), rng
+
+
+def add_reports(conn, texts):
+    conn.executemany("INSERT INTO reports (reported_content, status) VALUES (?, 'OPEN')", [(text,) for text in texts])
+    conn.commit()
+
+
+def test_a_continued_run_replays_older_examples_of_both_classes(tmp_path, monkeypatch):
+    conn, dataset, rng = open_db(tmp_path)
+    assert train(conn, dataset, full=True) is not None
+    add_reports(conn, [message(SPAM, rng) for _ in range(40)])
+
+    fitted = []
+    fit = LocalModel.fit
+
+    def recording_fit(self, examples, *args):
+        fitted.append(examples)
+        fit(self, examples, *args)
+
+    monkeypatch.setattr(LocalModel, "fit", recording_fit)
+    model = train(conn, dataset)
+
+    assert model is not None and model.version == latest_version(conn)
+    labels = [label for _, label, _ in fitted[0]]
+    assert labels.count(False) > 100
+    assert model.score(message(CLEAN, rng)) < 0.5
+
+
+def test_a_continued_run_that_does_worse_on_the_holdout_is_not_saved(tmp_path, monkeypatch):
+    conn, dataset, rng = open_db(tmp_path)
+    parent = train(conn, dataset, full=True)
+    add_reports(conn, [message(SPAM, rng) for _ in range(40)])
+
+    def forget(self, examples, *args):
+        self.weights = array.array('d', bytes(len(self.weights) * 8))
+        self.bias = 5.0
+
+    monkeypatch.setattr(LocalModel, "fit", forget)
+    assert train(conn, dataset) is None
+    assert latest_version(conn) == parent.version
@@ -0,0 +1,58 @@
+import asyncio
+from db_writer import DBWriter, connect
+from migrations import migrate
+from moderation_queue import ModerationQueue
+
+
+def test_lapsed_claims_return_to_the_queue_when_leases_are_expired(tmp_path):
+    path = str(tmp_path / "modbot.db")
+    conn = connect(path)
+    migrate(conn)
+    conn.executemany("INSERT INTO reports (status, severity, created_at, reported_content) VALUES ('OPEN', ?, 0, ?)",
+                     [(2, "worse"), (1, "bad")])
+    conn.commit()
+    writer = DBWriter(path)
+    queue = ModerationQueue(conn, writer, lease_seconds=-1)
+
+    async def main():
+        claimed = await queue.claim(moderator_id=7)
+        # Counting and listing only read, so the lapsed claim stays out until the leases are expired
+        remaining = (queue.qsize(), [report.reported_message.content for report in queue.list_open()])
+        await queue.expire_leases()
+        return claimed, remaining
+
+    try:
+        claimed, remaining = asyncio.run(main())
+    finally:
+        writer.close()
+    assert claimed.reported_message.content == "worse"
+    assert remaining == (1, ["bad"])
+    assert [report.reported_message.content for report in queue.list_open()] == ["worse", "bad"]
+    assert not queue.empty()
+
+
+def test_a_released_claim_goes_straight_back_to_the_queue(tmp_path):
+    path = str(tmp_path / "modbot.db")
+    conn = connect(path)
+    migrate(conn)
+    conn.execute("INSERT INTO reports (status, severity, created_at, reported_content) VALUES ('OPEN', 1, 0, 'bad')")
+    conn.commit()
+    writer = DBWriter(path)
+    queue = ModerationQueue(conn, writer)
+
+    async def main():
+        claimed = await queue.claim(moderator_id=7)
+        # Only the moderator holding the claim can give it back
+        await queue.release(claimed.report_id, moderator_id=8)
+        sizes = [queue.qsize()]
+        await queue.release(claimed.report_id, moderator_id=7)
+        sizes.append(queue.qsize())
+        return sizes, await queue.renew(claimed.report_id, moderator_id=7)
+
+    try:
+        sizes, renewed = asyncio.run(main())
+    finally:
+        writer.close()
+    assert sizes == [0, 1]
+    assert not renewed
+    assert [report.reported_message.content for report in queue.list_open()] == ["bad"]
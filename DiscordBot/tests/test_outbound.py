@@ -0,0 +1,44 @@
+import asyncio
+from outbound import OutboundScheduler
+
+
+def test_drain_waits_for_actions_delayed_by_their_route_limit():
+    sent = []
+
+    async def main():
+        scheduler = OutboundScheduler(None, coalesce_delay=60, route_limits={"delete": (20, 1), "dm": (20, 1),
+                                                                             "post": (20, 1)})
+
+        async def delete(number):
+            sent.append(number)
+
+        futures = [scheduler.submit("delete", 1, lambda number=number: delete(number)) for number in range(4)]
+        await asyncio.wait_for(scheduler.drain(), 5)
+        done = [future.done() for future in futures]
+        await scheduler.close()
+        return done
+
+    assert asyncio.run(main()) == [True] * 4
+    assert sent == [0, 1, 2, 3]
+
+
+def test_drain_flushes_posts_waiting_to_be_coalesced():
+    class Channel:
+        id = 5
+
+        def __init__(self):
+            self.messages = []
+
+        async def send(self, text):
+            self.messages.append(text)
+
+    async def main():
+        scheduler = OutboundScheduler(None, coalesce_delay=60)
+        channel = Channel()
+        scheduler.post(channel, "first")
+        scheduler.post(channel, "second")
+        await asyncio.wait_for(scheduler.drain(), 5)
+        await scheduler.close()
+        return channel.messages
+
+    assert asyncio.run(main()) == ["first\n\nsecond"]
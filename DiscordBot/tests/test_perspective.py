@@ -0,0 +1,106 @@
+import asyncio
+import time
+from aiohttp import web
+from perspective import PerspectiveClient, REQUESTED_ATTRIBUTES
+
+
+def scores(value):
+    return {"attributeScores": {"TOXICITY": {"summaryScore": {"value": value}}}}
+
+
+async def serve(responses, delay=0):
+    '''
+    A local stand-in for the Perspective API that answers with `responses` in turn, the last one from then on.
+    Returns the runner, the url and the list of requests it received.
+    '''
+    requests = []
+
+    async def analyze(request):
+        requests.append({"key": request.query.get("key"), "body": await request.json()})
+        await asyncio.sleep(delay)
+        status, headers, body = responses[min(len(requests), len(responses)) - 1]
+        if status == 200:
+            return web.json_response(body)
+        return web.Response(status=status, headers=headers, text="error")
+
+    app = web.Application()
+    app.router.add_post("/analyze", analyze)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}/analyze", requests
+
+
+def score(responses, text="hello", delay=0, **kwargs):
+    async def main():
+        runner, url, requests = await serve(responses, delay)
+        client = PerspectiveClient("test-key", url=url, qps=1000, **kwargs)
+        try:
+            started = time.monotonic()
+            result = await client.score(text)
+            return result, requests, time.monotonic() - started
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    return asyncio.run(main())
+
+
+def test_ok():
+    result, requests, _ = score([(200, {}, scores(0.7))], text="you idiot")
+    assert result == {"TOXICITY": 0.7}
+    assert len(requests) == 1
+    assert requests[0]["key"] == "test-key"
+    assert requests[0]["body"]["comment"]["text"] == "you idiot"
+    assert sorted(requests[0]["body"]["requestedAttributes"]) == sorted(REQUESTED_ATTRIBUTES)
+
+
+def test_429_waits_for_retry_after():
+    result, requests, elapsed = score([(429, {"Retry-After": "1"}, None), (200, {}, scores(0.1))], backoff=0.01)
+    assert result == {"TOXICITY": 0.1}
+    assert len(requests) == 2
+    assert elapsed >= 1
+
+
+def test_5xx_backs_off_exponentially():
+    result, requests, elapsed = score([(503, {}, None), (500, {}, None), (200, {}, scores(0.2))], backoff=0.05)
+    assert result == {"TOXICITY": 0.2}
+    assert len(requests) == 3
+    # At least backoff * 2^0 + backoff * 2^1
+    assert elapsed >= 0.15
+
+
+def test_gives_up_after_max_retries():
+    result, requests, _ = score([(502, {}, None)], backoff=0.01, max_retries=2)
+    assert result is None
+    assert len(requests) == 3
+
+
+def test_client_error_is_not_retried():
+    result, requests, _ = score([(400, {}, None)], backoff=0.01)
+    assert result is None
+    assert len(requests) == 1
+
+
+def test_timeout_is_retried_then_gives_up():
+    result, requests, elapsed = score([(200, {}, scores(0.5))], delay=1, timeout=0.1, backoff=0.01, max_retries=1)
+    assert result is None
+    assert len(requests) == 2
+    assert elapsed < 1
+
+
+def test_sheds_calls_over_max_pending():
+    async def main():
+        runner, url, requests = await serve([(200, {}, scores(0.3))], delay=0.2)
+        client = PerspectiveClient("test-key", url=url, qps=1000, max_pending=2)
+        try:
+            return await asyncio.gather(*(client.score(f"text {i}") for i in range(5))), requests
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    results, requests = asyncio.run(main())
+    assert results[:2] == [{"TOXICITY": 0.3}] * 2
+    assert results[2:] == [None] * 3
+    assert len(requests) == 2
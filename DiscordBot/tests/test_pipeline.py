@@ -0,0 +1,99 @@
+import asyncio
+from types import SimpleNamespace
+import pipeline
+from classifier import Verdict
+from detection import TIERS, TierStats
+from report import BroadAbuseType, SpecificAbuseType
+from verdict_cache import VerdictCache
+
+
+class RecordingSink:
+    def __init__(self):
+        self.reports = []
+
+    async def report_message(self, message, verdict):
+        self.reports.append((message.id, verdict.per_message))
+
+
+class NoPerspective:
+    async def score(self, text):
+        return None
+
+
+def conversation(texts):
+    messages = []
+    for index, text in enumerate(texts):
+        message = SimpleNamespace(id=index, content=text, author=SimpleNamespace(id=1, name="user"),
+                                  guild=SimpleNamespace(id=1), channel=SimpleNamespace(id=1))
+        messages.append((1, text, message))
+    return messages
+
+
+def run(monkeypatch, batch_max_messages):
+    async def classify(conversation, mode="structured"):
+        return Verdict(True, BroadAbuseType.SPAM, SpecificAbuseType.SCAM)
+
+    async def classify_batch(messages, targets):
+        return {index: Verdict(True, BroadAbuseType.SPAM, SpecificAbuseType.SCAM) for index in targets}
+
+    monkeypatch.setattr(pipeline, "classify", classify)
+    monkeypatch.setattr(pipeline, "classify_batch", classify_batch)
+    sink = RecordingSink()
+
+    async def main():
+        classification = pipeline.ClassificationPipeline(
+            sink, NoPerspective(), VerdictCache(), {tier: TierStats(tier) for tier in TIERS},
+            batch_max_messages=batch_max_messages, batch_max_delay=0.01)
+        messages = conversation(["hello there", "free nitro at http://discord-gift.example.com, claim now"])
+        await classification.run_tiers(messages[-1][2], messages)
+
+    asyncio.run(main())
+    return sink.reports
+
+
+def test_batch_verdicts_are_about_their_target_message(monkeypatch):
+    assert run(monkeypatch, batch_max_messages=5) == [(1, True)]
+
+
+def test_verdicts_about_the_whole_conversation_are_not(monkeypatch):
+    assert run(monkeypatch, batch_max_messages=1) == [(1, False)]
+
+
+class StubModel:
+    version = 1
+
+    def __init__(self, score):
+        self.value = score
+
+    def score(self, text):
+        return self.value
+
+
+def escalated(monkeypatch, text, local_model=None):
+    judged = []
+
+    async def classify(conversation, mode="structured"):
+        judged.append(conversation)
+        return Verdict(False)
+
+    monkeypatch.setattr(pipeline, "classify", classify)
+
+    async def main():
+        classification = pipeline.ClassificationPipeline(
+            RecordingSink(), NoPerspective(), VerdictCache(), {tier: TierStats(tier) for tier in TIERS},
+            local_model, batch_max_messages=1)
+        messages = conversation([text])
+        await classification.run_tiers(messages[-1][2], messages)
+
+    asyncio.run(main())
+    return bool(judged)
+
+
+def test_without_perspective_or_a_model_only_locally_suspicious_messages_escalate(monkeypatch):
+    assert not escalated(monkeypatch, "see you at lunch tomorrow")
+    assert escalated(monkeypatch, "free nitro at http://discord-gift.example.com, claim now")
+
+
+def test_without_perspective_the_model_decides_what_escalates(monkeypatch):
+    assert escalated(monkeypatch, "see you at lunch tomorrow", StubModel(0.5))
+    assert not escalated(monkeypatch, "see you at lunch tomorrow", StubModel(0.0))
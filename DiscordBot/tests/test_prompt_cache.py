@@ -0,0 +1,45 @@
+import pytest
+from claude import PROMPTS, PROMPT_CACHE_MIN_TOKENS, TRIAGE_MODEL, ESCALATION_MODEL, cached_prefix_tokens, \
+    mark_cache_breakpoint, request
+from classifier import BATCH_CLASSIFICATION_TOOL, CLASSIFICATION_TOOL, PROMPT_BUILDER
+
+
+def system_prompt(instructions):
+    return PROMPT_BUILDER.system(PROMPTS["system_message"].format(content_policy=PROMPTS["content_policy"],
+                                                                  instructions=PROMPTS[instructions]))
+
+
+# The prefixes the classifier sends: (instructions, tool)
+PREFIXES = [
+    ("structured_instructions", CLASSIFICATION_TOOL),
+    ("batch_instructions", BATCH_CLASSIFICATION_TOOL),
+    ("instructions", None),
+]
+
+
+@pytest.mark.parametrize("model", [TRIAGE_MODEL, ESCALATION_MODEL])
+@pytest.mark.parametrize("instructions, tool", PREFIXES)
+def test_breakpoint_only_on_prefixes_long_enough_to_cache(model, instructions, tool):
+    kwargs = request("Conversation:\nUser #1: hi", "", system_prompt(instructions), model, "tool")
+    if tool is not None:
+        kwargs["tools"] = [tool]
+    tokens = cached_prefix_tokens(kwargs)
+    marked = mark_cache_breakpoint(kwargs)
+    assert marked == (tokens >= PROMPT_CACHE_MIN_TOKENS[model])
+    assert ("cache_control" in kwargs["system"][-1]) == marked
+
+
+def test_long_prefix_is_marked():
+    system = PROMPT_BUILDER.system("policy " * 2000)
+    kwargs = request("q", "", system, TRIAGE_MODEL, "tool")
+    assert cached_prefix_tokens(kwargs) >= PROMPT_CACHE_MIN_TOKENS[TRIAGE_MODEL]
+    assert mark_cache_breakpoint(kwargs)
+    assert kwargs["system"][-1]["cache_control"] == {"type": "ephemeral"}
+    # The builder's blocks are shared between calls and must not be marked in place
+    assert "cache_control" not in system[-1]
+
+
+def test_no_system_prompt_is_left_alone():
+    kwargs = request("q", "", None, ESCALATION_MODEL, "reason")
+    assert not mark_cache_breakpoint(kwargs)
+    assert "system" not in kwargs
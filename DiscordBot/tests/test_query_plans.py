@@ -0,0 +1,37 @@
+import sqlite3
+import pytest
+from migrations import MIGRATIONS, check_query_plans, full_scans, hot_queries, migrate, schema_version
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "modbot.db"))
+    migrate(conn)
+    yield conn
+    conn.close()
+
+
+def test_migrate_reaches_the_latest_version(conn):
+    assert schema_version(conn) == MIGRATIONS[-1][0]
+    assert migrate(conn) == []
+
+
+@pytest.mark.parametrize("name", sorted(hot_queries()))
+def test_hot_query_uses_an_index(conn, name):
+    # Without ANALYZE statistics SQLite plans as if every table were large, which is the case that matters
+    sql, params = hot_queries()[name]
+    plan = conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+    assert full_scans(plan) == [], f"{name} scans a whole table: {plan}"
+
+
+def test_check_covers_the_lease_claim_and_offender_lookups():
+    queries = hot_queries()
+    assert "claim next open report" in queries
+    assert "offender's last report" in queries
+    assert "MAX(report_id)" in queries["offender's last report"][0]
+
+
+def test_check_reports_a_full_scan(conn):
+    plan = conn.execute("EXPLAIN QUERY PLAN SELECT * FROM reports WHERE reporter_name = ?", ("x",)).fetchall()
+    assert full_scans(plan)
+    assert check_query_plans(conn) == []
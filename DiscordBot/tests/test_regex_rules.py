@@ -0,0 +1,18 @@
+from regex_rules import GuildRuleSet, literal_prefix
+
+
+def test_literal_prefix():
+    assert literal_prefix("free (nitro|money)") == "free "
+    assert literal_prefix("free nitro|cheap money") == ""
+    assert literal_prefix(r"a\|b") == "a"
+    assert literal_prefix("gift[|]card|x") == ""
+    assert literal_prefix("gift[|]card") == "gift"
+    assert literal_prefix("scams?") == "scam"
+
+
+def test_rules_with_alternation_inside_a_group_still_match():
+    rules = GuildRuleSet(["free (nitro|money)", "cheap crypto|buy coins", "free trial"])
+    assert rules.match("get free money here") == "free (nitro|money)"
+    assert rules.match("want to buy coins?") == "cheap crypto|buy coins"
+    assert rules.match("start a free trial") == "free trial"
+    assert rules.match("free stuff") is None
@@ -0,0 +1,63 @@
+import asyncio
+from types import SimpleNamespace
+import discord
+from report import Report, State
+
+LINK = "https://discord.com/channels/100/200/300"
+
+
+class RestOnlyClient:
+    '''
+    A bot process whose shards don't include guild 100: nothing is cached, only the REST calls find it.
+    '''
+
+    def __init__(self, fetch_error=None):
+        self.fetch_error = fetch_error
+        self.fetched = []
+        self.reported = SimpleNamespace(id=300, content="pay me or else",
+                                        author=SimpleNamespace(id=5, name="offender"))
+
+    def get_guild(self, guild_id):
+        return None
+
+    async def fetch_channel(self, channel_id):
+        self.fetched.append(channel_id)
+        if self.fetch_error is not None:
+            raise self.fetch_error
+
+        async def fetch_message(message_id):
+            assert message_id == 300
+            return self.reported
+
+        return SimpleNamespace(id=channel_id, guild=SimpleNamespace(id=100), fetch_message=fetch_message)
+
+    async def score_perspective(self, text):
+        return None
+
+
+def report_link(client):
+    async def main():
+        report = Report(client, SimpleNamespace(id=1, name="reporter"))
+        report.state = State.AWAITING_MESSAGE
+        return report, await report.handle_message(SimpleNamespace(content=LINK))
+
+    return asyncio.run(main())
+
+
+def test_a_message_in_a_guild_missing_from_the_cache_is_fetched_over_rest():
+    client = RestOnlyClient()
+    report, replies = report_link(client)
+
+    assert client.fetched == [200]
+    assert report.state == State.AWAITING_ABUSE_TYPE
+    assert report.guild_id == 100
+    assert report.reported_message is client.reported
+    assert "pay me or else" in replies[1]["text"]
+
+
+def test_a_guild_the_bot_is_not_in_is_still_rejected():
+    response = SimpleNamespace(status=403, reason="Forbidden")
+    report, replies = report_link(RestOnlyClient(discord.errors.Forbidden(response, "Missing Access")))
+
+    assert report.state == State.AWAITING_MESSAGE
+    assert "guilds that I'm not in" in replies[0]
@@ -0,0 +1,32 @@
+from db_writer import DBWriter, connect
+from migrations import migrate
+from verdict_cache import VerdictCache
+
+
+def open_cache(path, **kwargs):
+    conn = connect(path)
+    migrate(conn)
+    writer = DBWriter(path)
+    return conn, writer, VerdictCache(conn=conn, writer=writer, **kwargs)
+
+
+def test_entries_survive_a_restart_and_expired_ones_are_dropped(tmp_path):
+    path = str(tmp_path / "modbot.db")
+    conn, writer, cache = open_cache(path)
+    cache.put("perspective", "fresh", {"TOXICITY": 0.5}, ttl=60)
+    cache.put("perspective", "stale", {"TOXICITY": 0.9}, ttl=-1)
+    writer.close()
+
+    conn, writer, cache = open_cache(path)
+    writer.close()
+    assert cache.get("perspective", "fresh") == {"TOXICITY": 0.5}
+    assert conn.execute("SELECT key FROM verdict_cache").fetchall() == [("fresh",)]
+
+
+def test_writes_go_through_the_writer(tmp_path):
+    path = str(tmp_path / "modbot.db")
+    conn, writer, cache = open_cache(path)
+    cache.put("llm", "key", {"violation": False})
+    writer.close()
+    assert conn.execute("SELECT value FROM verdict_cache WHERE key = 'key'").fetchone() == ('{"violation": false}',)
+    assert not conn.in_transaction
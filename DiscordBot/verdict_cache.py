@@ -0,0 +1,123 @@
+import asyncio
+import collections
+import hashlib
+import json
+import re
+import time
+
+
+def content_hash(text):
+    '''
+    Hash of the text after case folding and collapsing whitespace, so trivially re-formatted reposts share a key.
+    '''
+    normalized = re.sub(r'\s+', ' ', text.casefold()).strip()
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+LOOKUP_SQL = 'SELECT value, expires_at FROM verdict_cache WHERE namespace = ? AND key = ?'
+WRITE_SQL = 'INSERT OR REPLACE INTO verdict_cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)'
+DELETE_EXPIRED_SQL = 'DELETE FROM verdict_cache WHERE expires_at < ?'
+
+
+def write_entry(conn, row):
+    conn.execute(WRITE_SQL, row)
+
+
+def delete_expired(conn, now):
+    conn.execute(DELETE_EXPIRED_SQL, (now,))
+
+
+class VerdictCache:
+    '''
+    Size-bounded LRU cache with per-entry TTLs for API verdicts, split into namespaces (e.g. Perspective
+    scores and LLM verdicts). Values must be JSON serializable.
+
+    If a SQLite connection and a DBWriter are given, entries are also written to the verdict_cache table
+    (created by migrations.py) and read back on a miss, so the cache stays warm across restarts. Only the
+    lookups use the connection; expiry and new entries go through the writer.
+    '''
+
+    def __init__(self, max_entries=10000, ttl=3600, conn=None, writer=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.conn = conn
+        self.writer = writer
+        self.entries = collections.OrderedDict()  # (namespace, key) -> (expires_at, value)
+        self.inflight = {}
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        # Misses that were answered by another caller's in-flight computation
+        self.coalesced = collections.Counter()
+
+        if self.conn is not None:
+            if self.writer is None:
+                raise ValueError("A persistent VerdictCache needs a DBWriter for its writes")
+            self.writer.submit(delete_expired, time.time())
+
+    def get(self, namespace, key):
+        now = time.time()
+        entry = self.entries.get((namespace, key))
+        if entry is None and self.conn is not None:
+            row = self.conn.execute(LOOKUP_SQL, (namespace, key)).fetchone()
+            if row is not None:
+                entry = (row[1], json.loads(row[0]))
+                self.store(namespace, key, entry)
+
+        if entry is None or entry[0] < now:
+            if entry is not None:
+                self.entries.pop((namespace, key), None)
+            self.misses[namespace] += 1
+            return None
+
+        self.entries.move_to_end((namespace, key))
+        self.hits[namespace] += 1
+        return entry[1]
+
+    def put(self, namespace, key, value, ttl=None):
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        self.store(namespace, key, (expires_at, value))
+        if self.conn is None:
+            return
+        self.writer.submit(write_entry, (namespace, key, json.dumps(value), expires_at))
+
+    def store(self, namespace, key, entry):
+        self.entries[(namespace, key)] = entry
+        self.entries.move_to_end((namespace, key))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def get_or_compute(self, namespace, key, compute, ttl=None):
+        '''
+        Returns the cached value or awaits compute() to produce it. Concurrent callers asking for the same key
+        share a single computation, so a burst of identical messages costs one API call. None results are not cached.
+        A caller that stops waiting (a timeout) doesn't cancel the computation, and its result is still cached.
+        '''
+        value = self.get(namespace, key)
+        if value is not None:
+            return value
+
+        pending = self.inflight.get((namespace, key))
+        if pending is not None:
+            self.coalesced[namespace] += 1
+            return await asyncio.shield(pending)
+
+        pending = asyncio.ensure_future(compute())
+        self.inflight[(namespace, key)] = pending
+        pending.add_done_callback(lambda done: self.finish(namespace, key, done, ttl))
+        return await asyncio.shield(pending)
+
+    def finish(self, namespace, key, done, ttl):
+        self.inflight.pop((namespace, key), None)
+        if done.cancelled() or done.exception() is not None:
+            return
+        if done.result() is not None:
+            self.put(namespace, key, done.result(), ttl)
+
+    def stats(self):
+        namespaces = sorted(set(self.hits) | set(self.misses))
+        return {namespace: {"hits": self.hits[namespace], "misses": self.misses[namespace],
+                            "coalesced": self.coalesced[namespace]}
+                for namespace in namespaces}
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,168 @@
+import json
+import time
+from types import SimpleNamespace
+
+# A job claimed by a worker that hasn't finished it by then (say the process died) goes back to the queue
+JOB_LEASE_SECONDS = 2 * 60
+# After this many claims a job is given up on, so one message that crashes workers can't stall the queue
+MAX_ATTEMPTS = 3
+
+# The statements the queue runs, also checked for full table scans by tests/test_query_plans.py.
+# {shards} is filled in with one placeholder per shard.
+ENQUEUE_SQL = '''
+INSERT INTO classify_jobs (shard, guild_id, status, attempts, payload, created_at)
+VALUES (?, ?, 'QUEUED', 0, ?, ?)
+'''
+HAS_WORK_SQL = '''
+SELECT EXISTS (SELECT 1 FROM classify_jobs WHERE status = 'QUEUED')
+    OR EXISTS (SELECT 1 FROM classify_jobs WHERE status = 'CLAIMED' AND lease_expires_at < ?)
+'''
+EXPIRE_CLAIMS_SQL = '''
+UPDATE classify_jobs
+SET status = CASE WHEN attempts >= ? THEN 'FAILED' ELSE 'QUEUED' END, worker = NULL, lease_expires_at = NULL
+WHERE status = 'CLAIMED' AND lease_expires_at < ?
+'''
+CLAIM_SQL = '''
+UPDATE classify_jobs
+SET status = 'CLAIMED', worker = ?, lease_expires_at = ?, attempts = attempts + 1
+WHERE job_id IN (
+    SELECT job_id FROM classify_jobs
+    WHERE status = 'QUEUED'
+    ORDER BY job_id
+    LIMIT ?
+) AND status = 'QUEUED'
+RETURNING job_id, payload
+'''
+COMPLETE_SQL = '''
+UPDATE classify_jobs
+SET status = 'DONE', result = ?, worker = NULL, lease_expires_at = NULL
+WHERE job_id = ? AND status = 'CLAIMED' AND worker = ?
+'''
+HAS_RESULTS_SQL = '''
+SELECT EXISTS (SELECT 1 FROM classify_jobs WHERE status = 'DONE' AND shard IN ({shards}))
+'''
+TAKE_RESULTS_SQL = '''
+DELETE FROM classify_jobs
+WHERE job_id IN (
+    SELECT job_id FROM classify_jobs
+    WHERE status = 'DONE' AND shard IN ({shards})
+    ORDER BY job_id
+    LIMIT ?
+)
+RETURNING job_id, payload, result
+'''
+COUNTS_SQL = 'SELECT status, COUNT(*) FROM classify_jobs GROUP BY status'
+
+
+def shard_placeholders(shards):
+    return ", ".join("?" * len(shards))
+
+
+def job_payload(message, context):
+    '''
+    Everything a worker needs to classify the message: the message itself and its conversation window as
+    (user id, content, message id) entries.
+    '''
+    return json.dumps({
+        "id": message.id,
+        "content": message.content,
+        "author_id": message.author.id,
+        "author_name": message.author.name,
+        "guild_id": message.guild.id,
+        "channel_id": message.channel.id,
+        "context": [(user_id, content, entry.id) for user_id, content, entry in context],
+    })
+
+
+def message_from_payload(payload, channel=None):
+    '''
+    A stand-in for the queued message with the attributes the pipeline and the report flow use, and its
+    conversation window in the (user id, content, message) shape of ContextStore.
+    '''
+    message = SimpleNamespace(
+        id=payload["id"],
+        content=payload["content"],
+        author=SimpleNamespace(id=payload["author_id"], name=payload["author_name"]),
+        guild=SimpleNamespace(id=payload["guild_id"]),
+        channel=channel if channel is not None else SimpleNamespace(id=payload["channel_id"]),
+    )
+    context = [(user_id, content, SimpleNamespace(id=message_id)) for user_id, content, message_id in payload["context"]]
+    return message, context
+
+
+class WorkQueue:
+    '''
+    Classification jobs in the classify_jobs table of modbot.db, shared by the gateway process(es) and the
+    classify_worker.py processes. The table and its indexes are created by migrations.py.
+
+    A job is QUEUED by the gateway, CLAIMED with a lease by one worker, DONE with the worker's decisions, and
+    deleted when the gateway process that owns the guild's shard takes the result to act on it. Claims and
+    result pickup are single UPDATE/DELETE ... RETURNING statements, so two processes never get the same job.
+    Expired claims go back to the queue, which makes delivery at-least-once.
+
+    Reads use `conn`; every write goes through the DBWriter.
+    '''
+
+    def __init__(self, conn, writer, lease_seconds=JOB_LEASE_SECONDS):
+        self.conn = conn
+        self.writer = writer
+        self.lease_seconds = lease_seconds
+
+    async def put(self, shard, message, context):
+        '''
+        Queues the message; returns once the job is committed, and raises if it couldn't be.
+        '''
+        row = (shard, message.guild.id, job_payload(message, context), time.time())
+
+        def enqueue(conn):
+            conn.execute(ENQUEUE_SQL, row)
+
+        await self.writer.run(enqueue)
+
+    def has_work(self):
+        now = time.time()
+        return self.conn.execute(HAS_WORK_SQL, (now,)).fetchone()[0]
+
+    async def claim(self, worker, limit):
+        '''
+        Leases up to `limit` of the oldest queued jobs to the worker; returns (job id, payload) pairs.
+        '''
+        now = time.time()
+
+        def claim(conn):
+            conn.execute(EXPIRE_CLAIMS_SQL, (MAX_ATTEMPTS, now))
+            return conn.execute(CLAIM_SQL, (worker, now + self.lease_seconds, limit)).fetchall()
+
+        rows = await self.writer.run(claim)
+        return sorted((job_id, json.loads(payload)) for job_id, payload in rows)
+
+    async def complete(self, job_id, worker, actions):
+        '''
+        Stores the worker's decisions about the job for the gateway to act on; returns once they are committed,
+        and raises if they couldn't be.
+        '''
+        row = (json.dumps(actions), job_id, worker)
+
+        def complete(conn):
+            conn.execute(COMPLETE_SQL, row)
+
+        await self.writer.run(complete)
+
+    def has_results(self, shards):
+        sql = HAS_RESULTS_SQL.format(shards=shard_placeholders(shards))
+        return self.conn.execute(sql, tuple(shards)).fetchone()[0]
+
+    async def take_results(self, shards, limit):
+        '''
+        Removes up to `limit` finished jobs of the given shards; returns (payload, actions) pairs, oldest first.
+        '''
+        sql = TAKE_RESULTS_SQL.format(shards=shard_placeholders(shards))
+
+        def take(conn):
+            return conn.execute(sql, (*shards, limit)).fetchall()
+
+        rows = await self.writer.run(take)
+        return [(json.loads(payload), json.loads(result)) for _, payload, result in sorted(rows)]
+
+    def counts(self):
+        return dict(self.conn.execute(COUNTS_SQL).fetchall())